@@ -1,13 +1,14 @@
 #!/usr/bin/python3
 
-import yaml
 import os
 
+import clab_yaml
+
 def main():
     """ Adds FQDNs for clab devices to /etc/hosts"""
 
     fqdn_file = open('fqdn.yaml', 'r')
-    fqdn_map = yaml.safe_load(fqdn_file)
+    fqdn_map = clab_yaml.load(fqdn_file)
     fqdn_file.close()
 
     new_file = open('/tmp/new_hosts', 'w')
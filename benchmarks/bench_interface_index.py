@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import timeit
+from types import SimpleNamespace
+
+# clab_gen.py parses the command line when imported, so hide our arguments from it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+bench_argv, sys.argv = sys.argv, sys.argv[:1]
+import clab_gen
+import clab_netbox
+sys.argv = bench_argv
+
+import argparse
+parser = argparse.ArgumentParser(description='Compare LAG / sub-interface lookups on a synthetic chassis')
+parser.add_argument('-p', '--ports', help='Number of physical ports on chassis (default: 1000)', type=int, default=1000)
+parser.add_argument('-n', '--number', help='Times to repeat each pass over the ports (default: 5)', type=int, default=5)
+args = parser.parse_args()
+
+
+def main():
+    """ Builds a virtual chassis with args.ports physical ports, a LAG for every 4 ports and a
+        sub-interface on every LAG, then times finding LAG members and sub-interfaces for every
+        port with the previous linear scans and the per-device indexes from clab_netbox.get_int_indexes(). """
+    nb_device, lags, phys_ints = make_chassis(args.ports)
+    int_indexes = clab_netbox.get_int_indexes(nb_device)
+
+    print(f"{len(phys_ints)} ports, {len(lags)} LAGs, {len(int_indexes['ints'])} interfaces in total, " \
+          f"{args.number} passes:\n")
+
+    results = [
+        ("LAG member - scan", lambda: [scan_lag_member(int_indexes, lag) for lag in lags]),
+        ("LAG member - index", lambda: [clab_gen.get_lag_member(lag) for lag in lags]),
+        ("Sub-interfaces - scan", lambda: [scan_subints(int_indexes, port.name) for port in phys_ints + lags]),
+        ("Sub-interfaces - index", lambda: [int_indexes['subints'].get(port.name) for port in phys_ints + lags])
+    ]
+    for name, func in results:
+        print(f"{name:<24} {timeit.timeit(func, number=args.number):8.4f}s")
+
+
+def scan_lag_member(int_indexes, interface):
+    """ get_lag_member() before the lag_members index """
+    for nb_int in int_indexes['ints'].values():
+        if nb_int.lag is not None and nb_int.lag.name == interface.name:
+            return nb_int
+    return None
+
+
+def scan_subints(int_indexes, int_name):
+    """ Sub-interface check in add_device_interface() before the subints index """
+    return [sub for sub in int_indexes['ints'].keys() if sub.startswith(f"{int_name}.")]
+
+
+def make_chassis(num_ports):
+    """ Returns fake Netbox VC master device with num_ports ports, loaded into the clab_netbox
+        indexes, along with lists of its LAG and physical interfaces """
+    nb_device = SimpleNamespace(id=1, name="asw1-bench", device_role=SimpleNamespace(slug="cloudsw"),
+                                primary_ip4=None, primary_ip6=None)
+    nb_device.virtual_chassis = SimpleNamespace(id=1, name="asw1-bench.example.org", master=nb_device)
+    clab_netbox.devices_by_id[nb_device.id] = nb_device
+    clab_netbox.device_ints[nb_device.id] = {}
+
+    lags, phys_ints = [], []
+    for lag_num in range((num_ports + 3) // 4):
+        lags.append(make_int(nb_device, len(clab_netbox.interfaces_by_id), f"ae{lag_num}", "lag"))
+        make_int(nb_device, len(clab_netbox.interfaces_by_id), f"ae{lag_num}.100", "virtual")
+    for port_num in range(num_ports):
+        member, port = divmod(port_num, 48)
+        phys_ints.append(make_int(nb_device, len(clab_netbox.interfaces_by_id), f"xe-{member}/0/{port}",
+                                  "10gbase-x-sfpp", lag=lags[port_num // 4]))
+
+    return nb_device, lags, phys_ints
+
+
+def make_int(nb_device, int_id, name, int_type, lag=None):
+    interface = SimpleNamespace(id=int_id, name=name, device=nb_device, enabled=True, lag=lag,
+                                type=SimpleNamespace(value=int_type), mode=None)
+    clab_netbox.interfaces_by_id[int_id] = interface
+    clab_netbox.device_ints[nb_device.id][name] = interface
+    return interface
+
+
+if __name__ == "__main__":
+    main()
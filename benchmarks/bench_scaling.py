@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+parser = argparse.ArgumentParser(description='Run the generator against synthetic Netbox data of increasing size')
+parser.add_argument('-n', '--nodes', help='Comma separated lab sizes to run (default: 50,500,5000)', type=str, default="50,500,5000")
+parser.add_argument('-w', '--workers', help='Discovery workers, as clab_gen.py --workers (default: 1)', type=int, default=1)
+parser.add_argument('--latency', help='Milliseconds added to each Netbox API call (default: 0)', type=float, default=0)
+parser.add_argument('-o', '--output', help='File to write JSON results to (default: bench_scaling.json)', type=str,
+                    default="bench_scaling.json")
+parser.add_argument('--single', help=argparse.SUPPRESS, type=int)
+args = parser.parse_args()
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def main():
+    """ Runs each size in its own process, so module state and peak RSS don't carry over """
+    if args.single:
+        print(json.dumps(run_size(args.single)))
+        return
+
+    results = {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'workers': args.workers,
+        'latency_ms': args.latency,
+        'runs': []
+    }
+    for num_nodes in [int(nodes) for nodes in args.nodes.split(",")]:
+        cmd = [sys.executable, os.path.abspath(__file__), "--single", str(num_nodes), "--workers", str(args.workers),
+               "--latency", str(args.latency)]
+        run = json.loads(subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout.splitlines()[-1])
+        results['runs'].append(run)
+        print_run(run)
+
+    with open(args.output, 'w') as json_file:
+        json.dump(results, json_file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def run_size(num_nodes):
+    # clab_gen.py parses the command line when imported, so hide our arguments from it
+    sys.path.insert(0, REPO_DIR)
+    bench_argv, sys.argv = sys.argv, sys.argv[:1]
+    import pynetbox
+    import clab_gen
+    import clab_netbox
+    import clab_repos
+    import clab_snapshot
+    import clab_write
+    import synth_netbox
+    sys.argv = bench_argv
+
+    netbox = synth_netbox.build(num_nodes)
+    nb = pynetbox.api(synth_netbox.BASE_URL, token="bench", threading=True)
+    adapter = synth_netbox.SyntheticNetboxAdapter(netbox, args.latency / 1000)
+    nb.http_session.mount(f"{synth_netbox.BASE_URL}/", adapter)
+
+    clab_gen.nb, clab_gen.nb_backend = nb, clab_netbox
+    clab_gen.args.workers = args.workers
+    clab_gen.args.hosts = ",".join(netbox.host_names())
+    clab_gen.yaml_data = netbox.yaml_data()
+    clab_gen.device_transits = clab_repos.get_device_transits(clab_gen.yaml_data)
+    clab_gen.devices, clab_gen.links = {}, {}
+    clab_gen.use_context(clab_gen.devices, clab_gen.links)
+    clab_gen.add_isp_router()
+
+    out_dir = tempfile.mkdtemp(prefix="bench_scaling.")
+    shutil.copy(os.path.join(REPO_DIR, "dummy_routes.yaml"), out_dir)
+    os.chdir(out_dir)
+
+    stages = {}
+    tracemalloc.start()
+    l3_devices = run_stage(stages, adapter, "prefetch", lambda: clab_netbox.prefetch(nb, ["cr", "cloudsw"], ["active"]))
+    run_stage(stages, adapter, "discovery", lambda: clab_gen.discover_devices(l3_devices))
+    run_stage(stages, adapter, "hosts", clab_gen.add_hosts)
+    run_stage(stages, adapter, "write", lambda: clab_write.write_files(clab_gen.args, clab_gen.devices, clab_gen.links,
+                                                                       clab_gen.yaml_data))
+    run_stage(stages, adapter, "snapshot", lambda: clab_snapshot.save_snapshot(clab_gen.devices, clab_gen.links,
+                                                                               clab_gen.yaml_data, clab_gen.device_transits))
+    tracemalloc.stop()
+
+    output = {file_name: os.path.getsize(os.path.join("output", file_name)) for file_name in sorted(os.listdir("output"))}
+    output[clab_snapshot.SNAPSHOT_FILE] = os.path.getsize(clab_snapshot.SNAPSHOT_FILE)
+    with open(f"output/start_{clab_gen.args.name}.sh", 'r') as start_script:
+        start_lines = len(start_script.readlines())
+    shutil.rmtree(out_dir)
+
+    return {
+        'target_nodes': num_nodes,
+        'nodes': len(clab_gen.devices),
+        'links': len(clab_gen.links),
+        'netbox_objects': netbox.summary(),
+        'stages': stages,
+        'total_seconds': sum(stage['seconds'] for stage in stages.values()),
+        'api_calls': sum(adapter.calls.values()),
+        'api_calls_by_endpoint': dict(sorted(adapter.calls.items())),
+        'output_bytes': output,
+        'start_script_lines': start_lines,
+        # ru_maxrss is in KB on Linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+
+
+def run_stage(stages, adapter, name, func):
+    """ Runs func with its output hidden, recording wall time, peak traced memory and Netbox calls """
+    calls_before = sum(adapter.calls.values())
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        result = func()
+    stages[name] = {
+        'seconds': round(time.perf_counter() - start, 4),
+        'peak_mem_bytes': tracemalloc.get_traced_memory()[1],
+        'api_calls': sum(adapter.calls.values()) - calls_before
+    }
+    return result
+
+
+def print_run(run):
+    print(f"{run['nodes']} nodes, {run['links']} links, {run['api_calls']} API calls, " \
+          f"{run['total_seconds']:.2f}s, peak RSS {run['peak_rss_bytes'] / 2**20:.0f} MB:")
+    for name, stage in run['stages'].items():
+        print(f"    {name:<12} {stage['seconds']:8.3f}s {stage['peak_mem_bytes'] / 2**20:8.1f} MB " \
+              f"{stage['api_calls']:6} calls")
+    print(f"    {'output':<12} {sum(run['output_bytes'].values()) / 1024:8.0f} KB, " \
+          f"start script {run['start_script_lines']} lines\n")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, check=True, capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/python3
+
+import functools
+import ipaddress
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import clab_nbreplay
+import clab_trace
+
+# Synthetic Netbox with WMF-like proportions, served to pynetbox through a requests adapter so
+# the whole generator can be run against it.  Each site has:
+#
+#   2 cr         ae0 LAG between them, loopbacks, an ae per asw with a VRRP sub-interface,
+#                a transit circuit on cr1, a transport circuit from cr2 to the next site's cr1
+#   2 cloudsw    routed link to a cr each
+#   4 asw        LAG trunk to each cr, access ports to servers
+#   servers      SERVERS_PER_ASW on each asw, the first LVS_PER_SITE at each site named lvs*
+#
+# Only the filters clab_netbox.py uses are understood, and results are paginated like Netbox.
+
+NODES_PER_SITE = 10
+ASW_PER_SITE = 4
+LVS_PER_SITE = 2
+SERVERS_PER_ASW = 8
+PROVIDERS = {"zayo": 6461, "telia": 1299, "ntt": 2914}
+
+BASE_URL = "http://netbox.bench"
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+# Endpoint filters we support, mapped to the function giving the value(s) an object is
+# matched on.  Repeated filter values are OR'd, different filters AND'd, like Netbox.
+FILTERS = {
+    "id": lambda obj: [obj['id']],
+    "name": lambda obj: [obj.get('name')],
+    "role": lambda obj: [obj['device_role']['slug']],
+    "status": lambda obj: [obj['status']['value']],
+    "virtual_chassis_id": lambda obj: [(obj.get('virtual_chassis') or {}).get('id')],
+    "group_id": lambda obj: [obj['group']['id']],
+    "interface_id": lambda obj: [obj.get('interface_id', obj.get('assigned_object_id'))],
+}
+
+
+class SyntheticNetbox:
+    def __init__(self):
+        self.objects = {}
+        self.next_id = Counter()
+        self.loopbacks = ipaddress.ip_network("10.0.0.0/14").hosts()
+        self.p2p_v4 = ipaddress.ip_network("10.128.0.0/10").subnets(new_prefix=31)
+        self.p2p_v6 = ipaddress.ip_network("2001:db8:ffff::/48").subnets(new_prefix=127)
+        self.lans_v4 = ipaddress.ip_network("172.16.0.0/12").subnets(new_prefix=24)
+        self.lans_v6 = ipaddress.ip_network("2001:db8::/40").subnets(new_prefix=64)
+        self.transits = {}
+        self.device_indexes = {}
+
+    def add(self, obj_type, data):
+        self.next_id[obj_type] += 1
+        data['id'] = self.next_id[obj_type]
+        data['url'] = f"{BASE_URL}/api/{obj_type.replace('.', '/')}/{data['id']}/"
+        data['display'] = str(data.get('name', data.get('address', data.get('cid', data['id']))))
+        self.objects.setdefault(obj_type, {})[data['id']] = data
+        return data
+
+    def add_device(self, name, role, fqdn=None):
+        device = self.add("dcim.devices", {
+            'name': name,
+            'device_role': {'id': 1, 'url': f"{BASE_URL}/api/dcim/device-roles/1/", 'slug': role, 'name': role},
+            'status': {'value': "active", 'label': "Active"},
+            'virtual_chassis': None,
+            'primary_ip4': None,
+            'primary_ip6': None
+        })
+        if fqdn:
+            lo0 = self.add_interface(device, "lo0", "virtual")
+            loop_ip = self.add_ip(lo0, f"{next(self.loopbacks)}/32", dns_name=fqdn)
+            device['primary_ip4'] = brief(loop_ip, 'address')
+        return device
+
+    def add_interface(self, device, name, int_type, parent=None, lag=None, mode=None, vlans=None):
+        vlans = vlans or []
+        return self.add("dcim.interfaces", {
+            'name': name,
+            'device': brief(device),
+            'type': {'value': int_type, 'label': int_type},
+            'enabled': True,
+            'mgmt_only': False,
+            'description': "",
+            'parent': brief(parent) if parent else None,
+            'lag': brief(lag) if lag else None,
+            'mode': {'value': mode, 'label': mode.title()} if mode else None,
+            'untagged_vlan': make_vlan(vlans[0]) if mode == "access" else None,
+            'tagged_vlans': [make_vlan(vid) for vid in vlans] if mode == "tagged" else [],
+            'link_peer': None,
+            'link_peer_type': None,
+            'connected_endpoint': None,
+            'connected_endpoint_type': None,
+            'count_ipaddresses': 0,
+            'count_fhrp_groups': 0
+        })
+
+    def add_ip(self, interface, address, dns_name=""):
+        if interface:
+            interface['count_ipaddresses'] += 1
+        return self.add("ipam.ip-addresses", {
+            'address': str(address),
+            'dns_name': dns_name,
+            'status': {'value': "active", 'label': "Active"},
+            'assigned_object_type': "dcim.interface" if interface else None,
+            'assigned_object_id': interface['id'] if interface else None,
+            'assigned_object': int_brief(interface) if interface else None
+        })
+
+    def connect(self, int_a, int_b):
+        for local, remote in [(int_a, int_b), (int_b, int_a)]:
+            local['link_peer'], local['link_peer_type'] = int_brief(remote), "dcim.interface"
+            local['connected_endpoint'], local['connected_endpoint_type'] = int_brief(remote), "dcim.interface"
+
+    def add_circuit(self, cid, provider, circuit_type, interfaces):
+        """ Circuit with a termination on each interface.  Where both ends are ours the path
+            traces through, so each interface's connected_endpoint is the far one. """
+        circuit = self.add("circuits.circuits", {
+            'cid': cid,
+            'provider': {'id': 1, 'url': f"{BASE_URL}/api/circuits/providers/1/", 'name': provider, 'slug': provider},
+            'type': {'id': 1, 'url': f"{BASE_URL}/api/circuits/circuit-types/1/", 'slug': circuit_type,
+                     'name': circuit_type}
+        })
+        for term_side, interface in zip("AZ", interfaces):
+            term = self.add("circuits.circuit-terminations", {
+                'circuit': brief(circuit, 'cid'),
+                'term_side': term_side,
+                'link_peer': int_brief(interface),
+                'link_peer_type': "dcim.interface"
+            })
+            interface['link_peer'], interface['link_peer_type'] = brief(term, 'display'), "circuits.circuittermination"
+        if len(interfaces) == 2:
+            for local, remote in [interfaces, interfaces[::-1]]:
+                local['connected_endpoint'], local['connected_endpoint_type'] = int_brief(remote), "dcim.interface"
+
+    def add_lag(self, device, name, members, mode=None, vlans=None):
+        lag = self.add_interface(device, name, "lag", mode=mode, vlans=vlans)
+        member_ints = [self.add_interface(device, member, "10gbase-x-sfpp", lag=lag) for member in members]
+        return lag, member_ints
+
+    def add_p2p(self, int_a, int_b):
+        """ Numbers a point-to-point link with a v4 /31 and v6 /127 """
+        for network in [next(self.p2p_v4), next(self.p2p_v6)]:
+            for interface, address in zip([int_a, int_b], network):
+                self.add_ip(interface, f"{address}/{network.prefixlen}")
+
+    def add_vrrp(self, interfaces, addresses):
+        group = self.add("ipam.fhrp-groups", {'protocol': "vrrp3", 'group_id': 1, 'ip_addresses': []})
+        for address in addresses:
+            vip = self.add_ip(None, f"{address}/{address.max_prefixlen}")
+            group['ip_addresses'].append(brief(vip, 'address'))
+        for interface in interfaces:
+            interface['count_fhrp_groups'] += 1
+            self.add("ipam.fhrp-group-assignments", {
+                'group': brief(group, 'display'),
+                'interface_type': "dcim.interface",
+                'interface_id': interface['id'],
+                'interface': int_brief(interface),
+                'priority': 100
+            })
+
+    def add_site(self, site_num):
+        site = f"s{site_num:03d}"
+        crs = [self.add_device(f"cr{num}-{site}", "cr", f"cr{num}-{site}.wikimedia.org") for num in [1, 2]]
+        cr_ae0 = [self.add_lag(cr, "ae0", ["xe-0/0/0", "xe-0/0/1"]) for cr in crs]
+        for member_a, member_b in zip(cr_ae0[0][1], cr_ae0[1][1]):
+            self.connect(member_a, member_b)
+        self.add_p2p(cr_ae0[0][0], cr_ae0[1][0])
+
+        for num, cr in enumerate(crs, 1):
+            cloudsw = self.add_device(f"cloudsw{num}-{site}", "cloudsw", f"cloudsw{num}-{site}.mgmt.wikimedia.org")
+            cr_int = self.add_interface(cr, "et-0/0/2", "100gbase-x-qsfp28")
+            sw_int = self.add_interface(cloudsw, "et-0/0/0", "100gbase-x-qsfp28")
+            self.connect(cr_int, sw_int)
+            self.add_p2p(cr_int, sw_int)
+
+        server_num = 0
+        for asw_num in range(1, ASW_PER_SITE + 1):
+            vid = 1000 + asw_num
+            lan_v4, lan_v6 = next(self.lans_v4), next(self.lans_v6)
+            asw = self.add_device(f"asw{asw_num}-{site}", "asw", f"asw{asw_num}-{site}.mgmt.wikimedia.org")
+            vrrp_ints = []
+            for cr_num, cr in enumerate(crs):
+                members = [f"et-0/0/{48 + cr_num * 2}", f"et-0/0/{49 + cr_num * 2}"]
+                asw_lag, asw_members = self.add_lag(asw, f"ae{cr_num + 1}", members, mode="tagged", vlans=[vid])
+                cr_lag, cr_members = self.add_lag(cr, f"ae{asw_num}", [f"xe-1/0/{asw_num * 2}", f"xe-1/0/{asw_num * 2 + 1}"])
+                for member_a, member_b in zip(cr_members, asw_members):
+                    self.connect(member_a, member_b)
+                subint = self.add_interface(cr, f"ae{asw_num}.{vid}", "virtual", parent=cr_lag)
+                for lan in [lan_v4, lan_v6]:
+                    self.add_ip(subint, f"{lan[2 + cr_num]}/{lan.prefixlen}")
+                vrrp_ints.append(subint)
+            self.add_vrrp(vrrp_ints, [lan_v4[1], lan_v6[1]])
+
+            for port in range(SERVERS_PER_ASW):
+                server_name = f"lvs{site_num}{server_num:02d}" if server_num < LVS_PER_SITE else f"mw{site_num}{server_num:02d}"
+                server = self.add_device(server_name, "server")
+                server_int = self.add_interface(server, "eth0", "10gbase-x-sfpp")
+                sw_port = self.add_interface(asw, f"ge-0/0/{port}", "1000base-t", mode="access", vlans=[vid])
+                self.connect(server_int, sw_port)
+                self.add_ip(server_int, f"{lan_v4[10 + server_num]}/{lan_v4.prefixlen}")
+                self.add_ip(server_int, f"{lan_v6[10 + server_num]}/{lan_v6.prefixlen}")
+                server_num += 1
+
+        # Transit on cr1
+        provider = list(PROVIDERS)[site_num % len(PROVIDERS)]
+        transit_int = self.add_interface(crs[0], "xe-0/1/0", "10gbase-x-sfpp")
+        self.add_circuit(f"TR-{site}", provider, "transit", [transit_int])
+        transit_net = next(self.p2p_v4)
+        self.add_ip(transit_int, f"{transit_net[0]}/31")
+        self.transits[f"cr1-{site}.wikimedia.org"] = {str(transit_net[1]): {'provider': provider}}
+
+        # Transport to next site, numbered when that site's cr1 has been created
+        if site_num > 0:
+            prev_cr2 = self.find("dcim.devices", f"cr2-s{site_num - 1:03d}")
+            self.add_transport(prev_cr2, crs[0], f"TP-{site_num - 1:03d}-{site_num:03d}")
+
+    def add_transport(self, device_a, device_b, cid):
+        int_a = self.add_interface(device_a, "xe-0/1/1", "10gbase-x-sfpp")
+        int_b = self.add_interface(device_b, "xe-0/1/2", "10gbase-x-sfpp")
+        self.add_circuit(cid, "zayo", "transport", [int_a, int_b])
+        self.add_p2p(int_a, int_b)
+
+    def find(self, obj_type, name):
+        for obj in self.objects[obj_type].values():
+            if obj.get('name') == name:
+                return obj
+
+    def filter(self, obj_type, params):
+        """ Returns objects of obj_type matching filter params.  Objects are looked up by id /
+            device where the filter allows, so the emulated server adds little to timings. """
+        params = {field: values for field, values in params.items() if field not in ["limit", "offset", "brief"]}
+        if "id" in params:
+            candidates = [self.objects[obj_type][int(obj_id)] for obj_id in params.pop("id")
+                          if int(obj_id) in self.objects.get(obj_type, {})]
+            candidates.sort(key=lambda obj: obj['id'])
+        elif "device_id" in params:
+            by_device = self.device_index(obj_type)
+            candidates = sorted((obj for device_id in params.pop("device_id") for obj in by_device.get(int(device_id), [])),
+                                key=lambda obj: obj['id'])
+        else:
+            candidates = self.objects.get(obj_type, {}).values()
+
+        if "parent" in params:
+            networks = {}
+            for network in map(ipaddress.ip_network, params.pop("parent")):
+                networks.setdefault((network.version, network.prefixlen), set()).add(int(network.network_address))
+            candidates = [obj for obj in candidates if in_networks(obj['address'], networks)]
+
+        return [obj for obj in candidates
+                if all(any(str(value) in values for value in FILTERS[field](obj)) for field, values in params.items())]
+
+    def device_index(self, obj_type):
+        """ Objects of obj_type by the id of the device they're on, built on first use """
+        if obj_type not in self.device_indexes:
+            self.device_indexes[obj_type] = {}
+            for obj in self.objects.get(obj_type, {}).values():
+                if obj_type == "ipam.ip-addresses":
+                    if not obj['assigned_object']:
+                        continue
+                    device_id = obj['assigned_object']['device']['id']
+                else:
+                    device_id = obj['device']['id']
+                self.device_indexes[obj_type].setdefault(device_id, []).append(obj)
+        return self.device_indexes[obj_type]
+
+    def yaml_data(self):
+        """ Minimal homer data for the synthetic devices, as clab_repos.prep_homer_repo() returns """
+        return {
+            'devices': {fqdn: {'config': {'transits': transits}} for fqdn, transits in self.transits.items()},
+            'common': {'transit_providers': {provider: {'AS': asn} for provider, asn in PROVIDERS.items()}}
+        }
+
+    def host_names(self):
+        return [device['name'] for device in self.objects["dcim.devices"].values() if device['name'].startswith("lvs")]
+
+    def summary(self):
+        return {obj_type: len(type_objects) for obj_type, type_objects in sorted(self.objects.items())}
+
+
+class SyntheticNetboxAdapter(HTTPAdapter):
+    """ Answers pynetbox REST requests from a SyntheticNetbox, counting calls per endpoint """
+    def __init__(self, netbox, latency=0):
+        super().__init__()
+        self.netbox = netbox
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            self.calls[clab_trace.endpoint_name(request.url)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlsplit(request.url)
+        path = url.path.strip("/").split("/")[1:]
+        params = parse_qs(url.query)
+        if len(path) < 2:
+            content = {}
+        elif len(path) == 3:
+            content = self.netbox.objects.get(".".join(path[:2]), {}).get(int(path[2]))
+        else:
+            content = self.page(request.url, ".".join(path), params)
+
+        return clab_nbreplay.build_response(request, {
+            'status': 200 if content is not None else 404,
+            'content_type': "application/json",
+            'content': json.dumps(content if content is not None else {"detail": "Not found."})
+        })
+
+    def page(self, url, obj_type, params):
+        results = self.netbox.filter(obj_type, params)
+        limit = min(int(params.get('limit', [PAGE_SIZE])[0]) or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+        offset = int(params.get('offset', [0])[0])
+        next_url = None
+        if offset + limit < len(results):
+            next_params = dict(params, limit=[limit], offset=[offset + limit])
+            next_url = f"{url.split('?')[0]}?{urlencode(next_params, doseq=True)}"
+        return {'count': len(results), 'next': next_url, 'previous': None, 'results': results[offset:offset + limit]}
+
+
+def build(num_nodes):
+    """ Returns SyntheticNetbox whose lab topology has about num_nodes nodes """
+    netbox = SyntheticNetbox()
+    num_sites = max(1, round(num_nodes / NODES_PER_SITE))
+    for site_num in range(num_sites):
+        netbox.add_site(site_num)
+    return netbox
+
+
+@functools.lru_cache(maxsize=None)
+def parse_ip(address):
+    ip = ipaddress.ip_interface(address).ip
+    return ip.version, int(ip), ip.max_prefixlen
+
+
+def in_networks(address, networks):
+    """ True if address is in any of networks, given as {(version, prefixlen): {network ints}} """
+    ip_version, ip_int, max_prefixlen = parse_ip(address)
+    for (version, prefixlen), network_ints in networks.items():
+        if ip_version == version and ip_int >> (max_prefixlen - prefixlen) << (max_prefixlen - prefixlen) in network_ints:
+            return True
+    return False
+
+
+def brief(obj, name_field='name'):
+    return {'id': obj['id'], 'url': obj['url'], 'display': obj['display'], name_field: obj[name_field]}
+
+
+def int_brief(interface):
+    return dict(brief(interface), device=interface['device'])
+
+
+def make_vlan(vid):
+    return {'id': vid, 'url': f"{BASE_URL}/api/ipam/vlans/{vid}/", 'vid': vid, 'name': f"vlan{vid}"}
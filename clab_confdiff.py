@@ -0,0 +1,137 @@
+import json
+
+# Works out the smallest JunOS JSON config that turns a device's current config into the desired
+# one, so pushes load and commit just what changed rather than the whole config with overwrite.
+# Both configs are as returned by get_config(options={'format': 'json'}), minus the top-level
+# '@' attributes.  The patch is for loading with PyEZ's default 'replace' action, which merges
+# it into the candidate config while honouring the operations set on its stanzas:
+#
+#   - named list elements (i.e. BGP groups, OSPF interfaces) are matched by name, those only in
+#     current get '"@": {"operation": "delete"}', new ones are added whole
+#   - containers only in current get '"@": {"operation": "delete"}', leaves (including empty
+#     ones like 'no-readvertise', which are '[null]') the same on '"@<leaf>"', and changed
+#     leaves are just set to the new value
+#   - 'inactive' added / removed on a stanza is set with '"@": {"inactive": true}' or
+#     '"@": {"active": true}'
+#
+# Anything a merge can't express exactly, like changed leaf-lists, lists re-ordered or added to
+# other than at the end, or changed attributes besides 'inactive', replaces the enclosing stanza
+# with '"@": {"operation": "replace"}' instead.
+
+# Returned by diff_object() when the stanza must be replaced as a whole
+REPLACE = object()
+
+
+def load_changes(junos_dev, current, desired):
+    """ Loads the difference between current and desired config into the candidate config of
+        PyEZ device junos_dev, falling back to loading desired with overwrite if they differ at
+        the top level.  Returns the size of the config loaded in bytes, 0 if there's no
+        difference. """
+    patch = diff_object(current['configuration'], desired['configuration'])
+    if patch is None:
+        return 0
+    if patch is REPLACE:
+        content = json.dumps(desired)
+        junos_dev.config.load(content, format="json", overwrite=True)
+    else:
+        content = json.dumps({'configuration': patch})
+        junos_dev.config.load(content, format="json")
+    return len(content)
+
+
+def diff_object(current, desired):
+    """ Returns patch for a config stanza (JSON object), None if unchanged or REPLACE if it
+        must be replaced """
+    patch = {}
+
+    current_attrs, desired_attrs = current.get('@', {}), desired.get('@', {})
+    if current_attrs != desired_attrs:
+        if without_inactive(current_attrs) != without_inactive(desired_attrs):
+            return REPLACE
+        patch['@'] = {'inactive': True} if desired_attrs.get('inactive') else {'active': True}
+
+    for key, current_value in current.items():
+        if key.startswith('@'):
+            if key != '@' and current_value != desired.get(key):
+                return REPLACE
+            continue
+        if key not in desired:
+            if isinstance(current_value, dict):
+                patch[key] = {'@': {'operation': "delete"}}
+            elif current_value and is_named_list(current_value):
+                patch[key] = diff_named_list(current_value, [])
+            elif isinstance(current_value, list) and not is_empty_leaf(current_value):
+                return REPLACE
+            else:
+                patch[key] = current_value
+                patch[f"@{key}"] = {'operation': "delete"}
+
+    for key, desired_value in desired.items():
+        if key.startswith('@'):
+            if key != '@' and key not in current:
+                return REPLACE
+            continue
+        if key not in current:
+            patch[key] = desired_value
+            continue
+        current_value = current[key]
+        if current_value == desired_value:
+            continue
+        if isinstance(current_value, dict) and isinstance(desired_value, dict):
+            value_patch = diff_object(current_value, desired_value)
+            if value_patch is REPLACE:
+                value_patch = replace_stanza(desired_value)
+        elif is_named_list(current_value) and is_named_list(desired_value):
+            value_patch = diff_named_list(current_value, desired_value)
+            if value_patch is REPLACE:
+                return REPLACE
+        elif isinstance(current_value, (dict, list)) or isinstance(desired_value, (dict, list)):
+            return REPLACE
+        else:
+            value_patch = desired_value
+        if value_patch is not None:
+            patch[key] = value_patch
+
+    return patch or None
+
+
+def diff_named_list(current, desired):
+    """ Returns patch for a list of named stanzas, None if unchanged or REPLACE if the order of
+        the list has changed """
+    current_by_name = {element['name']: element for element in current}
+    desired_names = [element['name'] for element in desired]
+    kept_names = [name for name in desired_names if name in current_by_name]
+    # Elements are added at the end, so the existing ones must be first and in the same order
+    if kept_names != desired_names[:len(kept_names)] or \
+       kept_names != [element['name'] for element in current if element['name'] in kept_names]:
+        return REPLACE
+
+    patch = [{'name': element['name'], '@': {'operation': "delete"}}
+             for element in current if element['name'] not in desired_names]
+    for element in desired:
+        if element['name'] not in current_by_name:
+            patch.append(element)
+            continue
+        element_patch = diff_object(current_by_name[element['name']], element)
+        if element_patch is REPLACE:
+            patch.append(replace_stanza(element))
+        elif element_patch is not None:
+            patch.append({'name': element['name'], **element_patch})
+
+    return patch or None
+
+
+def replace_stanza(desired):
+    return {**desired, '@': {**desired.get('@', {}), 'operation': "replace"}}
+
+
+def without_inactive(attrs):
+    return {key: value for key, value in attrs.items() if key != 'inactive'}
+
+
+def is_empty_leaf(value):
+    return value == [None]
+
+
+def is_named_list(value):
+    return isinstance(value, list) and all(isinstance(element, dict) and 'name' in element for element in value)
@@ -8,9 +8,10 @@ import os
 from pathlib import Path
 import sys
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pprintpp import pprint as pp
 
-import pickle
 
 import urllib3
 urllib3.disable_warnings()
@@ -21,79 +22,139 @@ parser.add_argument('-k', '--key', help='Netbox API Token / Key', type=str)
 parser.add_argument('--name', help='Name for clab project, file names based on this.', default='wmf-clab')
 parser.add_argument('-l', '--license', help='License file name for crpd if available', type=str)
 parser.add_argument('--hosts', help='Comma separated list of hosts to add to the topology', type=str, default="")
-parser.add_argument('--load-pickle', help='Comma separated list of hosts to add to the topology', action='store_true')
+parser.add_argument('--load-snapshot', '--load-pickle', help='Write output from the saved topology snapshot instead of querying Netbox', action='store_true')
 parser.add_argument('--roles', help='Comma separate list of roles to pull (default: cr,clousw)', type=str, default="cr,cloudsw")
 parser.add_argument('--statuses', help='Comma separate list of device status to pull (default: active)', type=str, default="active")
+parser.add_argument('--workers', help='Number of devices to discover concurrently (default: 1)', type=int, default=1)
+parser.add_argument('--nb-cache', help='Directory to cache Netbox REST data in, only changes since last run are fetched', type=str)
+nb_replay_group = parser.add_mutually_exclusive_group()
+nb_replay_group.add_argument('--nb-record', help='Save every Netbox API response to this directory for later --nb-replay', type=str)
+nb_replay_group.add_argument('--nb-replay', help='Serve Netbox API responses recorded with --nb-record instead of contacting Netbox', type=str)
+parser.add_argument('--nb-latency', help='Milliseconds to delay each replayed Netbox response by (default: 0)', type=float, default=0)
+parser.add_argument('--debug', help='Pretty-print the discovered devices and links', action='store_true')
+parser.add_argument('--trace', help='Print time taken by each phase and save a Chrome trace-event JSON file here', type=str)
+parser.add_argument('--homer-mirror', help='Directory to keep mirrors of the homer repos in (default: homer_mirror)', type=str, default="homer_mirror")
+parser.add_argument('--homer-source', help='URL or local directory the homer repos are mirrored from (default: https://github.com/wikimedia)', type=str, default="https://github.com/wikimedia")
+parser.add_argument('-j', '--jobs', help='Number of nodes the start script configures in parallel (default: 4)', type=int, default=4)
+parser.add_argument('--provisioner', help='How the start script configures node interfaces (default: shell)', choices=['shell', 'pyroute2'], default="shell")
+parser.add_argument('--redeploy', help='Also write redeploy script, to change the running lab to match the new topology', action='store_true')
+parser.add_argument('--backend', help='Netbox API to discover devices with (default: rest)', choices=['rest', 'graphql'], default="rest")
 # TODO: add 'sites' option to select only get initial devices from given site
 args = parser.parse_args()
 
 import clab_repos
 import clab_write
+import clab_netbox
+import clab_graphql
+import clab_nbcache
+import clab_model
+import clab_snapshot
+import clab_nbreplay
+import clab_trace
+import clab_redeploy
+
+# Discovery functions add to the devices / links in the current thread's context.  Workers
+# each get their own, which are merged into the global ones in device order.
+ctx = threading.local()
+# Future for the homer repo prep, which runs alongside Netbox discovery
+homer_prep = None
 
 def main():
-    global nb, devices, links, yaml_data, device_transits
-    if args.load_pickle:
+    global nb, nb_backend, devices, links, yaml_data, device_transits, homer_prep
+    if args.load_snapshot:
         # Load the data from dumped file - use when working on clab topo generation
-        devices, links, yaml_data, device_transits = load_pickle()
+        with clab_trace.phase("load snapshot"):
+            devices, links, yaml_data, device_transits = clab_snapshot.load_snapshot()
     else:
         # Create data structures from netbox etc.
         nb = nb_connect()
-        yaml_data = clab_repos.prep_homer_repo()
-        device_transits = clab_repos.get_device_transits(yaml_data)
-        devices, links = {}, {}
-        add_isp_router()
-        get_nb_info()
-        add_hosts()
-        save_pickle()
-
-    pp(devices)
-    print()
-    pp(links)
+        if args.trace:
+            clab_trace.trace_http_session(nb.http_session)
+        if args.nb_record or args.nb_replay:
+            clab_nbreplay.attach(nb, args.nb_replay or args.nb_record, bool(args.nb_replay), args.nb_latency)
+        nb_backend = clab_graphql if args.backend == "graphql" else clab_netbox
+        if args.nb_cache:
+            with clab_trace.phase("netbox cache refresh"):
+                clab_nbcache.open_cache(nb, args.nb_cache)
+        clab_repos.mirror_dir = Path(args.homer_mirror)
+        clab_repos.homer_source = args.homer_source
+        # Only the l3_switch check for asw devices and transit peerings use the homer data, so
+        # the repo is prepared in the background and those wait for it if it's not ready yet
+        with ThreadPoolExecutor(max_workers=1) as homer_executor:
+            homer_prep = homer_executor.submit(prep_homer_data)
+            devices, links = {}, {}
+            use_context(devices, links)
+            add_isp_router()
+            try:
+                get_nb_info()
+                with clab_trace.phase("netbox hosts"):
+                    add_hosts()
+            except clab_graphql.GraphQLError as err:
+                print(f"GraphQL query failed: {err}")
+                sys.exit(1)
+            wait_homer_data()
+        with clab_trace.phase("save snapshot"):
+            clab_nbcache.save_cache()
+            clab_nbreplay.save_calls()
+            clab_snapshot.save_snapshot(devices, links, yaml_data, device_transits)
+
+    if args.debug:
+        pp(devices)
+        print()
+        pp(links)
+    else:
+        print(f"Topology has {len(devices)} devices and {len(links)} links.")
 
     # Write ContainerLab format output topology 
-    clab_write.write_files(args, devices, links, yaml_data)
+    with clab_trace.phase("write files"):
+        clab_write.write_files(args, devices, links, yaml_data)
+        if args.redeploy:
+            clab_redeploy.write_redeploy_script(args, devices, links)
 
+    if args.trace:
+        clab_trace.print_summary()
+        clab_trace.save_trace(args.trace)
 
-def save_pickle():
-    pickle_vars = {
-        "devices": devices,
-        "links": links,
-        "yaml_data": yaml_data,
-        "device_transits": device_transits
-    }
 
-    with open('pickle_vars.data', 'wb') as dump_file:
-        pickle.dump(pickle_vars, dump_file)
+def prep_homer_data():
+    with clab_trace.phase("homer repo prep"):
+        homer_yaml = clab_repos.prep_homer_repo()
+    return homer_yaml, clab_repos.get_device_transits(homer_yaml)
 
-def load_pickle():
-    with open('pickle_vars.data', 'rb') as dump_file:
-        pickle_vars = pickle.load(dump_file)
 
-    return pickle_vars['devices'], pickle_vars['links'], pickle_vars['yaml_data'], pickle_vars['device_transits']
-    
+def wait_homer_data():
+    """ Sets yaml_data / device_transits from the homer repo prep, waiting for it to finish if
+        needed.  Does nothing if they were set some other way. """
+    global yaml_data, device_transits
+    if homer_prep is not None:
+        if not homer_prep.done():
+            with clab_trace.phase("homer repo wait"):
+                homer_prep.result()
+        yaml_data, device_transits = homer_prep.result()
+
 
 def add_hosts():
     # TODO: Make the input a series of comma-seperated globs so we can go lvs*
     if args.hosts:
-        nb_hosts = nb.dcim.devices.filter(name=args.hosts.split(","))
+        nb_hosts = nb_backend.get_devices_by_name(args.hosts.split(","))
         for nb_host in nb_hosts:
             add_host(nb_host)
 
 
 def add_host(nb_host):
-    nb_ints = nb.dcim.interfaces.filter(device_id=nb_host.id, enabled="true")
+    nb_ints = clab_netbox.get_device_ints(nb_host)
     for nb_int in nb_ints:
         far_side_int, far_side_dev = get_far_side_dev(nb_int, nb_host)
         if far_side_int is not None and far_side_int.enabled:
             sw_name = get_device_name(far_side_dev)
-            if sw_name in devices:
-                int_addrs = list(nb.ipam.ip_addresses.filter(interface_id=nb_int.id))
+            if sw_name in ctx.devices:
+                int_addrs = clab_netbox.get_int_addrs(nb_int.id)
                 add_device_interface(nb_host.name, nb_int.name, int_addrs, nb_int.description, nb_host)
                 add_device_interface(sw_name, far_side_int.name, [], far_side_int.description, far_side_dev)
                 add_ordered_link(nb_host.name, nb_int, sw_name, far_side_int)
 
         if nb_int.parent:
-            int_addrs = list(nb.ipam.ip_addresses.filter(interface_id=nb_int.id))
+            int_addrs = [clab_model.make_address(addr) for addr in clab_netbox.get_int_addrs(nb_int.id)]
             add_subint(nb_host, nb_int, int_addrs)    
 
         # Add bridges
@@ -106,24 +167,72 @@ def get_nb_info():
     print()
     roles = [role.strip() for role in args.roles.split(",")]
     statuses = [status.strip() for status in args.statuses.split(",")]
-    l3_devices = nb.dcim.devices.filter(role=roles, status=statuses)
-    for nb_device in l3_devices:
-        print(f"Gathering Netbox data for {nb_device.name}...")
-        add_device(nb_device)
-        
-        # Iterate over device nb_ints and process each
-        for interface in devices[nb_device.name]['nb_ints'].values():
-            if not interface.mgmt_only and not interface.lag:
-                if interface.count_ipaddresses:
-                    add_l3_int(nb_device, interface)
-                else:
-                    add_l2_int(nb_device, interface)
-            
+    with clab_trace.phase("netbox prefetch"):
+        l3_devices = nb_backend.prefetch(nb, roles, statuses)
+    with clab_trace.phase("netbox discovery"):
+        discover_devices(l3_devices)
+
+
+def discover_devices(l3_devices):
+    """ Walks each prefetched device, args.workers at a time """
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        # map() returns results in the order of l3_devices, regardless of which finishes first
+        for found_devices, found_links, transits in executor.map(discover_device, l3_devices):
+            merge_discovery(found_devices, found_links, transits)
+
+
+def discover_device(nb_device):
+    """ Gathers data for a single device into a new context, so it can run in a worker thread
+        without touching the shared devices / links. """
+    use_context({}, {}, {})
+    print(f"Gathering Netbox data for {nb_device.name}...")
+    add_device(nb_device)
+
+    # Iterate over device nb_ints and process each
+    for interface in clab_netbox.get_int_indexes(nb_device)['ints'].values():
+        if not interface.mgmt_only and not interface.lag:
+            if interface.count_ipaddresses:
+                add_l3_int(nb_device, interface)
+            else:
+                add_l2_int(nb_device, interface)
+
+    return ctx.devices, ctx.links, ctx.transits
+
+
+def merge_discovery(found_devices, found_links, transits):
+    """ Merges what discover_device() found into the global devices / links.  Interfaces already
+        present are kept, as they would be if the device had been walked after those already
+        merged, so output is identical however many workers are used. """
+    for device_name, device_vars in found_devices.items():
+        if device_name not in devices:
+            devices[device_name] = device_vars
+            continue
+        for int_name, int_vars in device_vars.phys_ints.items():
+            devices[device_name].phys_ints.setdefault(int_name, int_vars)
+        devices[device_name].subints.update(device_vars.subints)
+        devices[device_name].irb_ints.update(device_vars.irb_ints)
+        if device_vars.loop_addrs:
+            devices[device_name].loop_addrs = device_vars.loop_addrs
+
+    for link_id, link_vars in found_links.items():
+        if link_id in transits:
+            add_isp_peering(*transits[link_id])
+        else:
+            links[link_id] = link_vars
+
+
+def use_context(device_data, link_data, transits=None):
+    ctx.devices = device_data
+    ctx.links = link_data
+    ctx.transits = transits
 
 def nb_connect():
     nb_url = "https://{}".format(args.netbox)
     if args.key:
         nb_key = args.key
+    elif args.nb_replay:
+        # Token isn't recorded, and isn't needed to replay
+        nb_key = "replay"
     else:
         from getpass import getpass
         nb_key = getpass(prompt="Netbox API Key: ")
@@ -143,29 +252,24 @@ def get_device_name(nb_device):
 
 def add_isp_router():
     """ Generic crpd device we always add.  Used to simulate upstream transit providers """
-    devices['isp_router'] = {}
-    devices['isp_router']['kind'] = "crpd"
-    devices['isp_router']['phys_ints'] = {}
-    devices['isp_router']['subints'] = {}
-    devices['isp_router']['sub_type'] = "isp_router"
-    devices['isp_router']['bgp_groups'] = {}
+    devices['isp_router'] = clab_model.make_device('isp_router', "crpd", "isp_router")
 
 
 def add_l3_int(nb_device, interface):
     """ Routed interface (i.e. has IPs on it) """
     int_addrs = []
-    for int_addr in nb.ipam.ip_addresses.filter(interface_id=interface.id):
-        int_addrs.append(ipaddress.ip_interface(int_addr.address))
+    for int_addr in clab_netbox.get_int_addrs(interface.id):
+        int_addrs.append(clab_model.make_address(int_addr.address))
 
     if interface.count_fhrp_groups > 0:
         int_addrs = get_vrrp_ips(nb_device, interface, int_addrs) + int_addrs
 
     if interface.type.value == "virtual" and interface.name.startswith("lo"):
-        devices[get_device_name(nb_device)]['loop_addrs'] = int_addrs
+        ctx.devices[get_device_name(nb_device)].loop_addrs = int_addrs
         return
     
     if interface.name.startswith("irb."):
-        devices[get_device_name(nb_device)]['irb_ints'][interface.name] = int_addrs
+        ctx.devices[get_device_name(nb_device)].irb_ints[interface.name] = int_addrs
         return
 
     if interface.name.startswith("gr-"):
@@ -187,35 +291,35 @@ def get_vrrp_ips(nb_device, interface, int_ips):
     """ Returns list with any VRRP IPs that should be added to the address list for this int.
         VRRP is supported in cRPD 23 on, but for now we just assign VIP to one device """
     vrrp_ips = []
-    for fhrp_assignment in nb.ipam.fhrp_group_assignments.filter(interface_id=interface.id):
-        assignments = nb.ipam.fhrp_group_assignments.filter(group_id=fhrp_assignment.group.id)
-        group_members = sorted([assignment.interface.device.name for assignment in assignments])
+    for fhrp_assignment in clab_netbox.get_fhrp_assignments(interface.id):
+        group_members = sorted(clab_netbox.fhrp_members[fhrp_assignment.group.id])
         # Only add VIPs on first member device
         if nb_device.name == group_members[0]:
-            for nb_vip in fhrp_assignment.group.ip_addresses:
+            for nb_vip in clab_netbox.fhrp_groups[fhrp_assignment.group.id].ip_addresses:
                 vip_addr = ipaddress.ip_interface(nb_vip.address)
                 # VIPs are /32s in Netbox for some weird reason, we need to change mask
                 for int_ip in int_ips:
                     if vip_addr.ip in int_ip.network:
-                        vrrp_ips.append(ipaddress.ip_interface(f"{vip_addr.ip}/{int_ip.network.prefixlen}"))
+                        vrrp_ips.append(clab_model.make_address(f"{vip_addr.ip}/{int_ip.prefixlen}"))
 
     return vrrp_ips
 
 
 def add_subint(nb_device, interface, int_addrs):
-    parent_int = interface.parent
+    parent_int = clab_netbox.get_interface(interface.parent.id)
     far_side_int, far_side_dev = get_far_side_dev(parent_int, nb_device)
     if far_side_dev:
         if interface.untagged_vlan:
             vlan_id = interface.untagged_vlan.vid
         else:
             vlan_id = interface.name.split(".")[-1]
-        devices[get_device_name(nb_device)]['subints'][interface.name] = {
-            "clab_dev": parent_int.name.replace('/', '_').replace(':', '_'),
-            "subint_dev": interface.name.replace('/', '_').replace(':', '_'),
-            "vlan_id": vlan_id,
-            "addrs": int_addrs,
-        }
+            if not vlan_id.isdigit():
+                print(f"Skipping {nb_device.name} {interface.name}, it has no untagged VLAN and unit isn't a VLAN ID.")
+                return
+            vlan_id = int(vlan_id)
+        ctx.devices[get_device_name(nb_device)].subints[interface.name] = clab_model.SubInterface(
+            interface.name, clab_model.clab_dev_name(parent_int.name), clab_model.clab_dev_name(interface.name),
+            vlan_id, int_addrs)
 
     else:
         # No far side device - mostly VPLS WAN, add as generic link
@@ -253,19 +357,20 @@ def get_circuit(interface):
         interface = get_lag_member(interface)
 
     if interface.link_peer_type == "circuits.circuittermination":
-        return interface.link_peer.circuit
+        return clab_netbox.get_termination_circuit(interface.link_peer.id)
     if interface.link_peer_type == "dcim.frontport":
-        if interface.link_peer.rear_port.link_peer_type == "circuits.circuittermination":
-            return interface.link_peer.rear_port.link_peer.circuit
+        rear_port = clab_netbox.get_front_port_rear(interface.link_peer.id)
+        if rear_port.link_peer_type == "circuits.circuittermination":
+            return clab_netbox.get_termination_circuit(rear_port.link_peer.id)
 
     return None
 
 
 def get_lag_member(interface):
     """ Returns a member physical interface belonging to a LAG so we can find other side """
-    for nb_int in devices[get_device_name(interface.device)]['nb_ints'].values():
-        if nb_int.lag is not None and nb_int.lag.name == interface.name:
-            return nb_int
+    lag_members = clab_netbox.get_int_indexes(clab_netbox.get_device(interface.device.id))['lag_members']
+    if interface.name in lag_members:
+        return lag_members[interface.name][0]
     return None
 
 
@@ -278,22 +383,35 @@ def add_transit_circuit(nb_device, interface, int_addrs, circuit):
     descr = f"{circuit.provider} Transit CCT {circuit.cid}"
     add_device_interface(get_device_name(nb_device), interface.name, int_addrs, descr, nb_device)
 
+    if ctx.transits is not None:
+        # isp_router interfaces are numbered in order, so in a worker we hold the link's place
+        # and add the isp_router side when the results are merged.
+        link_id = ("transit", get_device_name(nb_device), interface.name)
+        ctx.links[link_id] = None
+        ctx.transits[link_id] = (nb_device, interface, int_addrs)
+    else:
+        add_isp_peering(nb_device, interface, int_addrs)
+
+
+def add_isp_peering(nb_device, interface, int_addrs):
+    """ Adds 'isp_router' side of a transit circuit and the link to it """
     # Add 'isp_router' interface and record WMF peer IP + required ASN
     isp_rtr_int = get_next_eth_int(devices['isp_router'])
     descr = f"Peering to {nb_device.name} {interface.name}"
     isp_rtr_addrs = []
+    wait_homer_data()
     for nb_ip in int_addrs:
-        wmf_ip = ipaddress.ip_interface(str(nb_ip))
+        wmf_ip = nb_ip.interface
         for peer_ip in device_transits[get_device_name(nb_device)].keys():
             if peer_ip in wmf_ip.network:
                 isp_rtr_addrs.append(f"{peer_ip}/{wmf_ip.network.prefixlen}")
                 local_as = device_transits[get_device_name(nb_device)][peer_ip]['AS']
-                if local_as not in devices['isp_router']['bgp_groups']:
-                    devices['isp_router']['bgp_groups'][local_as] = {
+                if local_as not in devices['isp_router'].bgp_groups:
+                    devices['isp_router'].bgp_groups[local_as] = {
                         'provider': device_transits[get_device_name(nb_device)][peer_ip]['provider'],
                         'wmf_peers': []
                 }
-                devices['isp_router']['bgp_groups'][local_as]['wmf_peers'].append(str(wmf_ip.ip))
+                devices['isp_router'].bgp_groups[local_as]['wmf_peers'].append(str(wmf_ip.ip))
                 break
     add_device_interface('isp_router', isp_rtr_int, isp_rtr_addrs, descr)
 
@@ -307,12 +425,13 @@ def add_generic_transport(nb_device, interface, int_addrs):
     far_side_int = get_far_side_from_addr(interface, int_addrs)
 
     if far_side_int:
-        far_side_addrs = list(nb.ipam.ip_addresses.filter(interface_id=far_side_int.id))
+        far_side_addrs = [clab_model.make_address(addr) for addr in clab_netbox.get_int_addrs(far_side_int.id)]
+        far_side_dev = clab_netbox.get_device(far_side_int.device.id)
 
         add_device_interface(get_device_name(nb_device), interface.name, int_addrs, interface.description, nb_device)
-        add_device_interface(get_device_name(far_side_int.device), far_side_int.name, far_side_addrs,
-            far_side_int.description, far_side_int.device)
-        add_ordered_link(get_device_name(nb_device), interface, get_device_name(far_side_int.device), far_side_int)
+        add_device_interface(get_device_name(far_side_dev), far_side_int.name, far_side_addrs,
+            far_side_int.description, far_side_dev)
+        add_ordered_link(get_device_name(nb_device), interface, get_device_name(far_side_dev), far_side_int)
 #    else:
 #       PNIs, GREs to Cloudflare, L3 link to a third party that's not transit
 
@@ -321,16 +440,16 @@ def get_far_side_from_addr(interface, int_addrs):
     """ Uses IP addrs as the most generic way to get far side, works for directly connected
         ints as well as those via L2VPN, intermediate switch or GRE / tunnel ints. """
     for address in int_addrs:
-        subnet_ips = nb.ipam.ip_addresses.filter(parent=str(address.network))
+        subnet_ips = clab_netbox.get_network_addrs(address.network)
         for subnet_ip in subnet_ips:
-            if str(subnet_ip.address) != str(address):
+            if clab_model.make_address(subnet_ip.address) != address:
                 if subnet_ip.assigned_object:
-                    return nb.dcim.interfaces.get(subnet_ip.assigned_object.id)
+                    return clab_netbox.get_interface(subnet_ip.assigned_object.id)
 
 
 def get_next_eth_int(device_data):
     """ Returns name for next eth interface on a device """
-    eth_ints = [eth_int for eth_int in device_data['phys_ints'].keys() if eth_int.startswith('eth')]
+    eth_ints = [eth_int for eth_int in device_data.phys_ints.keys() if eth_int.startswith('eth')]
     return f"eth{len(eth_ints) + 1}"
 
 
@@ -338,24 +457,25 @@ def add_device_interface(device_name, int_name, int_addrs, descr, nb_device=None
     """ Adds required details for a container interface to internal devices dict.
         Will also add the device itself if it is not already there. """
     # Add device if this is first we've seen it
-    if device_name not in devices and nb_device:
+    if device_name not in ctx.devices and nb_device:
         add_device(nb_device)
 
-    if int_name not in devices[device_name]['phys_ints']:
+    if int_name not in ctx.devices[device_name].phys_ints:
         vlans = []
         access_vlan = 0
         if nb_device:
             # If it's a switch check Vlans needed on the interface
-            interface = devices[get_device_name(nb_device)]['nb_ints'][int_name]
-            if devices[get_device_name(nb_device)]['sub_type'] == "l2switch" and interface.mode is not None:
+            int_indexes = clab_netbox.get_int_indexes(nb_device)
+            interface = int_indexes['ints'][int_name]
+            if ctx.devices[get_device_name(nb_device)].sub_type == "l2switch" and interface.mode is not None:
                 if interface.mode.value == "tagged":
                     vlans = [vlan.vid for vlan in interface.tagged_vlans]
                 if interface.untagged_vlan:
                     access_vlan = interface.untagged_vlan.vid
 
-            elif devices[get_device_name(nb_device)]['sub_type'] == "l3switch" and not int_addrs:
+            elif ctx.devices[get_device_name(nb_device)].sub_type == "l3switch" and not int_addrs:
                 # It's a trunk or access port (i.e. we set allowed vlans) if it has no sub-interfaces
-                subints = [sub for sub in devices[get_device_name(nb_device)]['nb_ints'].keys() if sub.startswith(f"{int_name}.")]
+                subints = int_indexes['subints'].get(int_name)
                 if not subints and interface.mode is not None:
                     if interface.mode.value == "tagged":
                         vlans = [vlan.vid for vlan in interface.tagged_vlans]
@@ -364,19 +484,15 @@ def add_device_interface(device_name, int_name, int_addrs, descr, nb_device=None
                     elif interface.mode.value == "access":
                         access_vlan = interface.untagged_vlan.vid
 
-        devices[device_name]['phys_ints'][int_name] = {
-            "addrs": int_addrs,
-            "clab_dev": int_name.replace('/', '_').replace(':', '_'),
-            "descr": descr,
-            "vlans": vlans,
-            "access_vlan": access_vlan
-        }
+        addrs = [clab_model.make_address(int_addr) for int_addr in int_addrs]
+        ctx.devices[device_name].phys_ints[int_name] = clab_model.Interface(
+            int_name, clab_model.clab_dev_name(int_name), descr, addrs, vlans, access_vlan)
 
 
 def add_device(nb_device):
     device_name = get_device_name(nb_device)
     
-    if device_name not in devices.keys():
+    if device_name not in ctx.devices.keys():
         # Defaults
         kind = "crpd"
         sub_type = "cr"
@@ -386,6 +502,7 @@ def add_device(nb_device):
         if nb_device.device_role.slug == "cloudsw":
             sub_type = "l3switch"
         elif nb_device.device_role.slug == "asw":
+            wait_homer_data()
             try:
                 if yaml_data['devices'][fqdn]['config']['l3_switch']:
                     sub_type = "l3switch"
@@ -396,32 +513,16 @@ def add_device(nb_device):
             kind = "linux"
             sub_type = "host"
 
-        devices[device_name] = {}
-        devices[device_name]['kind'] = kind
-        devices[device_name]['sub_type'] = sub_type
-        devices[device_name]['fqdn'] = fqdn
-        devices[device_name]['phys_ints'] = {}
-        devices[device_name]['subints'] = {}
-        devices[device_name]['irb_ints'] = {}
-
-        # Get device interfaces, add to device object keyed by int name
-        devices[device_name]['nb_ints'] = {}
-        if nb_device.virtual_chassis:
-            # If it's VC we pull list of ints from the master device always
-            nb_ints = nb.dcim.interfaces.filter(device_id=nb_device.virtual_chassis.master.id, enabled="true")
-        else:
-            nb_ints = nb.dcim.interfaces.filter(device_id=nb_device.id, enabled="true")
-        for interface in nb_ints:
-            devices[device_name]['nb_ints'][interface.name] = interface
+        ctx.devices[device_name] = clab_model.make_device(device_name, kind, sub_type, fqdn)
 
 
 def get_dev_fqdn(nb_device):
     if nb_device.virtual_chassis:
         return nb_device.virtual_chassis.name
-    if nb_device.primary_ip4 is not None and nb_device.primary_ip4.dns_name:
-        return nb_device.primary_ip4.dns_name
-    elif nb_device.primary_ip6 is not None and nb_device.primary_ip6.dns_name:
-        return nb_device.primary_ip6.dns_name
+    if nb_device.primary_ip4 is not None and clab_netbox.get_address(nb_device.primary_ip4.id).dns_name:
+        return clab_netbox.get_address(nb_device.primary_ip4.id).dns_name
+    elif nb_device.primary_ip6 is not None and clab_netbox.get_address(nb_device.primary_ip6.id).dns_name:
+        return clab_netbox.get_address(nb_device.primary_ip6.id).dns_name
     else:
         return None
 
@@ -446,22 +547,17 @@ def add_link(router_a, int_a, router_b, int_b, descr=""):
     if not descr:
         descr = "{} {} to {} {}".format(router_a, int_a, router_b, int_b)
 
-    # Key on hash of router and port IDs, ensures uniqueness
-    link_id = hash((router_a, int_a, router_b, int_b))
-    links[link_id] = {
-        "dev_a": router_a,
-        "int_a": devices[router_a]['phys_ints'][int_a]['clab_dev'],
-        "dev_b": router_b,
-        "int_b": devices[router_b]['phys_ints'][int_b]['clab_dev'],
-        "descr": descr
-    }
+    # Key on router and port names, ensures uniqueness and is the same on every run
+    link_id = (router_a, int_a, router_b, int_b)
+    ctx.links[link_id] = clab_model.Link(router_a, ctx.devices[router_a].phys_ints[int_a].clab_dev,
+                                         router_b, ctx.devices[router_b].phys_ints[int_b].clab_dev, descr)
 
 
 def get_far_side_dev(phys_int, device):
     """ Return device object connected to phys_int """
     far_side_int = get_link_far_side(phys_int)
     if far_side_int:
-        return far_side_int, far_side_int.device
+        return far_side_int, clab_netbox.get_device(far_side_int.device.id)
     else:
         return None, None
 
@@ -471,15 +567,15 @@ def get_link_far_side(interface):
     if interface.type.value == "lag":
         lag_member = get_lag_member(interface)
         if lag_member.connected_endpoint_type == "dcim.interface":
-            phys_int_b = nb.dcim.interfaces.get(lag_member.connected_endpoint.id)
-            return nb.dcim.interfaces.get(phys_int_b.lag.id)
+            phys_int_b = clab_netbox.get_interface(lag_member.connected_endpoint.id)
+            return clab_netbox.get_interface(phys_int_b.lag.id)
         else:
             # Usually parent int of peering cct like AMS-IX
             return
     else:
         # No LAG, nice and simple
         try:
-            return nb.dcim.interfaces.get(interface.connected_endpoint.id)
+            return clab_netbox.get_interface(interface.connected_endpoint.id)
         except AttributeError as e:
             pass
             #print(e)
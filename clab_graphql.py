@@ -0,0 +1,266 @@
+import json
+from types import SimpleNamespace
+
+import clab_netbox
+
+# Alternative to the REST bulk loads in clab_netbox.py.  Pulls the same data with a handful of
+# nested GraphQL queries, asking only for the fields clab_gen.py reads, and fills the same
+# clab_netbox indexes with light objects that look enough like pynetbox Records to the add_*
+# functions.
+
+CIRCUIT_FIELDS = "id cid provider { name } type { slug }"
+
+DEVICE_FIELDS = """
+    id name
+    device_role { slug }
+    virtual_chassis { id name master { id } }
+    primary_ip4 { id address dns_name }
+    primary_ip6 { id address dns_name }
+"""
+
+INTERFACE_FIELDS = """
+    id name enabled mgmt_only description type mode
+    device { id name }
+    lag { id name }
+    parent { id name }
+    untagged_vlan { vid }
+    tagged_vlans { vid }
+    ip_addresses { id address dns_name }
+    fhrp_group_assignments { id group { id ip_addresses { id address } } }
+    connected_endpoints { __typename ... on InterfaceType { id device { id } } }
+    link_peers {
+        __typename
+        ... on InterfaceType { id }
+        ... on CircuitTerminationType { id circuit { %s } }
+        ... on FrontPortType {
+            id
+            rear_port {
+                id
+                link_peers { __typename ... on CircuitTerminationType { id circuit { %s } } }
+            }
+        }
+    }
+""" % (CIRCUIT_FIELDS, CIRCUIT_FIELDS)
+
+# GraphQL type names mapped to the object types the REST API uses for link peers / endpoints
+OBJECT_TYPES = {
+    "InterfaceType": "dcim.interface",
+    "FrontPortType": "dcim.frontport",
+    "RearPortType": "dcim.rearport",
+    "CircuitTerminationType": "circuits.circuittermination"
+}
+
+
+class GraphQLError(Exception):
+    """ Netbox returned errors for a GraphQL query """
+
+
+class GqlRecord(SimpleNamespace):
+    """ Attribute access to GraphQL results, printing like a pynetbox Record does """
+    def __str__(self):
+        for attr in ['address', 'name', 'cid', 'id']:
+            if hasattr(self, attr):
+                return str(getattr(self, attr))
+        return super().__str__()
+
+
+def prefetch(nb_api, roles, statuses):
+    """ GraphQL version of clab_netbox.prefetch() """
+    clab_netbox.nb = nb_api
+
+    print("Pre-fetching Netbox data with GraphQL...")
+    l3_devices = get_devices(f"role: {gql_list(roles)}, status: {gql_list(statuses)}")
+    load_device_data(l3_devices)
+
+    # Second pass for devices at the far side of connected interfaces
+    neighbour_ids = clab_netbox.get_neighbour_ids()
+    if neighbour_ids:
+        load_device_data(get_devices(f"id: {gql_list(neighbour_ids)}"))
+
+    # In chunks like clab_netbox.bulk_filter(), so a big site doesn't make one huge query
+    networks = sorted(clab_netbox.get_subnets_to_load())
+    for i in range(0, len(networks), clab_netbox.CHUNK_SIZE):
+        query = "ip_address_list(parent: %s) { id address dns_name " \
+                "assigned_object { __typename ... on InterfaceType { id } } }" % \
+                gql_list(networks[i:i+clab_netbox.CHUNK_SIZE])
+        addrs = [make_address(addr) for addr in run_query(query)['ip_address_list']]
+        clab_netbox.add_addrs(addrs, index_ints=False)
+    clab_netbox.print_summary()
+
+    return l3_devices
+
+
+def get_devices_by_name(names):
+    """ GraphQL version of clab_netbox.get_devices_by_name() """
+    nb_devices = get_devices(f"name: {gql_list(names)}")
+    load_device_data(nb_devices)
+    return nb_devices
+
+
+def load_device_data(nb_devices):
+    """ Loads interfaces, with their IPs, link peers and FHRP groups, for list of devices """
+    nb_devices = [nb_device for nb_device in nb_devices
+                  if clab_netbox.int_key(nb_device) not in clab_netbox.device_ints]
+    if not nb_devices:
+        return
+
+    clab_netbox.add_devices(nb_devices)
+    vc_ids = {nb_device.virtual_chassis.id for nb_device in nb_devices if nb_device.virtual_chassis}
+    if vc_ids:
+        clab_netbox.add_devices(get_devices(f"virtual_chassis_id: {gql_list(vc_ids)}"))
+
+    key_ids = {clab_netbox.int_key(nb_device) for nb_device in nb_devices}
+    for key_id in key_ids:
+        clab_netbox.device_ints[key_id] = {}
+    query = "interface_list(device_id: %s) { %s }" % (gql_list(key_ids), INTERFACE_FIELDS)
+    int_data = run_query(query)['interface_list']
+
+    new_ints = [add_interface(interface) for interface in int_data]
+    clab_netbox.add_interfaces(new_ints)
+
+    # Work out the device names for each FHRP group, so we can tell which gets the VIP
+    group_ids = {assignment.group.id for interface in new_ints
+                 for assignment in clab_netbox.fhrp_assignments.get(interface.id, [])
+                 if assignment.group.id not in clab_netbox.fhrp_members}
+    if group_ids:
+        query = "fhrp_group_assignment_list(group_id: %s) { group { id } " \
+                "interface { __typename ... on InterfaceType { device { name } } } }" % gql_list(group_ids)
+        for group_id in group_ids:
+            clab_netbox.fhrp_members[group_id] = []
+        for assignment in run_query(query)['fhrp_group_assignment_list']:
+            if assignment['interface']['__typename'] == "InterfaceType":
+                group_id = int(assignment['group']['id'])
+                clab_netbox.fhrp_members[group_id].append(assignment['interface']['device']['name'])
+
+
+def get_devices(filters):
+    query = "device_list(%s) { %s }" % (filters, DEVICE_FIELDS)
+    nb_devices = []
+    for device in run_query(query)['device_list']:
+        nb_device = make_record(device)
+        for primary_ip in [nb_device.primary_ip4, nb_device.primary_ip6]:
+            if primary_ip is not None:
+                clab_netbox.addrs_by_id[primary_ip.id] = primary_ip
+        nb_devices.append(nb_device)
+    return nb_devices
+
+
+def add_interface(data):
+    """ Converts interface data returned by GraphQL into an object with the same attributes as
+        we use from the REST API, and adds its IPs, link peers and FHRP groups to the indexes. """
+    interface = make_record({key: value for key, value in data.items()
+        if key not in ['type', 'mode', 'ip_addresses', 'fhrp_group_assignments', 'connected_endpoints', 'link_peers']})
+    interface.type = GqlRecord(value=enum_value(data['type']))
+    interface.mode = GqlRecord(value=enum_value(data['mode'])) if data['mode'] else None
+    interface.count_ipaddresses = len(data['ip_addresses'])
+    interface.count_fhrp_groups = len(data['fhrp_group_assignments'])
+
+    int_addrs = []
+    for addr in data['ip_addresses']:
+        addr['assigned_object'] = {'__typename': "InterfaceType", 'id': interface.id}
+        int_addrs.append(make_address(addr))
+    clab_netbox.int_addrs[interface.id] = []
+    clab_netbox.add_addrs(int_addrs)
+
+    for assignment in data['fhrp_group_assignments']:
+        group = make_record(assignment['group'])
+        clab_netbox.fhrp_groups[group.id] = group
+        clab_netbox.fhrp_assignments.setdefault(interface.id, []).append(
+            GqlRecord(id=int(assignment['id']), group=GqlRecord(id=group.id)))
+
+    interface.connected_endpoint_type, interface.connected_endpoint = None, None
+    if data['connected_endpoints']:
+        endpoint = data['connected_endpoints'][0]
+        interface.connected_endpoint_type = OBJECT_TYPES.get(endpoint['__typename'])
+        if endpoint['__typename'] == "InterfaceType":
+            interface.connected_endpoint = make_record(endpoint)
+
+    interface.link_peer_type, interface.link_peer = None, None
+    if data['link_peers']:
+        interface.link_peer_type, interface.link_peer = add_link_peer(data['link_peers'][0])
+
+    return interface
+
+
+def add_link_peer(peer):
+    """ Returns object type and record for far side of a cable, adding any circuit and
+        front/rear port details to the indexes """
+    peer_type = OBJECT_TYPES.get(peer['__typename'])
+    if peer_type is None:
+        return None, None
+
+    peer_id = int(peer['id'])
+    if peer_type == "circuits.circuittermination":
+        circuit = make_record(peer['circuit'])
+        clab_netbox.circuits[circuit.id] = circuit
+        clab_netbox.circuit_terms[peer_id] = GqlRecord(id=peer_id, circuit=GqlRecord(id=circuit.id))
+    elif peer_type == "dcim.frontport":
+        rear_port = GqlRecord(id=int(peer['rear_port']['id']))
+        rear_port.link_peer_type, rear_port.link_peer = None, None
+        if peer['rear_port']['link_peers']:
+            rear_port.link_peer_type, rear_port.link_peer = add_link_peer(peer['rear_port']['link_peers'][0])
+        clab_netbox.rear_ports[rear_port.id] = rear_port
+        clab_netbox.front_ports[peer_id] = GqlRecord(id=peer_id, rear_port=GqlRecord(id=rear_port.id))
+
+    return peer_type, GqlRecord(id=peer_id)
+
+
+def make_address(data):
+    """ IP object with the assigned_object attributes the REST API has """
+    address = make_record({key: value for key, value in data.items() if key != 'assigned_object'})
+    address.assigned_object_type, address.assigned_object_id, address.assigned_object = None, None, None
+    if data.get('assigned_object') and data['assigned_object']['__typename'] in OBJECT_TYPES:
+        address.assigned_object_type = OBJECT_TYPES[data['assigned_object']['__typename']]
+        address.assigned_object_id = int(data['assigned_object']['id'])
+        address.assigned_object = GqlRecord(id=address.assigned_object_id)
+    return address
+
+
+def make_record(data):
+    """ Recursively converts GraphQL result dicts to GqlRecord, with ids as ints like REST """
+    if isinstance(data, dict):
+        values = {}
+        for key, value in data.items():
+            if key == "id":
+                values[key] = int(value)
+            else:
+                values[key] = make_record(value)
+        return GqlRecord(**values)
+    if isinstance(data, list):
+        return [make_record(item) for item in data]
+    return data
+
+
+def enum_value(value):
+    """ Graphene returns choice fields as enum names (e.g. 'A_10GBASE_X_SFPP'), convert them
+        back to the value the REST API gives (e.g. '10gbase-x-sfpp') """
+    if value is None:
+        return None
+    value = value.lower()
+    if value.startswith("a_"):
+        value = value[2:]
+    return value.replace("_", "-")
+
+
+def gql_list(values):
+    """ Formats filter values as GraphQL list of strings """
+    return json.dumps([str(value) for value in sorted(values)])
+
+
+def run_query(query):
+    """ Sends query to the Netbox GraphQL API, using the pynetbox session so auth / TLS
+        settings are the same as the REST calls.  Raises GraphQLError if Netbox reports errors. """
+    nb = clab_netbox.nb
+    graphql_url = nb.base_url[:-len("/api")] + "/graphql/"
+    headers = {
+        "Authorization": f"Token {nb.token}",
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+    response = nb.http_session.post(graphql_url, headers=headers, json={"query": "{ %s }" % query})
+    response.raise_for_status()
+    result = response.json()
+    if result.get("errors"):
+        raise GraphQLError(result['errors'])
+
+    return result['data']
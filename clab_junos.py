@@ -0,0 +1,62 @@
+import os
+from contextlib import contextmanager
+
+from jnpr.junos import Device
+from jnpr.junos.utils.config import Config
+from jnpr.junos.exception import ConnectError, RpcError
+from ncclient.transport.errors import TransportError
+
+import clab_trace
+
+# NETCONF sessions to Junos devices (lab nodes or production routers), opened the same way by
+# all the junos_* scripts in place of each having its own copy.  A session is opened for the
+# duration of the 'with' block and closed after it, sessions aren't kept for reuse as no run
+# does more than one operation on the same device (junos_get_live_conf.py retrying a router
+# after an error reconnects, which is what we'd want after most failures anyway).
+#
+#     clab_junos.init(args.sshconfig)
+#     with clab_junos.session("clab-wmf-lab-cr1-eqiad") as junos_dev:
+#         config = junos_dev.rpc.get_config(options={'format': 'json'})
+
+ssh_config = "~/.ssh/config"
+username = None
+
+
+def init(ssh_config_file):
+    """ Sets SSH config file for sessions to use, and looks up the user to log in as.  That
+        happens here, so a failure isn't mistaken for one connecting to a device. """
+    global ssh_config, username
+    ssh_config = ssh_config_file
+    username = os.getlogin()
+
+
+@contextmanager
+def session(host, port=22, rpc_timeout=None, **device_args):
+    """ Yields PyEZ Device for host opened with device_args, with Config bound as 'config', and
+        closes it afterwards.  Raises ConnectError if it can't be opened. """
+    device = open_device(host, port, **device_args)
+    if rpc_timeout:
+        device.timeout = rpc_timeout
+    try:
+        yield device
+    finally:
+        close_device(device)
+
+
+def open_device(host, port, **device_args):
+    device = clab_trace.trace_junos_device(Device(host, username=username, ssh_config=ssh_config, port=port,
+                                                  **device_args))
+    with clab_trace.phase(f"{host} connect", "netconf"):
+        device.open()
+
+    # Get config object
+    device.bind(config=Config)
+    return device
+
+
+def close_device(device):
+    try:
+        device.close()
+    except (ConnectError, RpcError, TransportError, OSError):
+        # Closing a broken session can fail, it's gone either way
+        pass
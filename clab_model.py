@@ -0,0 +1,99 @@
+import ipaddress
+from dataclasses import dataclass
+
+# Compact representation of the discovered topology.  These hold only what clab_write.py needs
+# to write the lab files, rather than the pynetbox Records used during discovery, so they are
+# small in memory and in saved snapshots.
+
+
+@dataclass(frozen=True)
+class Address:
+    """ IP address and prefix length, with the address stored as an integer """
+    __slots__ = ('version', 'ip', 'prefixlen')
+    version: int
+    ip: int
+    prefixlen: int
+
+    def __str__(self):
+        return f"{self.ip_address}/{self.prefixlen}"
+
+    def __reduce__(self):
+        # Frozen slotted classes can't have their state set back by the default unpickling
+        return (Address, (self.version, self.ip, self.prefixlen))
+
+    @property
+    def ip_address(self):
+        if self.version == 4:
+            return ipaddress.IPv4Address(self.ip)
+        return ipaddress.IPv6Address(self.ip)
+
+    @property
+    def interface(self):
+        return ipaddress.ip_interface(str(self))
+
+    @property
+    def network(self):
+        return self.interface.network
+
+
+@dataclass
+class Interface:
+    __slots__ = ('name', 'clab_dev', 'descr', 'addrs', 'vlans', 'access_vlan')
+    name: str
+    clab_dev: str
+    descr: str
+    addrs: list
+    vlans: list
+    access_vlan: int
+
+
+@dataclass
+class SubInterface:
+    """ 802.1q sub-interface created on a container interface by the start script """
+    __slots__ = ('name', 'clab_dev', 'subint_dev', 'vlan_id', 'addrs')
+    name: str
+    clab_dev: str
+    subint_dev: str
+    vlan_id: int
+    addrs: list
+
+
+@dataclass
+class Device:
+    __slots__ = ('name', 'kind', 'sub_type', 'fqdn', 'phys_ints', 'subints', 'irb_ints', 'loop_addrs', 'bgp_groups')
+    name: str
+    kind: str
+    sub_type: str
+    fqdn: str
+    phys_ints: dict
+    subints: dict
+    irb_ints: dict
+    loop_addrs: list
+    bgp_groups: dict
+
+
+@dataclass
+class Link:
+    __slots__ = ('dev_a', 'int_a', 'dev_b', 'int_b', 'descr')
+    dev_a: str
+    int_a: str
+    dev_b: str
+    int_b: str
+    descr: str
+
+
+def make_address(address):
+    """ Returns Address from a string, ipaddress interface or Netbox IP object """
+    if isinstance(address, Address):
+        return address
+    ip_int = ipaddress.ip_interface(str(address))
+    return Address(ip_int.version, int(ip_int.ip), ip_int.network.prefixlen)
+
+
+def make_device(name, kind, sub_type, fqdn=None):
+    return Device(name, kind, sub_type, fqdn, {}, {}, {}, [], {})
+
+
+def clab_dev_name(int_name):
+    """ Linux netdev name for an interface, as '/' and ':' aren't allowed """
+    return int_name.replace('/', '_').replace(':', '_')
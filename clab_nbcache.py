@@ -0,0 +1,265 @@
+import ipaddress
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# On-disk cache of the Netbox REST objects clab_netbox.py pulls.  Objects are stored by type
+# and id along with their 'last_updated' value, and the ids each filter() returned are kept so
+# the same query can be answered from disk next time.  When the cache is opened, objects changed
+# since the last sync are pulled with 'last_updated__gte' and deletions found from the changelog,
+# so after a small Netbox edit only a few requests are needed.
+cache_dir = None
+nb = None
+last_sync = None
+objects = {}
+queries = {}
+lock = threading.Lock()
+
+stats = {
+    'query_hits': 0,
+    'query_misses': 0,
+    'objects_read': 0,
+    'objects_fetched': 0,
+    'refreshed': 0,
+    'deleted': 0
+}
+
+# Changelog object types for the endpoints clab_netbox.py queries
+CHANGELOG_TYPES = {
+    "dcim.device": "dcim.devices",
+    "dcim.interface": "dcim.interfaces",
+    "dcim.frontport": "dcim.front-ports",
+    "dcim.rearport": "dcim.rear-ports",
+    "ipam.ipaddress": "ipam.ip-addresses",
+    "ipam.fhrpgroup": "ipam.fhrp-groups",
+    "ipam.fhrpgroupassignment": "ipam.fhrp-group-assignments",
+    "circuits.circuit": "circuits.circuits",
+    "circuits.circuittermination": "circuits.circuit-terminations"
+}
+
+# Allow for clock difference between us and Netbox when picking the next sync time
+SYNC_MARGIN = timedelta(minutes=5)
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def open_cache(nb_api, directory):
+    """ Loads cache from directory, then brings it up to date with changes made in Netbox
+        since the last run """
+    global nb, cache_dir, last_sync, queries
+    nb = nb_api
+    cache_dir = Path(directory)
+    cache_dir.mkdir(exist_ok=True, parents=True)
+
+    for obj_file in cache_dir.glob("objects.*.json"):
+        obj_type = obj_file.name[len("objects."):-len(".json")]
+        objects[obj_type] = load_json(obj_file.name, {})
+    queries = load_json("queries.json", {})
+
+    sync_time = (datetime.now(timezone.utc) - SYNC_MARGIN).strftime(TIME_FORMAT)
+    last_sync = load_json("state.json", {}).get('last_sync')
+    if last_sync:
+        print(f"Refreshing Netbox cache with changes since {last_sync}...")
+        refresh(last_sync)
+    last_sync = sync_time
+
+
+def refresh(since):
+    """ Updates cached objects that have changed since the given time, and drops deleted ones """
+    stale_ints = set()
+    for obj_type in list(objects.keys()):
+        for record in get_endpoint(obj_type).filter(last_updated__gte=since):
+            old = objects[obj_type].get(str(record.id))
+            if old:
+                stale_ints |= dependent_ints(obj_type, old['data'])
+            data = dict(record)
+            store_object(obj_type, data)
+            update_queries(obj_type, data)
+            stale_ints |= dependent_ints(obj_type, data)
+            stats['refreshed'] += 1
+
+    for change in nb.extras.object_changes.filter(time_after=since, action="delete"):
+        obj_type = CHANGELOG_TYPES.get(change.changed_object_type)
+        old = objects.get(obj_type, {}).pop(str(change.changed_object_id), None)
+        if old:
+            stale_ints |= dependent_ints(obj_type, old['data'])
+            for query in queries.get(obj_type, {}).values():
+                if str(change.changed_object_id) in query['ids']:
+                    query['ids'].remove(str(change.changed_object_id))
+            stats['deleted'] += 1
+
+    # An interface's IP / FHRP group counts change without its 'last_updated' doing so
+    stale_ints = sorted(stale_ints & set(objects.get("dcim.interfaces", {}).keys()))
+    for i in range(0, len(stale_ints), 100):
+        for record in nb.dcim.interfaces.filter(id=stale_ints[i:i+100]):
+            data = dict(record)
+            store_object("dcim.interfaces", data)
+            update_queries("dcim.interfaces", data)
+            stats['refreshed'] += 1
+
+
+def cached_filter(endpoint, **filters):
+    """ Returns results of endpoint.filter(**filters), from disk if we have run the same
+        query before """
+    obj_type = endpoint_type(endpoint)
+    filters = {field: sorted(str(value) for value in (values if isinstance(values, list) else [values]))
+               for field, values in filters.items()}
+    key = "&".join(f"{field}={','.join(values)}" for field, values in sorted(filters.items()))
+
+    with lock:
+        query = queries.get(obj_type, {}).get(key)
+        if query is not None and all(obj_id in objects[obj_type] for obj_id in query['ids']):
+            stats['query_hits'] += 1
+            stats['objects_read'] += len(query['ids'])
+            obj_data = [objects[obj_type][obj_id]['data'] for obj_id in query['ids']]
+            return [endpoint.return_obj(data, endpoint.api, endpoint) for data in obj_data]
+
+    records = list(endpoint.filter(**filters))
+    with lock:
+        stats['query_misses'] += 1
+        stats['objects_fetched'] += len(records)
+        for record in records:
+            store_object(obj_type, dict(record))
+        queries.setdefault(obj_type, {})[key] = {
+            'filters': filters,
+            'ids': [str(record.id) for record in records]
+        }
+
+    return records
+
+
+def store_object(obj_type, data):
+    objects.setdefault(obj_type, {})[str(data['id'])] = {
+        'last_updated': data.get('last_updated'),
+        'data': data
+    }
+
+
+def update_queries(obj_type, data):
+    """ Keeps cached query results right after an object changes.  Where we can't tell locally
+        if it matches a query, or it is new to the results (so we don't know where Netbox
+        would order it), the query is dropped so it gets re-run. """
+    obj_id = str(data['id'])
+    for key, query in list(queries.get(obj_type, {}).items()):
+        match = matches(obj_type, data, query['filters'])
+        if obj_id in query['ids']:
+            if match is False:
+                query['ids'].remove(obj_id)
+            elif match is None:
+                del queries[obj_type][key]
+        elif match is not False:
+            del queries[obj_type][key]
+
+
+def matches(obj_type, data, filters):
+    """ Returns True/False if object matches all filters, or None if we can't tell """
+    result = True
+    for field, values in filters.items():
+        field_match = field_matches(obj_type, data, field, values)
+        if field_match is False:
+            return False
+        if field_match is None:
+            result = None
+    return result
+
+
+def field_matches(obj_type, data, field, values):
+    if field == "id":
+        return str(data['id']) in values
+    if field == "name":
+        return data.get('name') in values
+    if field == "role":
+        return get_nested(data, 'device_role', 'slug') in values
+    if field == "status":
+        return get_nested(data, 'status', 'value') in values
+    if field == "virtual_chassis_id":
+        return str(get_nested(data, 'virtual_chassis', 'id')) in values
+    if field == "group_id":
+        return str(get_nested(data, 'group', 'id')) in values
+    if field == "interface_id":
+        if obj_type == "ipam.ip-addresses":
+            return str(data.get('assigned_object_id')) in values
+        return str(data.get('interface_id')) in values
+    if field == "parent":
+        ip_addr = ipaddress.ip_interface(data['address']).ip
+        return any(ip_addr in ipaddress.ip_network(value) for value in values)
+    if field == "device_id":
+        if obj_type == "dcim.interfaces":
+            device_id = get_nested(data, 'device', 'id')
+        elif obj_type == "ipam.ip-addresses":
+            if not data.get('assigned_object'):
+                return False
+            device_id = get_nested(data, 'assigned_object', 'device', 'id')
+        else:
+            return None
+        if device_id is None:
+            return None
+        if str(device_id) in values:
+            return True
+        # Filtering on a VC master's id also returns objects on the other members
+        device = objects.get("dcim.devices", {}).get(str(device_id))
+        if device is None:
+            return None
+        return str(get_nested(device['data'], 'virtual_chassis', 'master', 'id')) in values
+    return None
+
+
+def dependent_ints(obj_type, data):
+    """ Returns ids of interfaces whose counts are affected by changes to this object """
+    if obj_type == "ipam.ip-addresses" and data.get('assigned_object_type') == "dcim.interface":
+        return {str(data['assigned_object_id'])}
+    if obj_type == "ipam.fhrp-group-assignments" and data.get('interface_type') == "dcim.interface":
+        return {str(data['interface_id'])}
+    return set()
+
+
+def get_nested(data, *keys):
+    for key in keys:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def endpoint_type(endpoint):
+    """ 'https://netbox/api/dcim/interfaces' -> 'dcim.interfaces' """
+    return ".".join(endpoint.url.rstrip("/").split("/")[-2:])
+
+
+def get_endpoint(obj_type):
+    app_name, endpoint_name = obj_type.split(".")
+    return getattr(getattr(nb, app_name), endpoint_name.replace("-", "_"))
+
+
+def save_cache():
+    """ Writes cache back to disk, and prints how much of this run it answered """
+    if not cache_dir:
+        return
+
+    for obj_type, type_objects in objects.items():
+        save_json(f"objects.{obj_type}.json", type_objects)
+    save_json("queries.json", queries)
+    save_json("state.json", {'last_sync': last_sync})
+
+    total_queries = stats['query_hits'] + stats['query_misses']
+    hit_rate = stats['query_hits'] / total_queries * 100 if total_queries else 0
+    print(f"Netbox cache: {stats['query_hits']} of {total_queries} queries ({hit_rate:.0f}%) served from disk, " \
+          f"{stats['objects_read']} objects read from cache, {stats['objects_fetched']} fetched.  " \
+          f"{stats['refreshed']} refreshed and {stats['deleted']} deleted since last sync.\n")
+
+
+def load_json(file_name, default):
+    try:
+        with open(cache_dir / file_name, 'r') as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return default
+
+
+def save_json(file_name, data):
+    """ Writes to a temp file and renames it, so an interrupted run doesn't corrupt the cache """
+    tmp_name = cache_dir / f".{file_name}.tmp"
+    with open(tmp_name, 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(tmp_name, cache_dir / file_name)
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+import clab_trace
+
+# Record / replay of Netbox API traffic, so clab_gen.py can be run and timed without a live
+# Netbox.  An adapter is mounted on the pynetbox http_session, so REST and GraphQL calls both go
+# through it:
+#
+#   record  - requests go to Netbox as normal, and each response is also saved to the fixture dir
+#   replay  - responses are served from the fixture dir, and Netbox is never contacted
+#
+# Fixtures are one JSON file per distinct request, named by a hash of method, URL and body.  The
+# API token is not saved.  In either mode a count of calls per endpoint is written to calls.json
+# in the fixture dir at the end of the run, so call counts can be compared between versions.
+
+adapter = None
+
+
+class NetboxFixtureAdapter(HTTPAdapter):
+    def __init__(self, fixture_dir, replay=False, latency=0):
+        super().__init__()
+        self.fixture_dir = Path(fixture_dir)
+        self.replay = replay
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.fixture_dir.mkdir(exist_ok=True, parents=True)
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            self.calls[clab_trace.endpoint_name(request.url)] += 1
+
+        fixture_file = self.fixture_dir / f"{fixture_key(request)}.json"
+        if not self.replay:
+            response = super().send(request, **kwargs)
+            save_fixture(fixture_file, request, response)
+            return response
+
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            with open(fixture_file, 'r') as json_file:
+                fixture = json.load(json_file)
+        except FileNotFoundError:
+            print(f"No recorded response for {request.method} {request.url}, record a run with the same options first.")
+            sys.exit(1)
+        return build_response(request, fixture)
+
+    def save_calls(self):
+        with open(self.fixture_dir / "calls.json", 'w') as json_file:
+            json.dump({'total': sum(self.calls.values()), 'endpoints': dict(sorted(self.calls.items()))},
+                      json_file, indent=2)
+
+
+def attach(nb_api, fixture_dir, replay=False, latency_ms=0):
+    """ Mounts record or replay adapter on pynetbox session for the Netbox server """
+    global adapter
+    adapter = NetboxFixtureAdapter(fixture_dir, replay, latency_ms / 1000)
+    server_url = nb_api.base_url[:-len("/api")] + "/"
+    nb_api.http_session.mount(server_url, adapter)
+    mode = "Replaying" if replay else "Recording"
+    print(f"{mode} Netbox API responses {'from' if replay else 'to'} {fixture_dir}")
+
+
+def save_calls():
+    """ Writes call counts for the run and prints the total """
+    if adapter is None:
+        return
+    adapter.save_calls()
+    print(f"Netbox API: {sum(adapter.calls.values())} calls, counts saved to {adapter.fixture_dir / 'calls.json'}\n")
+
+
+def fixture_key(request):
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode()
+    return hashlib.sha1(f"{request.method} {request.url} ".encode() + body).hexdigest()
+
+
+def save_fixture(fixture_file, request, response):
+    fixture = {
+        'method': request.method,
+        'url': request.url,
+        'status': response.status_code,
+        'content_type': response.headers.get('Content-Type'),
+        'content': response.content.decode(response.encoding or "utf-8")
+    }
+    # Write to temp file and rename, as workers may be recording the same request
+    tmp_file = fixture_file.with_name(f".{fixture_file.name}.{threading.get_ident()}.tmp")
+    with open(tmp_file, 'w') as json_file:
+        json.dump(fixture, json_file)
+    tmp_file.replace(fixture_file)
+
+
+def build_response(request, fixture):
+    response = Response()
+    response.status_code = fixture['status']
+    response.headers = CaseInsensitiveDict({'Content-Type': fixture['content_type'] or "application/json"})
+    response._content = fixture['content'].encode()
+    response.encoding = "utf-8"
+    response.url = request.url
+    response.request = request
+    return response
@@ -0,0 +1,357 @@
+import bisect
+import ipaddress
+import threading
+
+import clab_nbcache
+
+# Local indexes of Netbox objects, filled by prefetch() in a few paginated bulk requests
+# so the topology discovery in clab_gen.py doesn't need an API call per interface.
+nb = None
+devices_by_id = {}
+interfaces_by_id = {}
+device_ints = {}
+int_addrs = {}
+addrs_by_id = {}
+# Every IP added, kept as sorted integer arrays per IP version for lookups by network, plus
+# the networks we know we have all IPs for
+indexed_addrs = {}
+addr_index = {}
+loaded_networks = set()
+front_ports = {}
+rear_ports = {}
+circuit_terms = {}
+circuits = {}
+fhrp_assignments = {}
+fhrp_groups = {}
+fhrp_members = {}
+# Per device (or VC master) maps of enabled interfaces by name, LAG members by LAG name and
+# sub-interfaces by the name of the interface they are under
+int_indexes = {}
+
+# Held while loading multiple indexes for a device, so discovery workers never see a
+# partially loaded one
+lock = threading.RLock()
+
+# Netbox gets upset with very long URLs, so split id lists we filter on into chunks
+CHUNK_SIZE = 100
+# Only pull all IPs in subnets this small, bigger ones are LANs we never need to walk
+MAX_PREFETCH_ADDRS = 8
+
+
+def prefetch(nb_api, roles, statuses):
+    """ Pulls the devices with the given roles/statuses, their interfaces, IPs, and the cables /
+        circuits / neighbour devices connected to them, into the local indexes.  Returns the
+        list of selected devices. """
+    global nb
+    nb = nb_api
+
+    print("Pre-fetching Netbox data...")
+    l3_devices = nb_filter(nb.dcim.devices, role=roles, status=statuses)
+    add_devices(l3_devices)
+    load_device_data(l3_devices)
+
+    # Second pass for devices at the far side of connected interfaces
+    load_device_data(bulk_get(nb.dcim.devices, get_neighbour_ids()))
+
+    add_addrs(bulk_filter(nb.ipam.ip_addresses, 'parent', get_subnets_to_load()), index_ints=False)
+    print_summary()
+
+    return l3_devices
+
+
+def get_devices_by_name(names):
+    """ Returns devices matching list of names, with their data loaded to the indexes """
+    nb_devices = nb_filter(nb.dcim.devices, name=names)
+    load_device_data(nb_devices)
+    return nb_devices
+
+
+def load_device_data(nb_devices):
+    """ Bulk loads interfaces and IPs for list of devices, plus the front/rear ports, circuits
+        and FHRP groups their interfaces reference. """
+    nb_devices = [nb_device for nb_device in nb_devices if int_key(nb_device) not in device_ints]
+    if not nb_devices:
+        return
+
+    add_devices(nb_devices)
+    # VC members need to be known so we can work out which master their interfaces belong to
+    vc_ids = {nb_device.virtual_chassis.id for nb_device in nb_devices if nb_device.virtual_chassis}
+    if vc_ids:
+        add_devices(bulk_filter(nb.dcim.devices, 'virtual_chassis_id', vc_ids))
+
+    key_ids = {int_key(nb_device) for nb_device in nb_devices}
+    for key_id in key_ids:
+        device_ints[key_id] = {}
+    new_ints = bulk_filter(nb.dcim.interfaces, 'device_id', key_ids)
+    add_interfaces(new_ints)
+
+    for interface in new_ints:
+        int_addrs.setdefault(interface.id, [])
+    device_ids = {interface.device.id for interface in new_ints}
+    add_addrs(bulk_filter(nb.ipam.ip_addresses, 'device_id', device_ids))
+
+    load_link_peers(new_ints)
+
+    fhrp_int_ids = [interface.id for interface in new_ints if interface.count_fhrp_groups]
+    load_fhrp_groups(bulk_filter(nb.ipam.fhrp_group_assignments, 'interface_id', fhrp_int_ids))
+
+
+def load_link_peers(nb_ints):
+    """ Loads front/rear ports and circuit terminations at the far side of cables, and the circuits
+        they belong to, so get_circuit() can work them out locally. """
+    front_port_ids = {interface.link_peer.id for interface in nb_ints
+                      if interface.link_peer_type == "dcim.frontport"}
+    for front_port in bulk_get(nb.dcim.front_ports, front_port_ids - set(front_ports.keys())):
+        front_ports[front_port.id] = front_port
+
+    rear_port_ids = {front_ports[port_id].rear_port.id for port_id in front_port_ids if port_id in front_ports}
+    for rear_port in bulk_get(nb.dcim.rear_ports, rear_port_ids - set(rear_ports.keys())):
+        rear_ports[rear_port.id] = rear_port
+
+    term_ids = {interface.link_peer.id for interface in nb_ints
+                if interface.link_peer_type == "circuits.circuittermination"}
+    term_ids |= {rear_ports[port_id].link_peer.id for port_id in rear_port_ids
+                 if port_id in rear_ports and rear_ports[port_id].link_peer_type == "circuits.circuittermination"}
+    for term in bulk_get(nb.circuits.circuit_terminations, term_ids - set(circuit_terms.keys())):
+        circuit_terms[term.id] = term
+
+    circuit_ids = {term.circuit.id for term in circuit_terms.values()}
+    for circuit in bulk_get(nb.circuits.circuits, circuit_ids - set(circuits.keys())):
+        circuits[circuit.id] = circuit
+
+
+def load_fhrp_groups(assignments):
+    """ Indexes FHRP group assignments by interface, plus the groups themselves (with their VIPs)
+        and the names of all member devices of each group. """
+    group_ids = set()
+    for assignment in assignments:
+        fhrp_assignments.setdefault(assignment.interface_id, []).append(assignment)
+        group_ids.add(assignment.group.id)
+
+    group_ids -= set(fhrp_groups.keys())
+    for group in bulk_get(nb.ipam.fhrp_groups, group_ids):
+        fhrp_groups[group.id] = group
+        fhrp_members[group.id] = []
+    for assignment in bulk_filter(nb.ipam.fhrp_group_assignments, 'group_id', group_ids):
+        fhrp_members[assignment.group.id].append(assignment.interface.device.name)
+
+
+def get_neighbour_ids():
+    """ Returns ids of devices connected to loaded interfaces whose data isn't loaded yet """
+    neighbour_ids = set()
+    for interface in interfaces_by_id.values():
+        if interface.connected_endpoint_type == "dcim.interface" and interface.connected_endpoint:
+            neighbour_ids.add(interface.connected_endpoint.device.id)
+    return neighbour_ids - set(device_ints.keys())
+
+
+def get_subnets_to_load():
+    """ Returns the small (i.e. point-to-point) subnets configured on loaded interfaces that
+        we've not pulled all IPs for yet.  Having them lets the far side of L3 links be found
+        by address without a per-link query. """
+    networks = set()
+    for addrs in int_addrs.values():
+        for address in addrs:
+            network = ipaddress.ip_interface(address.address).network
+            if network.num_addresses <= MAX_PREFETCH_ADDRS and str(network) not in loaded_networks:
+                networks.add(str(network))
+
+    loaded_networks.update(networks)
+    return networks
+
+
+def print_summary():
+    print(f"Pre-fetched {len(devices_by_id)} devices, {len(interfaces_by_id)} interfaces, " \
+          f"{sum(len(addrs) for addrs in int_addrs.values())} IP addresses.\n")
+
+
+def bulk_filter(endpoint, field, values):
+    """ Runs filter() on endpoint for all values of field, in chunks to keep URLs sane """
+    values = sorted(values)
+    results = []
+    for i in range(0, len(values), CHUNK_SIZE):
+        results.extend(nb_filter(endpoint, **{field: values[i:i+CHUNK_SIZE]}))
+    return results
+
+
+def nb_filter(endpoint, **filters):
+    """ All REST lookups go through here, so they're served from the on-disk cache if enabled """
+    if clab_nbcache.cache_dir:
+        return clab_nbcache.cached_filter(endpoint, **filters)
+    return list(endpoint.filter(**filters))
+
+
+def nb_get(endpoint, obj_id):
+    results = nb_filter(endpoint, id=[obj_id])
+    return results[0] if results else None
+
+
+def bulk_get(endpoint, ids):
+    return bulk_filter(endpoint, 'id', ids)
+
+
+def add_devices(nb_devices):
+    for nb_device in nb_devices:
+        devices_by_id[nb_device.id] = nb_device
+
+
+def add_interfaces(nb_ints):
+    for interface in nb_ints:
+        interfaces_by_id[interface.id] = interface
+        owner_key = int_key(devices_by_id.get(interface.device.id))
+        if owner_key in device_ints:
+            device_ints[owner_key][interface.name] = interface
+
+
+def add_addrs(nb_addrs, index_ints=True):
+    """ Adds IPs to the address index, and the by-interface one unless they came from a
+        subnet query (which may not return all of an interface's IPs) """
+    with lock:
+        for nb_addr in nb_addrs:
+            addrs_by_id[nb_addr.id] = nb_addr
+            if index_ints and nb_addr.assigned_object_type == "dcim.interface":
+                assigned = int_addrs.setdefault(nb_addr.assigned_object_id, [])
+                if nb_addr.id not in [address.id for address in assigned]:
+                    assigned.append(nb_addr)
+            # Once built, the sorted arrays are added to rather than rebuilt
+            if addr_index:
+                index_addr(nb_addr)
+            indexed_addrs[nb_addr.id] = nb_addr
+
+
+def index_addr(nb_addr):
+    """ Inserts IP into the sorted arrays, in the (IP, id) order get_addr_index() builds them
+        in, replacing its entry from before if there was one """
+    if nb_addr.id in indexed_addrs:
+        ip_ints, nb_addrs = addr_index[ipaddress.ip_interface(indexed_addrs[nb_addr.id].address).version]
+        position = addr_position(ip_ints, nb_addrs, indexed_addrs[nb_addr.id])
+        del ip_ints[position], nb_addrs[position]
+    ip_ints, nb_addrs = addr_index[ipaddress.ip_interface(nb_addr.address).version]
+    position = addr_position(ip_ints, nb_addrs, nb_addr)
+    ip_ints.insert(position, int(ipaddress.ip_interface(nb_addr.address).ip))
+    nb_addrs.insert(position, nb_addr)
+
+
+def addr_position(ip_ints, nb_addrs, nb_addr):
+    """ Returns position of IP in the sorted arrays, or where it would go """
+    ip_int = int(ipaddress.ip_interface(nb_addr.address).ip)
+    position = bisect.bisect_left(ip_ints, ip_int)
+    # Same IP can be in Netbox more than once (i.e. different VRFs), those are in id order
+    while position < len(ip_ints) and ip_ints[position] == ip_int and nb_addrs[position].id < nb_addr.id:
+        position += 1
+    return position
+
+
+def get_addr_index(version):
+    """ Returns sorted list of integer IPs of given version, and list of IP objects in the
+        same order, so all IPs within a network can be found with a binary search """
+    with lock:
+        if not addr_index:
+            for ip_version in [4, 6]:
+                addr_index[ip_version] = ([], [])
+            ip_addrs = {addr_id: ipaddress.ip_interface(nb_addr.address).ip for addr_id, nb_addr in indexed_addrs.items()}
+            for addr_id in sorted(ip_addrs, key=lambda addr_id: (ip_addrs[addr_id].version, int(ip_addrs[addr_id]), addr_id)):
+                addr_index[ip_addrs[addr_id].version][0].append(int(ip_addrs[addr_id]))
+                addr_index[ip_addrs[addr_id].version][1].append(indexed_addrs[addr_id])
+        return addr_index[version]
+
+
+def int_key(nb_device):
+    """ Interfaces of a virtual chassis are all listed under the master device """
+    if nb_device is None:
+        return None
+    if nb_device.virtual_chassis:
+        return nb_device.virtual_chassis.master.id
+    return nb_device.id
+
+
+def get_device(device_id):
+    if device_id not in devices_by_id:
+        devices_by_id[device_id] = nb_get(nb.dcim.devices, device_id)
+    return devices_by_id[device_id]
+
+
+def get_interface(int_id):
+    if int_id not in interfaces_by_id:
+        interfaces_by_id[int_id] = nb_get(nb.dcim.interfaces, int_id)
+    return interfaces_by_id[int_id]
+
+
+def get_device_ints(nb_device):
+    """ Returns list of enabled interfaces for device, or the VC it is part of """
+    with lock:
+        if int_key(nb_device) not in device_ints:
+            load_device_data([nb_device])
+    return [interface for interface in device_ints[int_key(nb_device)].values() if interface.enabled]
+
+
+def get_int_indexes(nb_device):
+    """ Returns dict of interface indexes for device, building them the first time """
+    with lock:
+        if int_key(nb_device) not in int_indexes:
+            indexes = {'ints': {}, 'lag_members': {}, 'subints': {}}
+            for interface in get_device_ints(nb_device):
+                indexes['ints'][interface.name] = interface
+                if interface.lag is not None:
+                    indexes['lag_members'].setdefault(interface.lag.name, []).append(interface)
+                name_parts = interface.name.split(".")
+                for i in range(1, len(name_parts)):
+                    indexes['subints'].setdefault(".".join(name_parts[:i]), []).append(interface.name)
+            int_indexes[int_key(nb_device)] = indexes
+    return int_indexes[int_key(nb_device)]
+
+
+def get_address(addr_id):
+    if addr_id not in addrs_by_id:
+        addrs_by_id[addr_id] = nb_get(nb.ipam.ip_addresses, addr_id)
+    return addrs_by_id[addr_id]
+
+
+def get_int_addrs(int_id):
+    """ Returns list of Netbox IP objects assigned to interface """
+    if int_id not in int_addrs:
+        int_addrs[int_id] = nb_filter(nb.ipam.ip_addresses, interface_id=int_id)
+    return int_addrs[int_id]
+
+
+def get_network_addrs(network):
+    """ Returns list of Netbox IP objects within network, in address order like Netbox """
+    network = ipaddress.ip_network(network)
+    with lock:
+        if str(network) not in loaded_networks:
+            add_addrs(nb_filter(nb.ipam.ip_addresses, parent=str(network)), index_ints=False)
+            loaded_networks.add(str(network))
+
+        ip_ints, nb_addrs = get_addr_index(network.version)
+        start = bisect.bisect_left(ip_ints, int(network.network_address))
+        end = bisect.bisect_right(ip_ints, int(network.broadcast_address))
+        return nb_addrs[start:end]
+
+
+def get_fhrp_assignments(int_id):
+    if int_id not in fhrp_assignments:
+        with lock:
+            if int_id not in fhrp_assignments:
+                load_fhrp_groups(nb_filter(nb.ipam.fhrp_group_assignments, interface_id=int_id))
+                fhrp_assignments.setdefault(int_id, [])
+    return fhrp_assignments[int_id]
+
+
+def get_termination_circuit(term_id):
+    """ Returns circuit object for a circuit termination """
+    if term_id not in circuit_terms:
+        circuit_terms[term_id] = nb_get(nb.circuits.circuit_terminations, term_id)
+    circuit_id = circuit_terms[term_id].circuit.id
+    if circuit_id not in circuits:
+        circuits[circuit_id] = nb_get(nb.circuits.circuits, circuit_id)
+    return circuits[circuit_id]
+
+
+def get_front_port_rear(front_port_id):
+    """ Returns rear port mapped to a front port """
+    if front_port_id not in front_ports:
+        front_ports[front_port_id] = nb_get(nb.dcim.front_ports, front_port_id)
+    rear_port_id = front_ports[front_port_id].rear_port.id
+    if rear_port_id not in rear_ports:
+        rear_ports[rear_port_id] = nb_get(nb.dcim.rear_ports, rear_port_id)
+    return rear_ports[rear_port_id]
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+
+import argparse
+import ctypes
+import os
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+try:
+    from pyroute2 import IPRoute, NetlinkError
+except ImportError:
+    IPRoute = None
+
+import clab_snapshot
+import clab_write
+
+# Applies the netlink config for each lab node directly, as an alternative to the 'ip -batch'
+# files run by the start script.  The same ops are used (clab_write.get_netlink_ops()), but each
+# node's are sent over a single pyroute2 netlink socket opened inside its netns, without running
+# any processes.  Worker threads each switch into the netns of the node they are working on with
+# setns(), which only affects the calling thread, so nodes are set up in parallel.
+#
+# Can be used as a library, i.e. provision(devices, "wmf-lab"), or run as a script after
+# 'clab deploy', reading the devices from the topology snapshot clab_gen.py saved.
+
+CLONE_NEWNET = 0x40000000
+IFF_UP = 0x1
+# Seconds to wait for a node's links to be ready, and to wait before each retry of address adds
+READY_TIMEOUT = 60
+ADDR_RETRY_DELAYS = [1, 2, 3]
+# Ops a node is failed for if they don't work, as in the start script.  Others failing (i.e.
+# deleting a default route that isn't there) are only reported.
+REQUIRED_OPS = ["addr_add", "bridge_add", "vlan_add"]
+libc = ctypes.CDLL(None, use_errno=True)
+
+
+@dataclass
+class NodeResult:
+    name: str
+    seconds: float = 0
+    wait_seconds: float = 0
+    ops: int = 0
+    retries: int = 0
+    errors: list = field(default_factory=list)
+    warnings: list = field(default_factory=list)
+
+
+def main():
+    global READY_TIMEOUT
+    parser = argparse.ArgumentParser(description='Configure interfaces, addresses and routes in clab node namespaces')
+    parser.add_argument('-n', '--name', help='Name of clab project (default: wmf-lab)', type=str, default="wmf-lab")
+    parser.add_argument('-j', '--jobs', help='Number of nodes to configure in parallel (default: 4)', type=int, default=4)
+    parser.add_argument('-t', '--ready-timeout', help=f'Seconds to wait for a node\'s links to be ready (default: {READY_TIMEOUT})',
+                        type=int, default=READY_TIMEOUT)
+    parser.add_argument('-s', '--snapshot', help='Topology snapshot saved by clab_gen.py', type=str,
+                        default=f"../{clab_snapshot.SNAPSHOT_FILE}")
+    args = parser.parse_args()
+
+    READY_TIMEOUT = args.ready_timeout
+    devices = clab_snapshot.load_snapshot(args.snapshot)[0]
+    results = provision(devices, args.name, jobs=args.jobs)
+    print_results(results)
+    if any(result.errors for result in results.values()):
+        sys.exit(1)
+
+
+def provision(devices, lab_name, dns_resolvers=None, jobs=4):
+    """ Configures each device in its netns 'clab-<lab_name>-<device>', jobs at a time.  Returns
+        NodeResult for each device, in device order. """
+    if IPRoute is None:
+        print("pyroute2 is needed to provision nodes directly, install it with 'pip3 install pyroute2'.")
+        sys.exit(1)
+    if dns_resolvers is None:
+        dns_resolvers = clab_write.get_dns_resolvers()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {device_name: executor.submit(provision_node, f"clab-{lab_name}-{device_name}", device_name,
+                                                device_vars, dns_resolvers)
+                   for device_name, device_vars in devices.items()}
+    return {device_name: future.result() for device_name, future in futures.items()}
+
+
+def provision_node(netns_name, device_name, device_vars, dns_resolvers):
+    """ Applies a device's netlink ops inside its netns, carrying on past any that fail """
+    result = NodeResult(device_name)
+    start = time.perf_counter()
+    ops = clab_write.get_netlink_ops(device_vars, dns_resolvers)
+    # As with the batch files, bridge vlan changes go last, once the ports / irb exist
+    ops.sort(key=lambda op: op[0].startswith("bridge_vlan_"))
+
+    host_netns = os.open("/proc/thread-self/ns/net", os.O_RDONLY)
+    try:
+        set_netns(f"/run/netns/{netns_name}")
+        # Disable proxy arp cos it's evil
+        with open("/proc/sys/net/ipv4/conf/all/arp_ignore", 'w') as sysctl_file:
+            sysctl_file.write("2")
+        with IPRoute() as ipr:
+            wait_start = time.perf_counter()
+            for link_name in wait_for_links(ipr, clab_write.get_node_links(device_vars)):
+                result.errors.append((("wait", link_name), f"not ready after {READY_TIMEOUT}s"))
+            result.wait_seconds = time.perf_counter() - wait_start
+            retry_ops = []
+            for op in ops:
+                try:
+                    apply_op(ipr, op)
+                except (NetlinkError, LookupError, ValueError) as e:
+                    # IPv6 address adds can fail if too soon after the link came up, so try again
+                    if op[0] == "addr_add" and ipr.link_lookup(ifname=op[1]):
+                        retry_ops.append(op)
+                    elif op[0] in REQUIRED_OPS or op[0].startswith("bridge_vlan_"):
+                        result.errors.append((op, str(e)))
+                    else:
+                        result.warnings.append((op, str(e)))
+                result.ops += 1
+            for delay in ADDR_RETRY_DELAYS:
+                if not retry_ops:
+                    break
+                time.sleep(delay)
+                result.retries += 1
+                retry_ops = [op for op in retry_ops if not try_op(ipr, op)]
+            for op in retry_ops:
+                result.errors.append((op, "still failing after retries"))
+    except OSError as e:
+        result.errors.append((("netns", netns_name), str(e)))
+    finally:
+        set_netns(host_netns)
+        os.close(host_netns)
+
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def wait_for_links(ipr, link_names):
+    """ Waits for links to exist, be up and have IPv6 initialised, checking every 50ms backing off
+        to 1s.  Returns any still not ready after READY_TIMEOUT. """
+    start = time.perf_counter()
+    delay = 0.05
+    for link_num, link_name in enumerate(link_names):
+        while not link_ready(ipr, link_name):
+            if time.perf_counter() - start > READY_TIMEOUT:
+                return link_names[link_num:]
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+    return []
+
+
+def link_ready(ipr, link_name):
+    indexes = ipr.link_lookup(ifname=link_name)
+    if not indexes:
+        return False
+    return bool(ipr.get_links(indexes[0])[0]['flags'] & IFF_UP) and os.path.isdir(f"/proc/sys/net/ipv6/conf/{link_name}")
+
+
+def try_op(ipr, op):
+    try:
+        apply_op(ipr, op)
+        return True
+    except (NetlinkError, LookupError, ValueError):
+        return False
+
+
+def set_netns(netns):
+    """ Moves calling thread to netns, given by path or open fd """
+    netns_fd = os.open(netns, os.O_RDONLY) if isinstance(netns, str) else netns
+    try:
+        if libc.setns(netns_fd, CLONE_NEWNET) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), netns)
+    finally:
+        if netns_fd is not netns:
+            os.close(netns_fd)
+
+
+def apply_op(ipr, op):
+    op_name, dev, *op_args = op
+    if op_name == "bridge_add":
+        ipr.link("add", ifname=dev, kind="bridge", br_vlan_filtering=1, br_vlan_protocol=0x8100,
+                 br_vlan_stats_enabled=1, br_vlan_stats_per_port=1)
+    elif op_name == "vlan_add":
+        ipr.link("add", ifname=op_args[0], kind="vlan", link=get_index(ipr, dev), vlan_id=op_args[1])
+    elif op_name == "route_add" or op_name == "route_del":
+        family = socket.AF_INET6 if ":" in op_args[0] else socket.AF_INET
+        dst = dev
+        if dev == "default":
+            dst = "::/0" if family == socket.AF_INET6 else "0.0.0.0/0"
+        ipr.route(op_name[len("route_"):], dst=dst, gateway=op_args[0], family=family)
+    elif op_name == "addr_add":
+        ipr.addr("add", index=get_index(ipr, dev), address=str(op_args[0].ip_address),
+                 prefixlen=op_args[0].prefixlen)
+    elif op_name == "addr_del":
+        ipr.addr("del", index=get_index(ipr, dev), address=str(op_args[0].ip_address),
+                 prefixlen=op_args[0].prefixlen)
+    elif op_name == "link_del":
+        ipr.link("del", index=get_index(ipr, dev))
+    elif op_name == "link_nomaster":
+        ipr.link("set", index=get_index(ipr, dev), master=0)
+    elif op_name == "addr_flush":
+        ipr.flush_addr(index=get_index(ipr, dev))
+    elif op_name == "link_mtu":
+        ipr.link("set", index=get_index(ipr, dev), mtu=op_args[0])
+    elif op_name == "link_up":
+        ipr.link("set", index=get_index(ipr, dev), state="up")
+    elif op_name == "link_alias":
+        ipr.link("set", index=get_index(ipr, dev), ifalias=op_args[0])
+    elif op_name == "link_master":
+        ipr.link("set", index=get_index(ipr, dev), master=get_index(ipr, op_args[0]))
+    elif op_name == "bridge_vlan_add" or op_name == "bridge_vlan_del":
+        vlan_info = {'vid': op_args[0]}
+        kwargs = {}
+        if op_args[1] == "self":
+            kwargs['vlan_flags'] = "self"
+        elif op_args[1]:
+            vlan_info['flags'] = op_args[1].split()
+        ipr.vlan_filter(op_name[len("bridge_vlan_"):], index=get_index(ipr, dev), vlan_info=vlan_info, **kwargs)
+    else:
+        raise ValueError(f"Unknown netlink op {op_name}")
+
+
+def get_index(ipr, dev):
+    indexes = ipr.link_lookup(ifname=dev)
+    if not indexes:
+        raise LookupError(f"Device {dev} not found")
+    return indexes[0]
+
+
+def print_results(results):
+    for result in results.values():
+        status = f"{len(result.errors)} FAILED" if result.errors else "ok"
+        print(f"{result.name:<24} {result.ops:>5} ops {result.seconds:>8.3f}s  " \
+              f"(ready after {result.wait_seconds:.3f}s, {result.retries} retries)  {status}")
+        for op, error in result.errors:
+            print(f"    {' '.join(str(arg) for arg in op)}: {error}")
+        for op, error in result.warnings:
+            print(f"    {' '.join(str(arg) for arg in op)}: {error} (ignored)")
+    print(f"\n{len(results)} nodes, {sum(1 for result in results.values() if result.errors)} with errors, " \
+          f"{sum(result.seconds for result in results.values()):.3f}s total node time")
+
+
+if __name__ == "__main__":
+    main()
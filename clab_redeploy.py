@@ -0,0 +1,211 @@
+import ipaddress
+import os
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import clab_snapshot
+import clab_write
+
+# Works out what has changed between the lab as last deployed and a newly generated topology,
+# and writes redeploy_<name>.sh to make just those changes to the running lab: containers for
+# added / removed nodes, veth pairs for added / removed links, and the ip / bridge commands to
+# add or remove addresses, vlans, sub-interfaces and routes.  Untouched nodes keep running.
+#
+# The start script (and redeploy script) copy the topology snapshot to DEPLOYED_SNAPSHOT_FILE in
+# the output dir once they have run, which is what the next redeploy compares against.
+
+# Netlink ops that undo others, those not listed (i.e. 'route_del default', 'addr_flush') are
+# one-off setup with nothing to undo
+UNDO_OPS = {
+    'addr_add': "addr_del",
+    'route_add': "route_del",
+    'bridge_vlan_add': "bridge_vlan_del",
+    'link_master': "link_nomaster"
+}
+
+
+@dataclass
+class TopologyDiff:
+    added_nodes: list = field(default_factory=list)
+    removed_nodes: list = field(default_factory=list)
+    added_links: list = field(default_factory=list)
+    removed_links: list = field(default_factory=list)
+    # Per node lists of netlink ops to remove, then add
+    node_ops: dict = field(default_factory=dict)
+
+    def empty(self):
+        return not (self.added_nodes or self.removed_nodes or self.added_links or self.removed_links
+                    or any(del_ops or add_ops for del_ops, add_ops in self.node_ops.values()))
+
+
+def diff_topology(old_devices, old_links, new_devices, new_links, dns_resolvers):
+    """ Compares deployed and new devices / links and returns TopologyDiff.  Nodes whose kind or
+        sub_type changed are replaced rather than changed in place. """
+    diff = TopologyDiff()
+    for device_name, device_vars in old_devices.items():
+        if device_name not in new_devices or not same_node_type(device_vars, new_devices[device_name]):
+            diff.removed_nodes.append(device_name)
+    for device_name, device_vars in new_devices.items():
+        if device_name not in old_devices or device_name in diff.removed_nodes:
+            diff.added_nodes.append(device_name)
+
+    old_link_ends = {link_ends(link): link for link in old_links.values()}
+    new_link_ends = {link_ends(link): link for link in new_links.values()}
+    for ends, link in old_link_ends.items():
+        # Links to removed nodes go with the container
+        if ends not in new_link_ends and not {link.dev_a, link.dev_b} & set(diff.removed_nodes):
+            diff.removed_links.append(link)
+    for ends, link in new_link_ends.items():
+        if ends not in old_link_ends or {link.dev_a, link.dev_b} & set(diff.removed_nodes):
+            diff.added_links.append(link)
+
+    for device_name, device_vars in new_devices.items():
+        new_ops = clab_write.get_netlink_ops(device_vars, dns_resolvers)
+        if device_name in diff.added_nodes:
+            diff.node_ops[device_name] = ([], new_ops)
+            continue
+        old_ops = clab_write.get_netlink_ops(old_devices[device_name], dns_resolvers)
+        # Anything on interfaces of removed links was deleted with them, and interfaces of added
+        # links are new, so they get all their ops
+        gone_devs = link_devs(device_name, diff.removed_links)
+        fresh_devs = gone_devs | link_devs(device_name, diff.added_links)
+        new_op_set, old_op_set = set(new_ops), set(old_ops)
+        # Routes via an address that is deleted, or goes with its link, are removed by the kernel
+        # along with it, so aren't deleted but are re-added if still wanted
+        gone_networks = [ipaddress.ip_interface(str(op[2])).network for op in old_ops if op[0] == "addr_add"
+                         and (op not in new_op_set or on_dev(op, gone_devs))]
+        del_ops = [undo_op(op) for op in reversed(old_ops) if op not in new_op_set and undo_op(op)
+                   and not on_dev(op, gone_devs) and not via_networks(op, gone_networks)]
+        add_ops = [op for op in new_ops if op not in old_op_set or on_dev(op, fresh_devs)
+                   or via_networks(op, gone_networks)]
+        diff.node_ops[device_name] = (del_ops, add_ops)
+
+    return diff
+
+
+def same_node_type(old_device, new_device):
+    return (old_device.kind, old_device.sub_type) == (new_device.kind, new_device.sub_type)
+
+
+def link_ends(link):
+    """ Link endpoints in a consistent order, so the same link is matched whichever way round """
+    return tuple(sorted([(link.dev_a, link.int_a), (link.dev_b, link.int_b)]))
+
+
+def link_devs(device_name, links):
+    """ Names of device_name's interfaces on any of links """
+    return {link.int_a if link.dev_a == device_name else link.int_b
+            for link in links if device_name in (link.dev_a, link.dev_b)}
+
+
+def on_dev(op, dev_names):
+    """ True if op is for one of dev_names, or a vlan sub-interface of one.  Routes are for a
+        destination, not an interface. """
+    if op[0].startswith("route_"):
+        return False
+    return op[1] in dev_names or op[1].split(".")[0] in dev_names
+
+
+def via_networks(op, networks):
+    """ True if op is a route whose gateway is in one of networks """
+    if not op[0].startswith("route_"):
+        return False
+    gateway = ipaddress.ip_address(op[2])
+    return any(gateway.version == network.version and gateway in network for network in networks)
+
+
+def undo_op(op):
+    """ Returns netlink op that reverses op, or None if there's nothing to undo """
+    op_name, dev, *op_args = op
+    if op_name == "vlan_add":
+        return ("link_del", op_args[0])
+    if op_name == "bridge_add":
+        return ("link_del", dev)
+    if op_name == "link_master":
+        return ("link_nomaster", dev)
+    if op_name in UNDO_OPS:
+        return (UNDO_OPS[op_name], dev, *op_args)
+    return None
+
+
+def write_redeploy_script(args, devices, links):
+    """ Writes output/redeploy_<name>.sh to bring the deployed lab in line with devices / links """
+    deployed_file = Path("output") / clab_snapshot.DEPLOYED_SNAPSHOT_FILE
+    if not deployed_file.is_file():
+        print(f"No {deployed_file}, so nothing to compare with.  Deploy the lab with the start script first.")
+        sys.exit(1)
+    old_devices, old_links = clab_snapshot.load_snapshot(deployed_file)[:2]
+    diff = diff_topology(old_devices, old_links, devices, links, clab_write.get_dns_resolvers())
+    print_diff(diff)
+
+    file_name = f"output/redeploy_{args.name}.sh"
+    print(f"Writing redeploy_{args.name}.sh...")
+    with open(file_name, 'w') as out_file:
+        out_file.write("#!/bin/bash\n")
+        out_file.write("set -x\n")
+
+        for device_name in diff.removed_nodes:
+            out_file.write(f"sudo docker rm -f clab-{args.name}-{device_name}\n")
+        for link in diff.removed_links:
+            # Deleting one end of a veth removes the other
+            out_file.write(f"sudo ip -n clab-{args.name}-{link.dev_a} link del {link.int_a}\n")
+
+        if diff.added_nodes:
+            # Links between new nodes are created by clab, links from them to existing ones by us
+            out_file.write(f"sudo clab deploy -t {args.name}.yaml --node-filter {','.join(diff.added_nodes)}\n")
+            out_file.write("../add_fqdn_hosts.py\n")
+        for link in diff.added_links:
+            if link.dev_a in diff.added_nodes and link.dev_b in diff.added_nodes:
+                continue
+            ns_a, ns_b = f"clab-{args.name}-{link.dev_a}", f"clab-{args.name}-{link.dev_b}"
+            out_file.write(f"sudo ip link add {link.int_a} netns {ns_a} mtu 9500 type veth " \
+                           f"peer name {link.int_b} netns {ns_b} mtu 9500\n")
+            out_file.write(f"sudo ip -n {ns_a} link set dev {link.int_a} up\n")
+            out_file.write(f"sudo ip -n {ns_b} link set dev {link.int_b} up\n")
+
+        for device_name, (del_ops, add_ops) in diff.node_ops.items():
+            if not (del_ops or add_ops):
+                continue
+            out_file.write(f"\n# {device_name}\n")
+            if device_name in diff.added_nodes and args.provisioner == "shell":
+                # Set up like the start script does, once its links are ready
+                out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} env READY_TIMEOUT=${{READY_TIMEOUT:-60}} " \
+                               f"sh netlink/setup_node.sh {device_name}\n")
+                continue
+            if device_name in diff.added_nodes:
+                out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
+                               "sysctl -w net.ipv4.conf.all.arp_ignore=2\n")
+            # Removals first, then additions with the bridge vlan ones last as in the start script
+            add_ops = sorted(add_ops, key=lambda op: op[0].startswith("bridge_vlan_"))
+            for op in del_ops + add_ops:
+                tool, cmd = clab_write.netlink_cmd(op)
+                if tool == "ip":
+                    out_file.write(f"sudo ip -n clab-{args.name}-{device_name} {cmd}\n")
+                else:
+                    out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} {tool} {cmd}\n")
+
+        out_file.write(f"\ncp ../{clab_snapshot.SNAPSHOT_FILE} {clab_snapshot.DEPLOYED_SNAPSHOT_FILE}\n")
+    os.chmod(file_name, 0o755)
+
+    changed_crpds = [device_name for device_name in diff.added_nodes if devices[device_name].kind == "crpd"]
+    if changed_crpds:
+        print(f"Once run, apply config to new nodes with homer: {', '.join(changed_crpds)}")
+    print()
+
+
+def print_diff(diff):
+    if diff.empty():
+        print("No changes since lab was deployed.")
+        return
+    for device_name in diff.removed_nodes:
+        print(f"Removing node {device_name}")
+    for device_name in diff.added_nodes:
+        print(f"Adding node {device_name}")
+    for link in diff.removed_links:
+        print(f"Removing link {link.dev_a}:{link.int_a} - {link.dev_b}:{link.int_b}")
+    for link in diff.added_links:
+        print(f"Adding link {link.dev_a}:{link.int_a} - {link.dev_b}:{link.int_b}")
+    for device_name, (del_ops, add_ops) in diff.node_ops.items():
+        if (del_ops or add_ops) and device_name not in diff.added_nodes:
+            print(f"Changing {device_name}: {len(del_ops)} removals, {len(add_ops)} additions")
@@ -1,98 +1,214 @@
 from pathlib import Path
-import os
-import yaml
+import hashlib
+import json
+import shutil
+import subprocess
+import sys
 import ipaddress
 
-def prep_homer_repo():
-    """ Clones homer public repo and makes some modifications to allow it to work with crpd rather
-        than MX. """
-    # clone the repo using git
-    clone_homer_repo()
+import clab_trace
+import clab_yaml
 
-    # Remove capirca key from devices and roles so firewall filters won't be generated
-    remove_capirca_key("operations-homer-public/config/devices.yaml")
-    remove_capirca_key("operations-homer-public/config/roles.yaml")
+# Bare mirrors of the homer repos are kept in mirror_dir and updated with a fetch, and the
+# patched working copies are only re-created when the upstream commits or our templates change.
+# homer_source can be a local directory holding <repo>.git bare repos, to work without network.
+HOMER_REPOS = ["operations-homer-public", "operations-homer-mock-private"]
+mirror_dir = Path("homer_mirror")
+homer_source = "https://github.com/wikimedia"
 
-    # Remove prefix-lists from common-prefix-lists.conf with incompatible 'apply-groups'
-    remove_pfx_list = ['loopback4', 'loopback6', 'system-ntp']
-    remove_prefix_lists_j2file('operations-homer-public/templates/includes/policies/common-prefix-lists.conf', remove_pfx_list)
-    # Same for cr/policy-options.conf
-    remove_prefix_lists_j2file('operations-homer-public/templates/cr/policy-options.conf', ['system-nameservers'])
 
+# Changes made to the homer public repo so it works with crpd rather than MX, as a list of edits
+# for each file.  Every file is read once, all its edits applied in order, and the result written
+# to a temp file and renamed into place.  Files whose edits and upstream content are unchanged
+# since the last run are left alone.
+HOMER_PATCHES = {
+    # Remove capirca key from devices and roles so firewall filters won't be generated
+    "operations-homer-public/config/devices.yaml": [("remove_yaml_key", "capirca")],
+    "operations-homer-public/config/roles.yaml": [("remove_yaml_key", "capirca")],
+    # Remove prefix-lists with incompatible 'apply-groups'
+    "operations-homer-public/templates/includes/policies/common-prefix-lists.conf": [
+        ("remove_prefix_lists", ['loopback4', 'loopback6', 'system-ntp'])],
+    "operations-homer-public/templates/cr/policy-options.conf": [("remove_prefix_lists", ['system-nameservers'])],
     # Replace top-level cr.conf template with crpd template
-    os.system("rm -f operations-homer-public/templates/cr.conf && cp templates/crpd.j2 operations-homer-public/templates/cr.conf")
+    "operations-homer-public/templates/cr.conf": [("replace_with", "templates/crpd.j2")],
     # Replace OSPF template with custom one (no BFD and adjust interface names)
-    os.system("rm -f operations-homer-public/templates/common/ospf.conf && cp templates/ospf.j2 operations-homer-public/templates/common/ospf.conf")
+    "operations-homer-public/templates/common/ospf.conf": [("replace_with", "templates/ospf.j2")],
     # Replace routing-options with one that just covers aggregates, no RPKI etc.
-    os.system("rm -f operations-homer-public/templates/cr/routing-options.conf && cp templates/routing-options.j2 operations-homer-public/templates/cr/routing-options.conf")
+    "operations-homer-public/templates/cr/routing-options.conf": [("replace_with", "templates/routing-options.j2")]
+}
+# Bump if what the edit functions below do changes, so files are re-patched
+PATCH_VERSION = 1
+
+
+def prep_homer_repo():
+    """ Clones homer public repo and makes some modifications to allow it to work with crpd rather
+        than MX. """
+    # Bring mirrors up to date, and re-create working copies if upstream has moved on
+    repo_shas = update_homer_mirrors()
+    key_file = mirror_dir / "checkout_key"
+    if all(Path(repo).is_dir() for repo in HOMER_REPOS) and key_file.is_file() and key_file.read_text() == " ".join(repo_shas):
+        print("Homer repos unchanged since last run, using existing checkout.")
+    else:
+        # Remove key first, so an interrupted clone is re-done next time
+        key_file.unlink(missing_ok=True)
+        clone_homer_repo()
+        key_file.write_text(" ".join(repo_shas))
+
+    with clab_trace.phase("homer patch"):
+        patch_homer_repo()
 
     yaml_data = {}
     # Load data from YAML files so it's available to us
-    with open('operations-homer-public/config/devices.yaml', 'r') as yaml_file:
-        yaml_data['devices'] = yaml.safe_load(yaml_file)
-    with open('operations-homer-public/config/common.yaml', 'r') as yaml_file:
-        yaml_data['common'] = yaml.safe_load(yaml_file)
-    with open('operations-homer-public/config/sites.yaml', 'r') as yaml_file:
-        yaml_data['sites'] = yaml.safe_load(yaml_file)
-    with open('operations-homer-public/config/roles.yaml', 'r') as yaml_file:
-        yaml_data['roles'] = yaml.safe_load(yaml_file)
+    with clab_trace.phase("homer yaml load"):
+        for file_name in ['devices', 'common', 'sites', 'roles']:
+            yaml_data[file_name] = clab_yaml.load_file(f'operations-homer-public/config/{file_name}.yaml')
 
     return yaml_data
 
 
-def clone_homer_repo():
-    if Path('operations-homer-public').is_dir():
-        print("Deleting existing homer public repo directory...")
-        os.system("rm -Rf operations-homer-public")
+def patch_homer_repo():
+    """ Applies HOMER_PATCHES to the working copy.  State kept in patch_state.json records, for
+        each file, the hash of the edits, and of the file before and after they were applied. """
+    state_file = mirror_dir / "patch_state.json"
+    try:
+        patch_state = json.loads(state_file.read_text())
+    except FileNotFoundError:
+        patch_state = {}
+
+    patched = 0
+    for file_name, edits in HOMER_PATCHES.items():
+        file_path = Path(file_name)
+        edits_hash = get_edits_hash(edits)
+        # Templates we replace don't have to exist upstream
+        content = file_path.read_bytes() if file_path.is_file() else b""
+        file_state = patch_state.get(file_name)
+        if file_state and file_state['output'] == sha256(content):
+            if file_state['edits'] == edits_hash:
+                continue
+            # We patched this before with different edits, start again from upstream version
+            content = get_upstream_file(file_name)
+        elif file_state:
+            # Changed since we patched it, put it back how it was upstream first
+            print(f"{file_name} modified since last patched, restoring from repo...")
+            content = get_upstream_file(file_name)
+
+        print(f"Patching {file_name}...")
+        input_hash = sha256(content)
+        text = content.decode()
+        for edit_name, edit_arg in edits:
+            text = PATCH_EDITS[edit_name](text, edit_arg)
+        write_atomic(file_path, text.encode())
+        patch_state[file_name] = {'edits': edits_hash, 'input': input_hash, 'output': sha256(text.encode())}
+        patched += 1
+
+    write_atomic(state_file, json.dumps(patch_state, indent=2).encode())
+    if not patched:
+        print("Homer repo already patched for crpd, nothing to do.")
+    print()
+
 
-    if Path('operations-homer-mock-private').is_dir():
-        print("Deleting existing homer mock private repo directory...\n")
-        os.system("rm -Rf operations-homer-mock-private")
+def get_edits_hash(edits):
+    """ Hash of the edits for a file, plus contents of any of our templates they copy in """
+    edits_hash = hashlib.sha256(f"{PATCH_VERSION} {edits!r}".encode())
+    for edit_name, edit_arg in edits:
+        if edit_name == "replace_with":
+            edits_hash.update(Path(edit_arg).read_bytes())
+    return edits_hash.hexdigest()
 
+
+def get_upstream_file(file_name):
+    """ Returns unmodified content of a file in the working copy of one of the homer repos """
+    repo, repo_path = file_name.split("/", 1)
+    return subprocess.run(["git", "-C", repo, "show", f"HEAD:{repo_path}"], capture_output=True).stdout
+
+
+def sha256(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def write_atomic(file_path, content):
+    """ Writes to temp file beside the target and renames it over it """
+    tmp_file = file_path.with_name(f".{file_path.name}.tmp")
+    tmp_file.write_bytes(content)
+    tmp_file.replace(file_path)
+
+
+def update_homer_mirrors():
+    """ Creates or fetches into local mirror of each homer repo, returns their HEAD commits """
+    mirror_dir.mkdir(exist_ok=True)
+    repo_shas = []
+    for repo in HOMER_REPOS:
+        mirror = mirror_dir / f"{repo}.git"
+        if mirror.is_dir():
+            with clab_trace.phase(f"git fetch {repo}"):
+                fetch = run_git("-C", str(mirror), "fetch", "--prune", "origin")
+            if fetch.returncode != 0:
+                print(f"Fetching {repo} failed, using mirror as last fetched:\n{fetch.stderr}")
+        else:
+            with clab_trace.phase(f"git clone {repo}"):
+                if run_git("clone", "--mirror", f"{homer_source}/{repo}", str(mirror)).returncode != 0:
+                    print(f"Cannot clone {repo} from {homer_source}.")
+                    sys.exit(1)
+        repo_shas.append(run_git("-C", str(mirror), "rev-parse", "HEAD").stdout.strip())
+    return repo_shas
+
+
+def run_git(*git_args):
     # Not verifying TLS as running on a machine with incorrect time to fool crpd license
-    os.system("git -c http.sslVerify=false clone --depth 1 https://github.com/wikimedia/operations-homer-public")
-    print()
-    os.system("git -c http.sslVerify=false clone --depth 1 https://github.com/wikimedia/operations-homer-mock-private")
-    print()
+    return subprocess.run(["git", "-c", "http.sslVerify=false", *git_args], capture_output=True, text=True)
 
 
-def remove_capirca_key(filename):
-    """ Loads data from YAML file, removes dict keys with value 'capirca' and re-writes """
-
-    with open(filename, "r") as yaml_file:
-        data = yaml.safe_load(yaml_file)
-        for element_name, element_values in data.items():
-            try:
-                del data[element_name]['capirca']
-            except KeyError:
-                pass
-            if "config" in element_values.keys():
-                try:
-                    del data[element_name]['config']['capirca']
-                except KeyError:
-                    pass
-
-    with open(filename, "w") as new_file:
-        print(f"Removing capirca defs from {filename}...")
-        yaml.dump(data, new_file)
-
-
-def remove_prefix_lists_j2file(filename, pfx_lists):
-    """ Interates over Jinja2 template and removes prefix-list definitions with names
-        matching those in array pfx_lists[]. """
-
-    with open('/tmp/new_file', "w") as new_file:
-        write_lines = True
-        with open(filename, 'r') as old_file:
-            for line in old_file.readlines():
-                if line.startswith("prefix-list") and line.split()[1] in pfx_lists:
-                    write_lines = False
-                if write_lines:
-                    new_file.write(line)
-                elif line.startswith("}"):
-                    write_lines = True
-
-    os.system(f"rm -fv {filename} && mv -v /tmp/new_file {filename}")
+def clone_homer_repo():
+    """ Re-creates working copies of the homer repos from the local mirrors """
+    # Files in the new copies are all unpatched
+    (mirror_dir / "patch_state.json").unlink(missing_ok=True)
+    for repo in HOMER_REPOS:
+        if Path(repo).is_dir():
+            print(f"Deleting existing {repo} directory...")
+            shutil.rmtree(repo)
+        print(f"Cloning {repo} from local mirror...")
+        with clab_trace.phase(f"git checkout {repo}"):
+            clone = run_git("clone", "--depth", "1", f"file://{(mirror_dir / f'{repo}.git').resolve()}", repo)
+        if clone.returncode != 0:
+            # Exiting before the checkout key is written, so the clone is re-done next run
+            print(f"Cannot clone {repo} from local mirror:\n{clone.stderr}")
+            sys.exit(1)
+
+
+def remove_yaml_key(text, key_name):
+    """ Removes key from each top-level element of YAML doc, and from their 'config' dicts """
+    data = clab_yaml.load(text)
+    for element_name, element_values in data.items():
+        element_values.pop(key_name, None)
+        if "config" in element_values.keys():
+            element_values['config'].pop(key_name, None)
+    return clab_yaml.dump(data)
+
+
+def remove_prefix_lists(text, pfx_lists):
+    """ Removes prefix-list definitions in Jinja2 template with names matching those in pfx_lists[] """
+    new_lines = []
+    write_lines = True
+    for line in text.splitlines(keepends=True):
+        if line.startswith("prefix-list") and line.split()[1] in pfx_lists:
+            write_lines = False
+        if write_lines:
+            new_lines.append(line)
+        elif line.startswith("}"):
+            write_lines = True
+    return "".join(new_lines)
+
+
+def replace_with(text, template_file):
+    """ Replaces whole file with one of our templates """
+    return Path(template_file).read_text()
+
+
+PATCH_EDITS = {
+    'remove_yaml_key': remove_yaml_key,
+    'remove_prefix_lists': remove_prefix_lists,
+    'replace_with': replace_with
+}
 
 
 def get_device_transits(yaml_data):
@@ -0,0 +1,231 @@
+import json
+import ipaddress
+import os
+import sys
+from collections.abc import Mapping
+from datetime import datetime, timezone
+
+import clab_model
+
+# Snapshot of the data clab_gen.py gathers, so the output files can be re-written without going
+# back to Netbox / homer.  Only plain data is stored, never library objects, so a snapshot keeps
+# working across pynetbox upgrades.
+#
+# The file is newline-delimited JSON.  The first line is a header:
+#
+#   {"format": "wmf-clab-snapshot", "version": 1, "created": "<UTC time>",
+#    "sections": {"<name>": {"offset": <bytes>, "length": <bytes>, "count": <records>}, ...}}
+#
+# Offsets are counted from the start of the line after the header.  Each section is 'count'
+# lines, one JSON record per line:
+#
+#   devices          {"name", "kind", "sub_type", "fqdn", "phys_ints": [...], "subints": [...],
+#                     "irb_ints": {name: [addrs]}, "loop_addrs": [addrs], "bgp_groups": [[AS, group]]}
+#                    with addresses as "ip/prefixlen" strings
+#   links            {"id": [dev_a, int_a, dev_b, int_b], "dev_a", "int_a", "dev_b", "int_b", "descr"}
+#   yaml_data        [key, value] for each top-level key of the parsed homer yaml
+#   device_transits  [device name, {peer IP: {"provider", "AS"}}]
+#
+# Dicts in yaml_data with keys JSON can't hold (e.g. ints) are written as {"__pairs__": [[key, value]]}.
+# Sections are only read and decoded when first used, so re-writing the output doesn't pay for
+# parsing data it doesn't look at.  Bump SNAPSHOT_VERSION if the record layout changes.
+
+SNAPSHOT_FILE = "topology_snapshot.ndjson"
+# Copy of the snapshot in the output dir, made by the start script, for the lab as deployed
+DEPLOYED_SNAPSHOT_FILE = "deployed_snapshot.ndjson"
+SNAPSHOT_FORMAT = "wmf-clab-snapshot"
+SNAPSHOT_VERSION = 1
+
+
+class LazySection(Mapping):
+    """ Read-only dict of a snapshot section, read from the file the first time it is used """
+    def __init__(self, snapshot, name):
+        self.snapshot = snapshot
+        self.name = name
+        self.data = None
+
+    def load(self):
+        if self.data is None:
+            self.data = self.snapshot.read_section(self.name)
+        return self.data
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        # Number of records is in the header, so no need to read the section for it
+        if self.data is None:
+            return self.snapshot.sections[self.name]['count']
+        return len(self.data)
+
+    def __repr__(self):
+        return repr(self.load())
+
+
+class Snapshot:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        try:
+            with open(file_name, 'rb') as snap_file:
+                header_line = snap_file.readline()
+        except FileNotFoundError:
+            print(f"Snapshot file {file_name} not found, run without --load-snapshot to create it.")
+            sys.exit(1)
+
+        header = json.loads(header_line)
+        if header.get('format') != SNAPSHOT_FORMAT or header.get('version') != SNAPSHOT_VERSION:
+            print(f"{file_name} is not a version {SNAPSHOT_VERSION} snapshot, run without --load-snapshot " \
+                  "to re-create it.")
+            sys.exit(1)
+
+        self.data_start = len(header_line)
+        self.sections = header['sections']
+
+    def read_section(self, name):
+        section = self.sections[name]
+        with open(self.file_name, 'rb') as snap_file:
+            snap_file.seek(self.data_start + section['offset'])
+            lines = snap_file.read(section['length']).splitlines()
+        return DECODERS[name](json.loads(line) for line in lines)
+
+
+def save_snapshot(devices, links, yaml_data, device_transits, file_name=SNAPSHOT_FILE):
+    """ Writes snapshot file, via a temp file so a failed run doesn't leave a broken one """
+    sections = {}
+    body = []
+    offset = 0
+    for name, records in [
+        ("devices", [encode_device(device) for device in devices.values()]),
+        ("links", [encode_link(link_id, link) for link_id, link in links.items()]),
+        ("yaml_data", [[key, encode_yaml(value)] for key, value in yaml_data.items()]),
+        ("device_transits", [[device_name, {str(peer_ip): peer_vars for peer_ip, peer_vars in transits.items()}]
+                             for device_name, transits in device_transits.items()])
+    ]:
+        lines = b"".join(json.dumps(record, separators=(',', ':')).encode() + b"\n" for record in records)
+        sections[name] = {'offset': offset, 'length': len(lines), 'count': len(records)}
+        body.append(lines)
+        offset += len(lines)
+
+    header = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'created': datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        'sections': sections
+    }
+    tmp_name = f".{file_name}.tmp"
+    with open(tmp_name, 'wb') as snap_file:
+        snap_file.write(json.dumps(header).encode() + b"\n")
+        snap_file.writelines(body)
+    os.replace(tmp_name, file_name)
+
+
+def load_snapshot(file_name=SNAPSHOT_FILE):
+    """ Returns devices, links, yaml_data and device_transits from snapshot.  Nothing past the
+        header is read until each is used. """
+    snapshot = Snapshot(file_name)
+    return [LazySection(snapshot, name) for name in ["devices", "links", "yaml_data", "device_transits"]]
+
+
+def encode_device(device):
+    return {
+        'name': device.name,
+        'kind': device.kind,
+        'sub_type': device.sub_type,
+        'fqdn': device.fqdn,
+        'phys_ints': [{
+            'name': interface.name,
+            'clab_dev': interface.clab_dev,
+            'descr': interface.descr,
+            'addrs': [str(address) for address in interface.addrs],
+            'vlans': interface.vlans,
+            'access_vlan': interface.access_vlan
+        } for interface in device.phys_ints.values()],
+        'subints': [{
+            'name': subint.name,
+            'clab_dev': subint.clab_dev,
+            'subint_dev': subint.subint_dev,
+            'vlan_id': subint.vlan_id,
+            'addrs': [str(address) for address in subint.addrs]
+        } for subint in device.subints.values()],
+        'irb_ints': {irb_name: [str(address) for address in irb_addrs]
+                     for irb_name, irb_addrs in device.irb_ints.items()},
+        'loop_addrs': [str(address) for address in device.loop_addrs],
+        # Keyed on AS number, so kept as a list of pairs to keep ints as ints
+        'bgp_groups': [[local_as, group] for local_as, group in device.bgp_groups.items()]
+    }
+
+
+def decode_devices(records):
+    devices = {}
+    for data in records:
+        device = clab_model.make_device(data['name'], data['kind'], data['sub_type'], data['fqdn'])
+        for int_data in data['phys_ints']:
+            device.phys_ints[int_data['name']] = clab_model.Interface(int_data['name'], int_data['clab_dev'],
+                int_data['descr'], decode_addrs(int_data['addrs']), int_data['vlans'], int_data['access_vlan'])
+        for subint_data in data['subints']:
+            device.subints[subint_data['name']] = clab_model.SubInterface(subint_data['name'],
+                subint_data['clab_dev'], subint_data['subint_dev'], subint_data['vlan_id'],
+                decode_addrs(subint_data['addrs']))
+        for irb_name, irb_addrs in data['irb_ints'].items():
+            device.irb_ints[irb_name] = decode_addrs(irb_addrs)
+        device.loop_addrs = decode_addrs(data['loop_addrs'])
+        device.bgp_groups = {local_as: group for local_as, group in data['bgp_groups']}
+        devices[device.name] = device
+    return devices
+
+
+def decode_addrs(addrs):
+    return [clab_model.make_address(address) for address in addrs]
+
+
+def encode_link(link_id, link):
+    return {
+        'id': list(link_id),
+        'dev_a': link.dev_a,
+        'int_a': link.int_a,
+        'dev_b': link.dev_b,
+        'int_b': link.int_b,
+        'descr': link.descr
+    }
+
+
+def decode_links(records):
+    return {tuple(data['id']): clab_model.Link(data['dev_a'], data['int_a'], data['dev_b'], data['int_b'],
+                                               data['descr']) for data in records}
+
+
+def encode_yaml(value):
+    """ Makes parsed yaml safe to write as JSON without changing key types """
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value):
+            return {key: encode_yaml(item) for key, item in value.items()}
+        return {'__pairs__': [[key, encode_yaml(item)] for key, item in value.items()]}
+    if isinstance(value, list):
+        return [encode_yaml(item) for item in value]
+    return value
+
+
+def decode_yaml(value):
+    if isinstance(value, dict):
+        if list(value.keys()) == ['__pairs__']:
+            return {key: decode_yaml(item) for key, item in value['__pairs__']}
+        return {key: decode_yaml(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_yaml(item) for item in value]
+    return value
+
+
+def decode_transits(records):
+    return {device_name: {ipaddress.ip_address(peer_ip): peer_vars for peer_ip, peer_vars in transits.items()}
+            for device_name, transits in records}
+
+
+DECODERS = {
+    "devices": decode_devices,
+    "links": decode_links,
+    "yaml_data": lambda records: {key: decode_yaml(value) for key, value in records},
+    "device_transits": decode_transits
+}
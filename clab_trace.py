@@ -0,0 +1,127 @@
+import json
+import resource
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# Timing of the phases of a lab build, plus counts of Netbox requests and NETCONF RPCs.  Phases
+# are timed with 'with clab_trace.phase(name):' (or as a decorator), and the results printed
+# as a summary and / or saved in Chrome trace-event format, which chrome://tracing or
+# https://ui.perfetto.dev can open.
+
+start = time.perf_counter()
+events = []
+phases = {}
+nb_requests = Counter()
+rpcs = Counter()
+rpc_seconds = Counter()
+lock = threading.Lock()
+
+
+def now_us():
+    return int((time.perf_counter() - start) * 1000000)
+
+
+@contextmanager
+def phase(name, category="phase"):
+    """ Records the time taken by the block as a trace event, and adds it to the phase totals """
+    begin = now_us()
+    try:
+        yield
+    finally:
+        add_event(name, category, begin, now_us() - begin)
+
+
+def add_event(name, category, begin, duration):
+    with lock:
+        events.append({'name': name, 'cat': category, 'ph': "X", 'ts': begin, 'dur': duration, 'pid': 1,
+                       'tid': threading.get_ident()})
+        totals = phases.setdefault((category, name), {'calls': 0, 'seconds': 0})
+        totals['calls'] += 1
+        totals['seconds'] += duration / 1000000
+        events.append({'name': "peak RSS (MB)", 'ph': "C", 'ts': begin + duration, 'pid': 1,
+                       'args': {'self': peak_rss() / 2**20}})
+
+
+def trace_http_session(session):
+    """ Counts and times each request made through a requests session, by API endpoint """
+    def response_hook(response, *args, **kwargs):
+        endpoint = endpoint_name(response.request.url)
+        elapsed = int(response.elapsed.total_seconds() * 1000000)
+        with lock:
+            nb_requests[endpoint] += 1
+        add_event(endpoint, "netbox", now_us() - elapsed, elapsed)
+
+    session.hooks['response'].append(response_hook)
+
+
+def trace_junos_device(device):
+    """ Wraps PyEZ Device.execute(), which every RPC goes through, to count / time RPCs by device """
+    execute = device.execute
+
+    def traced_execute(rpc_cmd, *args, **kwargs):
+        rpc_name = getattr(rpc_cmd, 'tag', str(rpc_cmd))
+        begin = now_us()
+        try:
+            return execute(rpc_cmd, *args, **kwargs)
+        finally:
+            duration = now_us() - begin
+            with lock:
+                rpcs[(device.hostname, rpc_name)] += 1
+                rpc_seconds[device.hostname] += duration / 1000000
+            add_event(f"{device.hostname} {rpc_name}", "netconf", begin, duration)
+
+    device.execute = traced_execute
+    return device
+
+
+def endpoint_name(url):
+    """ 'https://netbox/api/dcim/interfaces/?device_id=1' -> 'dcim/interfaces' """
+    path = urlsplit(url).path.strip("/").split("/")
+    if path[0] == "api":
+        path = path[1:]
+    return "/".join(path[:2])
+
+
+def peak_rss():
+    """ Peak resident memory in bytes of this process, or of any child (i.e. git) if higher """
+    # ru_maxrss is in KB on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+def print_summary():
+    if any(category == "phase" for category, name in phases):
+        print(f"{'Phase':<48} {'Calls':>6} {'Seconds':>9}")
+        for (category, name), totals in phases.items():
+            if category == "phase":
+                print(f"{name:<48} {totals['calls']:>6} {totals['seconds']:>9.3f}")
+    if nb_requests:
+        print(f"\nNetbox requests: {sum(nb_requests.values())}")
+        for endpoint, count in sorted(nb_requests.items()):
+            print(f"    {endpoint:<44} {count:>6}")
+    if rpcs:
+        print(f"\nNETCONF RPCs: {sum(rpcs.values())}")
+        for device_name, count in sorted(Counter(device_name for device_name, rpc in rpcs.elements()).items()):
+            print(f"    {device_name:<44} {count:>6} {rpc_seconds[device_name]:>9.3f}")
+    print(f"\nPeak RSS: {peak_rss() / 2**20:.0f} MB\n")
+
+
+def save_trace(file_name):
+    """ Writes Chrome trace-event JSON, with the totals added under 'otherData' """
+    trace = {
+        'traceEvents': events,
+        'displayTimeUnit': "ms",
+        'otherData': {
+            'phases': [dict(totals, name=name, category=category) for (category, name), totals in phases.items()],
+            'netbox_requests': dict(nb_requests),
+            'netconf_rpcs': [{'device': device_name, 'rpc': rpc, 'calls': count}
+                             for (device_name, rpc), count in sorted(rpcs.items())],
+            'peak_rss_bytes': peak_rss()
+        }
+    }
+    with open(file_name, 'w') as trace_file:
+        json.dump(trace, trace_file)
+    print(f"Trace written to {file_name}")
@@ -1,15 +1,17 @@
 from pathlib import Path
-import yaml
 import json
 import os
+import shutil
 import ipaddress
 
+import clab_snapshot
+import clab_yaml
+
 def write_files(parser_args, device_info, link_info, parsed_yaml_data):
     global args, devices, links, yaml_data, dummy_routes
 
     # Load list of random routes we announce from fake isp router node
-    with open('dummy_routes.yaml', 'r') as yaml_file:
-        dummy_routes = yaml.safe_load(yaml_file)
+    dummy_routes = clab_yaml.load_file('dummy_routes.yaml')
 
     args = parser_args
     devices = device_info
@@ -42,10 +44,10 @@ def write_clab_topology():
     print("Building clab topology...")
     for device_name, device_vars in devices.items():
         out_data['topology']['nodes'][device_name] = {
-            "kind": device_vars['kind'],
+            "kind": device_vars.kind,
             "binds": ["~/.ssh/id_ed25519.pub:/root/.ssh/authorized_keys"]
         }
-        if device_vars['kind'] == "crpd":
+        if device_vars.kind == "crpd":
             out_data['topology']['nodes'][device_name]['image'] = "crpd"
             if args.license:
                 out_data['topology']['nodes'][device_name]['license'] = args.license
@@ -61,13 +63,13 @@ def write_clab_topology():
     for link in links.values():
         out_data['topology']['links'].append({
             "endpoints": [
-                "{}:{}".format(link['dev_a'], link['int_a']),
-                "{}:{}".format(link['dev_b'], link['int_b'])
+                "{}:{}".format(link.dev_a, link.int_a),
+                "{}:{}".format(link.dev_b, link.int_b)
         ]})
 
     print("Writing clab topology file {}.yaml...".format(args.name))
     out_file = open('output/{}.yaml'.format(args.name), 'w')
-    yaml.safe_dump(out_data, out_file)
+    clab_yaml.dump(out_data, out_file)
     out_file.close()
 
 
@@ -77,10 +79,10 @@ def write_fqdn_map():
 
     fqdn_map = {}
     for device_name, device_vars in devices.items():
-        if "fqdn" in device_vars:
-            fqdn_map[device_name] = device_vars['fqdn']
+        if device_vars.fqdn:
+            fqdn_map[device_name] = device_vars.fqdn
 
-    yaml.safe_dump(fqdn_map, out_file)
+    clab_yaml.dump(fqdn_map, out_file)
     out_file.close()
 
 
@@ -89,130 +91,274 @@ def write_start_script():
     out_file = open("output/start_{}.sh".format(args.name), 'w')
     out_file.write("#!/bin/bash\n")
     out_file.write("set -x\n")
-
+    if args.trace:
+        # Chrome trace-event begin / end markers, timed by the shell as the script runs
+        out_file.write(f"TRACE_FILE=start_{args.name}.trace.json\n")
+        out_file.write("echo '[' > $TRACE_FILE\n")
+        # Thread id is the pid of the (sub)shell, so nodes set up in parallel show side by side
+        out_file.write("trace() { printf '{\"name\": \"%s\", \"ph\": \"%s\", \"ts\": %s, \"pid\": 1, \"tid\": %s},\\n' " \
+                       "\"$2\" \"$1\" \"$(date +%s%6N)\" \"$BASHPID\" >> $TRACE_FILE; }\n")
+
+    write_trace(out_file, "B", "clab deploy")
     out_file.write("sudo clab deploy -t {}.yaml\n".format(args.name))
+    write_trace(out_file, "E", "clab deploy")
     out_file.write("../add_fqdn_hosts.py\n\n")
-    # Added below as Netlink reports not being able to set IPv6 addr for some ints without
-    # Expect it's just happening too quick after container/netns/netdev init as running 
-    # command manually just after works fine.
-    out_file.write("sleep 5\n\n")
     dns_resolvers = get_dns_resolvers()
 
-    for device_name, device_vars in devices.items():
-        # Disable proxy arp cos it's evil
-        out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                        f"sysctl -w net.ipv4.conf.all.arp_ignore=2\n")
-
-        if "loop_addrs" in device_vars.keys():
-            for address in device_vars['loop_addrs']:
-                out_file.write("sudo ip netns exec clab-{}-{} ip addr add {} dev lo\n".format(
-                    args.name, device_name, address))
-
-        out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} ip route del default via 172.20.20.1\n")
-        out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} ip -6 route del default via 2001:172:20:20::1\n")
-
-        for resolver in dns_resolvers:
-            # Should be changed to detect v4/v6 IP and use appropriate next-hop, also discover GW IP and not assume default
-            out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} ip route add {resolver} via 172.20.20.1\n")
-
-        if device_vars['sub_type'] == "l2switch" or device_vars['sub_type'] == "l3switch":
-            # This container should have a vlan-aware bridge created, which we'll attach all physicals to
-            out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                            "ip link add irb type bridge vlan_filtering 1 vlan_protocol 802.1Q " \
-                            "vlan_stats_enabled 1 vlan_stats_per_port 1\n")
-            out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} ip link set dev irb mtu 9212\n")
-            out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} ip link set dev irb up\n")
-            out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                                f"bridge vlan del dev irb vid 1 self\n")
-            out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} ip addr flush dev irb\n\n")
-
-        for int_name, int_vars in device_vars['phys_ints'].items():
-            out_file.write("sudo ip netns exec clab-{}-{} ip link set alias \"{}\" dev {}\n".format(
-                args.name, device_name, int_name, int_vars['clab_dev']))
-
-            if int_vars['vlans']:
-                # L2 trunk, so set port master to the 'irb' bridge and set vlans
-                out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                               f"ip link set dev {int_vars['clab_dev']} master irb\n")
-                # Vlan 1 defaults to native VLAN.  Delete to block untagged frames.
-                out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                               f"bridge vlan del dev {int_vars['clab_dev']} vid 1\n")
-                for vlan in int_vars['vlans']:
-                    out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                                   f"bridge vlan add dev {int_vars['clab_dev']} vid {vlan}\n")
-
-            # If access vlan is set and not default value 0 (indicating none)
-            if "access_vlan" in int_vars and int_vars['access_vlan']:
-                if not int_vars['vlans']:
-                    out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                                   f"ip link set dev {int_vars['clab_dev']} master irb\n")
-                    out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                                   f"bridge vlan del dev {int_vars['clab_dev']} vid 1\n")
-                out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                               f"bridge vlan add dev {int_vars['clab_dev']} vid {int_vars['access_vlan']} " \
-                               f"pvid untagged\n")
-
-            if int_vars['addrs']:
-                for address in int_vars['addrs']:
-                    out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " 
-                                   f"ip addr add {address} dev {int_vars['clab_dev']}\n")
-
-                    if device_vars['sub_type'] == "host":
-                        # Add default route towards the first IP in the subnet
-                        ip_int = ipaddress.ip_interface(address)
-                        out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} "
-                                       f"ip route add default via {ip_int.network[1]}\n")
-
-            else:
-                # No unicast address - best to delete v6 link local too.
-                out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} "
-                               f"ip addr flush dev {int_vars['clab_dev']}\n")
-
-        for subint_name, subint_vars in device_vars['subints'].items():
-            out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} "
-                           f"ip link add link {subint_vars['clab_dev']} name {subint_vars['subint_dev']} "
-                           f"type vlan id {subint_vars['vlan_id']}\n")
-
-            for address in subint_vars['addrs']:
-                out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} "
-                               f"ip addr add {address} dev {subint_vars['subint_dev']}\n")
-
-            out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} "            
-                           f"ip link set dev {subint_vars['subint_dev']} up\n")
-
-            out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} "
-                           f"ip link set alias {subint_vars['clab_dev']}.{subint_vars['vlan_id']} "
-                           f"dev {subint_vars['subint_dev']}\n")
-
-        if "irb_ints" in device_vars:
-            # IRB interfaces are modelled as vlan sub-interfaces of the 'irb' master bridge.
-            # We add them with the correct 802.1q tag, then allow that tag on the master dev itself
-            for irb_name, irb_addrs in device_vars['irb_ints'].items():
-                out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                    f"ip link add link irb name {irb_name} type vlan id {irb_name.split('.')[1]}\n")
-                for address in irb_addrs:
-                    out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                        f"ip addr add {address} dev {irb_name}\n")
-                out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                    f"ip link set dev {irb_name} up\n")
-                out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                    f"bridge vlan add dev irb vid {irb_name.split('.')[1]} self\n")
-
-
-        if device_vars['sub_type'] == "lvs":
-            # Add default via .2 address on eth1 subnet to allow peering to CRs
-            lvs_eth1_ip = ipaddress.ip_interface(device_vars['phys_ints']['eth1']['addrs'][0])
-            out_file.write(f"sudo ip netns exec clab-{args.name}-{device_name} ip route add default via {lvs_eth1_ip.network[2]}\n")
-
+    if args.provisioner == "pyroute2":
+        # Nodes set up over netlink from python, using the devices in the topology snapshot
+        out_file.write(f"JOBS=${{JOBS:-{args.jobs}}}\n")
+        write_trace(out_file, "B", "netns setup")
+        out_file.write(f"sudo ../clab_provision.py --name {args.name} --jobs $JOBS --ready-timeout ${{READY_TIMEOUT:-60}}\n")
+        write_trace(out_file, "E", "netns setup")
         out_file.write("\n")
+    else:
+        write_netlink_batches(out_file, dns_resolvers)
 
-    out_file.write('\n../junos_push_lvs_conf.py -c ../lvs_config.json\n\n')
-    out_file.write('../junos_push_isp_router_conf.py -c ./isp_router_conf.json\n')
+    # Record what's deployed for clab_gen.py --redeploy to compare with
+    out_file.write(f"cp ../{clab_snapshot.SNAPSHOT_FILE} {clab_snapshot.DEPLOYED_SNAPSHOT_FILE}\n")
+
+    # LVS and isp_router pushes run as one pipeline, over shared NETCONF sessions
+    if args.trace:
+        out_file.write(f'\n../junos_push_lab.py -t {args.name}.yaml -l ../lvs_config.json -i ./isp_router_conf.json --trace junos_push_lab.trace.json\n')
+        # Drop trailing comma from last event and close the JSON array
+        out_file.write("sed -i '$ s/,$//' $TRACE_FILE && echo ']' >> $TRACE_FILE\n")
+    else:
+        out_file.write(f'\n../junos_push_lab.py -t {args.name}.yaml -l ../lvs_config.json -i ./isp_router_conf.json\n')
 
     out_file.close()
     os.chmod("output/start_{}.sh".format(args.name), 0o755)
 
 
+def write_netlink_batches(out_file, dns_resolvers):
+    """ Writes netlink config for each node to 'ip -batch' and 'bridge -batch' files, applied by
+        the start script with one process each inside the node's netns.  The ip commands all
+        run before the bridge ones, which only need the ports / irb to exist. """
+    shutil.rmtree("output/netlink", ignore_errors=True)
+    os.makedirs("output/netlink")
+    with open("output/netlink/setup_node.sh", 'w') as script_file:
+        script_file.write(SETUP_NODE_SCRIPT)
+    write_node_setup_func(out_file)
+    for device_name, device_vars in devices.items():
+        ip_cmds, bridge_cmds = [], []
+        for op in get_netlink_ops(device_vars, dns_resolvers):
+            tool, cmd = netlink_cmd(op)
+            (ip_cmds if tool == "ip" else bridge_cmds).append(cmd)
+        with open(f"output/netlink/{device_name}.ip", 'w') as batch_file:
+            batch_file.write("".join(f"{cmd}\n" for cmd in ip_cmds))
+        if bridge_cmds:
+            with open(f"output/netlink/{device_name}.bridge", 'w') as batch_file:
+                batch_file.write("".join(f"{cmd}\n" for cmd in bridge_cmds))
+        with open(f"output/netlink/{device_name}.devs", 'w') as devs_file:
+            devs_file.write("".join(f"{dev}\n" for dev in get_node_links(device_vars)))
+
+        out_file.write(f"node_setup {device_name} &\n")
+        out_file.write("node_throttle\n")
+    out_file.write("wait\n")
+    out_file.write("if [ -s netlink/failed.txt ]; then\n" \
+                   "    echo \"Setup failed on: $(tr '\\n' ' ' < netlink/failed.txt)- see netlink/<node>.log\"\n" \
+                   "fi\n\n")
+
+
+def get_node_links(device_vars):
+    """ Returns the interfaces clab creates for a node, which must be there before it is set up """
+    return [int_vars.clab_dev for int_vars in device_vars.phys_ints.values()]
+
+
+def get_netlink_ops(device_vars, dns_resolvers):
+    """ Returns list of netlink changes needed to set up a node's interfaces, addresses and
+        routes, as tuples of operation name and arguments.  These are written out as 'ip' and
+        'bridge' commands by netlink_cmd(), or applied directly by clab_provision. """
+    ops = []
+
+    for address in device_vars.loop_addrs:
+        ops.append(("addr_add", "lo", address))
+
+    ops.append(("route_del", "default", "172.20.20.1"))
+    ops.append(("route_del", "default", "2001:172:20:20::1"))
+
+    for resolver in dns_resolvers:
+        # Should be changed to detect v4/v6 IP and use appropriate next-hop, also discover GW IP and not assume default
+        ops.append(("route_add", resolver, "172.20.20.1"))
+
+    if device_vars.sub_type == "l2switch" or device_vars.sub_type == "l3switch":
+        # This container should have a vlan-aware bridge created, which we'll attach all physicals to
+        ops.append(("bridge_add", "irb"))
+        ops.append(("link_mtu", "irb", 9212))
+        ops.append(("link_up", "irb"))
+        ops.append(("bridge_vlan_del", "irb", 1, "self"))
+        ops.append(("addr_flush", "irb"))
+
+    for int_name, int_vars in device_vars.phys_ints.items():
+        ops.append(("link_alias", int_vars.clab_dev, int_name))
+
+        if int_vars.vlans:
+            # L2 trunk, so set port master to the 'irb' bridge and set vlans
+            ops.append(("link_master", int_vars.clab_dev, "irb"))
+            # Vlan 1 defaults to native VLAN.  Delete to block untagged frames.
+            ops.append(("bridge_vlan_del", int_vars.clab_dev, 1, ""))
+            for vlan in int_vars.vlans:
+                ops.append(("bridge_vlan_add", int_vars.clab_dev, vlan, ""))
+
+        # If access vlan is set and not default value 0 (indicating none)
+        if int_vars.access_vlan:
+            if not int_vars.vlans:
+                ops.append(("link_master", int_vars.clab_dev, "irb"))
+                ops.append(("bridge_vlan_del", int_vars.clab_dev, 1, ""))
+            ops.append(("bridge_vlan_add", int_vars.clab_dev, int_vars.access_vlan, "pvid untagged"))
+
+        if int_vars.addrs:
+            for address in int_vars.addrs:
+                ops.append(("addr_add", int_vars.clab_dev, address))
+
+                if device_vars.sub_type == "host":
+                    # Add default route towards the first IP in the subnet
+                    ip_int = address.interface
+                    ops.append(("route_add", "default", str(ip_int.network[1])))
+
+        else:
+            # No unicast address - best to delete v6 link local too.
+            ops.append(("addr_flush", int_vars.clab_dev))
+
+    for subint_name, subint_vars in device_vars.subints.items():
+        ops.append(("vlan_add", subint_vars.clab_dev, subint_vars.subint_dev, subint_vars.vlan_id))
+        for address in subint_vars.addrs:
+            ops.append(("addr_add", subint_vars.subint_dev, address))
+        ops.append(("link_up", subint_vars.subint_dev))
+        ops.append(("link_alias", subint_vars.subint_dev, f"{subint_vars.clab_dev}.{subint_vars.vlan_id}"))
+
+    # IRB interfaces are modelled as vlan sub-interfaces of the 'irb' master bridge.
+    # We add them with the correct 802.1q tag, then allow that tag on the master dev itself
+    for irb_name, irb_addrs in device_vars.irb_ints.items():
+        ops.append(("vlan_add", "irb", irb_name, int(irb_name.split('.')[1])))
+        for address in irb_addrs:
+            ops.append(("addr_add", irb_name, address))
+        ops.append(("link_up", irb_name))
+        ops.append(("bridge_vlan_add", "irb", int(irb_name.split('.')[1]), "self"))
+
+    if device_vars.sub_type == "lvs":
+        # Add default via .2 address on eth1 subnet to allow peering to CRs
+        lvs_eth1_ip = device_vars.phys_ints['eth1'].addrs[0].interface
+        ops.append(("route_add", "default", str(lvs_eth1_ip.network[2])))
+
+    return ops
+
+
+def netlink_cmd(op):
+    """ Returns tool ('ip' or 'bridge') and command line, without the tool name, for a netlink op """
+    op_name, dev, *op_args = op
+    if op_name.startswith("bridge_vlan_"):
+        flags = f" {op_args[1]}" if op_args[1] else ""
+        return "bridge", f"vlan {op_name[len('bridge_vlan_'):]} dev {dev} vid {op_args[0]}{flags}"
+    if op_name.startswith("route_"):
+        # No '-6' option in batch files, so give the v6 default explicitly
+        dst = "::/0" if dev == "default" and ":" in op_args[0] else dev
+        return "ip", f"route {op_name[len('route_'):]} {dst} via {op_args[0]}"
+    return "ip", {
+        'addr_add': "addr add {1} dev {0}",
+        'addr_flush': "addr flush dev {0}",
+        'bridge_add': "link add {0} type bridge vlan_filtering 1 vlan_protocol 802.1Q " \
+                      "vlan_stats_enabled 1 vlan_stats_per_port 1",
+        'link_mtu': "link set dev {0} mtu {1}",
+        'link_up': "link set dev {0} up",
+        'link_alias': "link set alias \"{1}\" dev {0}",
+        'link_master': "link set dev {0} master {1}",
+        'link_nomaster': "link set dev {0} nomaster",
+        'link_del': "link del {0}",
+        'addr_del': "addr del {1} dev {0}",
+        'vlan_add': "link add link {0} name {1} type vlan id {2}"
+    }[op_name].format(dev, *op_args)
+
+
+# Run inside a node's netns, from the output dir, by the start script.  Waits for the node's
+# links to be ready rather than a fixed time after 'clab deploy', as adding IPv6 addresses fails
+# if done too soon after the netdevs are created.  Any address adds that fail anyway are retried.
+# The node is only marked failed if its links aren't ready, address adds still fail after the
+# retries, or creating a bridge / vlan device fails.  Other failures, like deleting a default
+# route that isn't there or adding one twice, are logged but harmless.
+SETUP_NODE_SCRIPT = """#!/bin/sh
+node=$1
+rc=0
+
+# Wait for each link to be up and have IPv6 initialised, checking every 50ms backing off to 1s
+waited=0
+delay=50
+for dev in $(cat netlink/$node.devs); do
+    until [ -n "$(ip link show up dev $dev 2>/dev/null)" ] && [ -d /proc/sys/net/ipv6/conf/$dev ]; do
+        if [ $waited -ge $((${READY_TIMEOUT:-60} * 1000)) ]; then
+            echo "timed out waiting for $dev"
+            rc=1
+            break 2
+        fi
+        sleep "$((delay / 1000)).$(printf %03d $((delay % 1000)))"
+        waited=$((waited + delay))
+        delay=$((delay * 2 > 1000 ? 1000 : delay * 2))
+    done
+done
+echo "ready after ${waited}ms"
+
+# Disable proxy arp cos it's evil
+sysctl -w net.ipv4.conf.all.arp_ignore=2
+
+batch=netlink/$node.ip
+for attempt in 0 1 2 3; do
+    ip -force -batch $batch > netlink/$node.err 2>&1
+    cat netlink/$node.err
+    : > netlink/$node.retry
+    for line in $(sed -n 's/^Command failed .*:\\([0-9]*\\)$/\\1/p' netlink/$node.err); do
+        cmd=$(sed -n "${line}p" $batch)
+        # Only worth retrying if the device is there
+        case "$cmd" in
+            "addr add "*) ip link show dev ${cmd##* } > /dev/null 2>&1 && echo "$cmd" >> netlink/$node.retry || rc=1 ;;
+            "link add "*) rc=1 ;;
+        esac
+    done
+    [ -s netlink/$node.retry ] || break
+    if [ $attempt -eq 3 ]; then
+        rc=1
+        break
+    fi
+    echo "retrying $(wc -l < netlink/$node.retry) address adds"
+    sleep $((attempt + 1))
+    mv netlink/$node.retry netlink/$node.ip.retry
+    batch=netlink/$node.ip.retry
+done
+
+if [ -f netlink/$node.bridge ]; then
+    bridge -force -batch netlink/$node.bridge || rc=1
+fi
+exit $rc
+"""
+
+
+def write_node_setup_func(out_file):
+    """ Adds shell functions to the start script that set up nodes in the background, up to
+        $JOBS (--jobs by default) at a time, each logging to netlink/<node>.log """
+    out_file.write(f"JOBS=${{JOBS:-{args.jobs}}}\n")
+    out_file.write("rm -f netlink/failed.txt\n")
+    out_file.write("node_setup() {\n")
+    write_trace(out_file, "B", "netns setup $1", indent=4)
+    # sudo doesn't pass on the environment, so READY_TIMEOUT is given explicitly
+    out_file.write(f"    if sudo ip netns exec clab-{args.name}-$1 env READY_TIMEOUT=${{READY_TIMEOUT:-60}} " \
+                   "sh netlink/setup_node.sh $1 > netlink/$1.log 2>&1; then\n" \
+                   "        echo \"$1 done, $(head -1 netlink/$1.log)\"\n" \
+                   "    else\n" \
+                   "        echo \"$1 FAILED, see netlink/$1.log\"\n" \
+                   "        echo $1 >> netlink/failed.txt\n" \
+                   "    fi\n")
+    write_trace(out_file, "E", "netns setup $1", indent=4)
+    out_file.write("}\n")
+    out_file.write("node_throttle() {\n" \
+                   "    while [ $(jobs -rp | wc -l) -ge $JOBS ]; do wait -n; done\n" \
+                   "}\n\n")
+
+
+def write_trace(out_file, event_type, name, indent=0):
+    """ Adds trace event to start script if --trace was given """
+    if args.trace:
+        out_file.write(f"{' ' * indent}trace {event_type} \"{name}\"\n")
+
+
 def get_dns_resolvers():
     resolvers = []
     with open('/etc/resolv.conf', 'r') as resolvconf:
@@ -298,7 +444,7 @@ def write_isp_rtr_config():
             rtr_conf['policy-options']['prefix-list'].append(pfx_list_conf)
 
     # Add policy-statements to add as-path prepends
-    for local_as, group_vars in devices['isp_router']['bgp_groups'].items():
+    for local_as, group_vars in devices['isp_router'].bgp_groups.items():
         policy = {}
         for ip_version in ['4', '6']:
             policy[ip_version] = {
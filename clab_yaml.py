@@ -0,0 +1,56 @@
+import hashlib
+import pickle
+from pathlib import Path
+
+import yaml
+
+# All YAML read / written by the scripts goes through here.  The libyaml based loader and dumper
+# are used if PyYAML was built with it (pure Python one is ~10x slower), and parsed files are
+# cached in cache_dir, so an unchanged file is only parsed once.  There is one pickle per file,
+# named by the hash of its path and holding the hash of the content it was parsed from, so a
+# file that changes replaces its entry rather than adding another.  Set cache_dir to None to
+# disable the cache.
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+cache_dir = Path(".yaml_cache")
+CACHE_VERSION = 2
+
+
+def load(stream):
+    """ Parses YAML string or open file, as yaml.safe_load() """
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def dump(data, stream=None, **kwargs):
+    """ Writes data as YAML to open file, or returns it as string, as yaml.safe_dump() """
+    return yaml.dump(data, stream, Dumper=SafeDumper, **kwargs)
+
+
+def load_file(file_name):
+    """ Returns parsed content of YAML file, from the cache if it has been parsed before """
+    content = Path(file_name).read_bytes()
+    if cache_dir is None:
+        return load(content)
+
+    content_hash = hashlib.sha256(content).hexdigest()
+    cache_file = cache_dir / f"{hashlib.sha256(str(Path(file_name).resolve()).encode()).hexdigest()}.pickle"
+    try:
+        with open(cache_file, 'rb') as pickle_file:
+            version, cached_hash, data = pickle.load(pickle_file)
+        if version == CACHE_VERSION and cached_hash == content_hash:
+            return data
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        pass
+
+    data = load(content)
+    cache_dir.mkdir(exist_ok=True)
+    # Write to temp file and rename, so a partly written entry is never read
+    tmp_file = cache_file.with_suffix(".tmp")
+    with open(tmp_file, 'wb') as pickle_file:
+        pickle.dump((CACHE_VERSION, content_hash, data), pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_file.replace(cache_file)
+    return data
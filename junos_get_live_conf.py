@@ -2,33 +2,86 @@
 
 import pynetbox
 
-from jnpr.junos import Device
-from jnpr.junos.utils.config import Config
-from jnpr.junos.exception import ConnectError
+from jnpr.junos.exception import ConnectError, RpcError
+from ncclient.transport.errors import TransportError
 
 from getpass import getpass
 import argparse
-import os
+import hashlib
 import sys
-import re
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 import json
 
+import clab_junos
+import clab_trace
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-n', '--netbox', help='Netbox server IP / Hostname', type=str, default="netbox.wikimedia.org")
 parser.add_argument('-k', '--key', help='Netbox API Token / Key', type=str, default='')
 parser.add_argument('-s', '--sshconfig', help='SSH config file', default='~/.ssh/config.homer')
 parser.add_argument('-d', '--outputdir', help='Directory for output YAML files', default='junos_data')
+parser.add_argument('-j', '--jobs', help='Number of routers to collect from in parallel (default: 8)', type=int, default=8)
+parser.add_argument('--devices', help='Comma separated routers to collect from instead of those in Netbox, as name or name=host[:port]', type=str)
+parser.add_argument('--connect-timeout', help='Seconds to wait for NETCONF session to a router to open (default: 30)', type=int, default=30)
+parser.add_argument('--rpc-timeout', help='Seconds to wait for each RPC reply (default: 120)', type=int, default=120)
+parser.add_argument('--retries', help='Times to retry a router that fails, waiting 2, 4, 8... seconds between (default: 2)', type=int, default=2)
+parser.add_argument('--full', help='Get config from every router, even if not committed to since the last run', action='store_true')
+parser.add_argument('--trace', help='Print time taken by NETCONF RPCs per device and save a Chrome trace-event JSON file here', type=str)
 args = parser.parse_args()
 
+# Seconds before first retry of a router, doubling for each one after
+RETRY_BACKOFF = 2
+
+
+@dataclass
+class DeviceResult:
+    name: str
+    seconds: float = 0
+    attempts: int = 0
+    # Set if the router hadn't been committed to since the last run, and getting its config was skipped
+    unchanged: bool = False
+    error: str = None
+
+
 def main():
-    """ Polls netbox for devices with roles/statues in the vars defined below, then connects 
-        to the live prod instances and pulls the BGP config and OSPF interface metrics from 
-        them.  These are then saved to files in <output_dir> so they can be used in lab 
-        environments, filling the gap of manual / automatic config we can't derive from 
-        Netbox / Homer YAML files. """ 
+    """ Polls netbox for devices with roles/statues in the vars defined below, then connects
+        to the live prod instances and pulls the BGP config and OSPF interface metrics from
+        them.  These are then saved to files in <output_dir> so they can be used in lab
+        environments, filling the gap of manual / automatic config we can't derive from
+        Netbox / Homer YAML files.  Routers are collected from in parallel, and one that
+        fails doesn't stop the others.  Returns True if all were saved.
+
+        Alongside <output_dir>/config/<device>.json is <device>.meta.json, with the router's
+        last commit when it was exported and the sha256 of the files saved.  Later runs ask
+        each router for its commit history first, and skip getting its config if it hasn't been
+        committed to since.  OSPF metrics are always got, as those derived from the
+        reference-bandwidth can change without a commit (i.e. a LAG member going down).  Files
+        are only rewritten if their content hash has changed. """
+
+    clab_junos.init(args.sshconfig)
+    Path(f"{args.outputdir}/config").mkdir(exist_ok=True, parents=True)
+    Path(f"{args.outputdir}/ospf_ints").mkdir(exist_ok=True, parents=True)
 
+    if args.devices:
+        targets = parse_devices(args.devices)
+    else:
+        targets = get_netbox_devices()
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {device_name: executor.submit(collect_device, device_name, host, port)
+                   for device_name, (host, port) in targets.items()}
+    results = {device_name: future.result() for device_name, future in futures.items()}
+
+    print_results(results)
+    return not any(result.error for result in results.values())
+
+
+def get_netbox_devices():
+    """ Returns {device name: (host, port)} for the routers in Netbox to collect from """
     nb_url = "https://{}".format(args.netbox)
     if args.key:
         nb_key = args.key
@@ -36,53 +89,155 @@ def main():
         nb_key = getpass(prompt="Netbox API Key: ")
     nb = pynetbox.api(nb_url, nb_key)
 
-    Path(f"{args.outputdir}/config").mkdir(exist_ok=True, parents=True)
-    Path(f"{args.outputdir}/ospf_ints").mkdir(exist_ok=True, parents=True)
-
     device_roles = ['cr']
     device_statuses = ['active', 'staged']
 
+    nb_devices = []
     for role in device_roles:
-        nb_devices = nb.dcim.devices.filter(role=role)
-        for nb_device in nb_devices:
+        for nb_device in nb.dcim.devices.filter(role=role):
             if str(nb_device.status).lower() not in device_statuses:
                 continue
-            print(f"Connecting to {nb_device.name}... ", end="", flush=True)
-            dev_pri_ip = nb.ipam.ip_addresses.get(nb_device.primary_ip.id)
-            junos_dev = get_junos_dev(dev_pri_ip.dns_name)
-
+            if not nb_device.primary_ip:
+                print(f"Skipping {nb_device.name}, it has no primary IP.")
+                continue
+            nb_devices.append(nb_device)
+
+    # Get all the primary IPs in one request rather than one per device
+    dns_names = {}
+    if nb_devices:
+        ip_ids = [nb_device.primary_ip.id for nb_device in nb_devices]
+        dns_names = {nb_ip.id: nb_ip.dns_name for nb_ip in nb.ipam.ip_addresses.filter(id=ip_ids)}
+
+    return {nb_device.name: (dns_names[nb_device.primary_ip.id], 22) for nb_device in nb_devices}
+
+
+def parse_devices(devices_arg):
+    """ Parses --devices, i.e. 'cr1-eqiad,cr2-eqiad=localhost:8302', to {name: (host, port)} """
+    targets = {}
+    for device in devices_arg.split(','):
+        device_name, _, host = device.partition('=')
+        host, _, port = (host or device_name).partition(':')
+        targets[device_name] = (host, int(port or 22))
+    return targets
+
+
+def collect_device(device_name, host, port):
+    """ Gets the data for one router and saves it, retrying with backoff if the session or an
+        RPC fails """
+    result = DeviceResult(device_name)
+    start = time.perf_counter()
+    config_file = Path(f"{args.outputdir}/config/{device_name}.json")
+    ospf_file = Path(f"{args.outputdir}/ospf_ints/{device_name}.json")
+    meta = load_meta(device_name)
+    last_commit = meta.get('commit')
+    if args.full or not config_file.is_file():
+        last_commit = None
+    while True:
+        result.attempts += 1
+        try:
+            commit_id, config, ospf_metrics = get_device_data(host, port, last_commit)
+            break
+        except (ConnectError, RpcError, TransportError, OSError) as err:
+            result.error = str(err) or type(err).__name__
+        except (KeyError, IndexError, ValueError) as err:
+            # Unexpected reply, no point trying again
+            result.error = f"unexpected RPC output: {err!r}"
+            result.seconds = time.perf_counter() - start
+            print(f"{device_name} failed: {result.error}")
+            return result
+        if result.attempts > args.retries:
+            result.seconds = time.perf_counter() - start
+            print(f"{device_name} failed: {result.error}")
+            return result
+        delay = RETRY_BACKOFF * 2 ** (result.attempts - 1)
+        print(f"{device_name} attempt {result.attempts} failed, retrying in {delay}s: {result.error}")
+        time.sleep(delay)
+
+    result.error = None
+    if config is None:
+        result.unchanged = True
+        config_sha256 = meta.get('config_sha256')
+    else:
+        config_sha256 = write_if_changed(config_file, json.dumps(config), meta.get('config_sha256'))
+    meta = {'commit': commit_id,
+            'config_sha256': config_sha256,
+            'ospf_sha256': write_if_changed(ospf_file, json.dumps(ospf_metrics), meta.get('ospf_sha256'))}
+    write_atomic(meta_file(device_name), json.dumps(meta))
+    result.seconds = time.perf_counter() - start
+    print(f"{device_name} saved ok{', config unchanged since last commit' if result.unchanged else ''}.")
+    return result
+
+
+def get_device_data(host, port, last_commit=None):
+    """ Returns router's last commit, BGP config and {interface: OSPF metric}.  The config is
+        None if the last commit is still last_commit. """
+    with clab_junos.session(host, port, rpc_timeout=args.rpc_timeout, conn_open_timeout=args.connect_timeout) as junos_dev:
+        commit_id = get_commit_id(junos_dev)
+        config = None
+        if commit_id != last_commit:
             config_filter = "<protocols><bgp/></protocols>"
             config = junos_dev.rpc.get_config(options={'format':'json'}, filter_xml=config_filter)
-            with open(f"{args.outputdir}/config/{nb_device.name}.json", "w") as config_file:
-                config_file.write(json.dumps(config))
 
-            ospf_metrics = {}
-            ospf_ints = junos_dev.rpc.get_ospf_interface_information({'format':'json'}, detail=True)
-            for ospf_int in ospf_ints['ospf-interface-information'][0]['ospf-interface']:
-                metric = int(ospf_int['ospf-interface-topology'][0]['ospf-topology-metric'][0]['data'])
-                ospf_metrics[ospf_int['interface-name'][0]['data']] = metric
+        ospf_metrics = {}
+        ospf_ints = junos_dev.rpc.get_ospf_interface_information({'format':'json'}, detail=True)
+        for ospf_int in ospf_ints['ospf-interface-information'][0]['ospf-interface']:
+            metric = int(ospf_int['ospf-interface-topology'][0]['ospf-topology-metric'][0]['data'])
+            ospf_metrics[ospf_int['interface-name'][0]['data']] = metric
+
+    return commit_id, config, ospf_metrics
+
+
+def get_commit_id(junos_dev):
+    """ Returns string identifying router's last commit, from the first commit history entry """
+    commit_info = junos_dev.rpc.get_commit_information({'format':'json'})
+    last_commit = commit_info['commit-information'][0]['commit-history'][0]
+    return " ".join(last_commit[key][0]['data'] for key in ('date-time', 'user', 'client', 'log')
+                    if key in last_commit)
 
-            with open(f"{args.outputdir}/ospf_ints/{nb_device.name}.json", "w") as metric_file:
-                metric_file.write(json.dumps(ospf_metrics))
 
-            junos_dev.close()
-            print("saved ok.")
+def meta_file(device_name):
+    return Path(f"{args.outputdir}/config/{device_name}.meta.json")
 
 
-def get_junos_dev(dev_name):
-    # Initiates NETCONF session to router
+def load_meta(device_name):
     try:
-        device = Device(dev_name, username=os.getlogin(), ssh_config=args.sshconfig, port=22)
-        device.open()
-    except ConnectError as err:
-        print(f"Cannot connect to device: {err}")
-        sys.exit(1)
+        return json.loads(meta_file(device_name).read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_if_changed(file_path, content, last_sha256):
+    """ Writes content to file_path unless it's already there, going by the hash of what was
+        written last time.  Returns the content's sha256. """
+    content_sha256 = hashlib.sha256(content.encode()).hexdigest()
+    if content_sha256 != last_sha256 or not file_path.is_file():
+        write_atomic(file_path, content)
+    return content_sha256
 
-    # Get config object
-    device.bind(config=Config)
 
-    return device
+def write_atomic(file_path, content):
+    """ Writes to temp file beside the target and renames it over it, so a run that fails part
+        way never leaves a truncated file """
+    tmp_file = file_path.with_name(f".{file_path.name}.tmp")
+    tmp_file.write_text(content)
+    tmp_file.replace(file_path)
+
+
+def print_results(results):
+    print()
+    for result in results.values():
+        status = f"FAILED: {result.error}" if result.error else "ok, config unchanged" if result.unchanged else "ok"
+        print(f"{result.name:<20} {result.seconds:>8.3f}s  {result.attempts} attempt(s)  {status}")
+    failed = [result.name for result in results.values() if result.error]
+    unchanged = sum(1 for result in results.values() if result.unchanged)
+    print(f"\n{len(results) - len(failed)} of {len(results)} routers saved ok ({unchanged} with config unchanged)" +
+          (f", failed: {', '.join(failed)}" if failed else "."))
 
 
 if __name__ == '__main__':
-    main()
+    ok = main()
+    if args.trace:
+        clab_trace.print_summary()
+        clab_trace.save_trace(args.trace)
+    if not ok:
+        sys.exit(1)
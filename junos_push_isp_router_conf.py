@@ -1,18 +1,16 @@
 #!/usr/bin/python3
 
-from jnpr.junos import Device
-from jnpr.junos.utils.config import Config
 from jnpr.junos.exception import ConnectError
 
-from getpass import getpass
 import argparse
-import os
+import copy
 import sys
-import re
 
-from pathlib import Path
 import json
-import yaml
+
+import clab_confdiff
+import clab_junos
+import clab_trace
 
 import warnings
 warnings.filterwarnings(action='ignore',module='.*paramiko.*')
@@ -20,49 +18,50 @@ warnings.filterwarnings(action='ignore',module='.*paramiko.*')
 parser = argparse.ArgumentParser()
 parser.add_argument('-s', '--sshconfig', help='SSH config file', default='~/.ssh/config')
 parser.add_argument('-c', '--conffile', help='Path to JSON-formatted JunOS config gile', default='output/isp_route_conf.json')
-args = parser.parse_args()
+parser.add_argument('--trace', help='Print time taken by NETCONF RPCs per device and save a Chrome trace-event JSON file here', type=str)
 
 def main():
     """ Pushes generated config to dummy isp_router node once it is spun up """
-    # Get existing JunOS config
-    junos_dev = get_junos_dev('clab-wmf-lab-isp_router')
-    config = junos_dev.rpc.get_config(options={'format':'json', 'database' : 'committed'})
-    del config['configuration']['@']
-
     # Load generated JunOS config
     with open(args.conffile, 'r') as json_file:
         add_config = json.load(json_file)
 
-    config['configuration'].update(add_config)
-
-    # Push modified config back to device if things have changed.
-    junos_dev.config.load(json.dumps(config), format="json", overwrite=True)
-    junos_dev.config.commit()
-    print(f"Pushed config to dummy isp_router node.")
-
-    junos_dev.close()
-    '''
-    from pprintpp import pprint as pp
-    pp(config)
-
-    print()
-    '''
-
-
-def get_junos_dev(dev_name):
-    # Initiates NETCONF session to router
+    clab_junos.init(args.sshconfig)
     try:
-        device = Device(dev_name, username=os.getlogin(), ssh_config=args.sshconfig, port=22)
-        device.open()
+        push_isp_router(add_config)
     except ConnectError as err:
         print(f"Cannot connect to device: {err}")
         sys.exit(1)
 
-    # Get config object
-    device.bind(config=Config)
 
-    return device
+def push_isp_router(add_config):
+    """ Adds / replaces the top-level stanzas in add_config in isp_router's config """
+    with clab_junos.session('clab-wmf-lab-isp_router') as junos_dev:
+        # Get existing JunOS config
+        config = junos_dev.rpc.get_config(options={'format':'json', 'database' : 'committed'})
+        del config['configuration']['@']
+
+        new_config = copy.deepcopy(config)
+        new_config['configuration'].update(add_config)
+
+        # Push changes to device if things have changed.
+        load_bytes = clab_confdiff.load_changes(junos_dev, config, new_config)
+        if load_bytes:
+            junos_dev.config.commit()
+            print(f"Pushed config to dummy isp_router node ({load_bytes} bytes).")
+        else:
+            print(f"Dummy isp_router node config already up to date.")
+        '''
+        from pprintpp import pprint as pp
+        pp(config)
+
+        print()
+        '''
 
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     main()
+    if args.trace:
+        clab_trace.print_summary()
+        clab_trace.save_trace(args.trace)
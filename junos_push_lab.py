@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+from jnpr.junos.exception import ConnectError, RpcError
+from ncclient.transport.errors import TransportError
+
+import argparse
+import json
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import clab_junos
+import clab_trace
+import clab_yaml
+
+import junos_push_isp_router_conf
+import junos_push_lvs_conf
+import junos_push_saved_data
+
+import warnings
+warnings.filterwarnings(action='ignore',module='.*paramiko.*')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s', '--sshconfig', help='SSH config file', default='~/.ssh/config')
+parser.add_argument('-t', '--topology', help='Containerlab topology file', default='wmf-lab.yaml')
+parser.add_argument('-l', '--lvs-conf', help='Path to JSON-formatted JunOS config for LVS nodes', default='../lvs_config.json')
+parser.add_argument('-i', '--isp-conf', help='Path to JSON-formatted JunOS config for isp_router', default='./isp_router_conf.json')
+parser.add_argument('-d', '--saved-data', help='Also push production data saved by junos_get_live_conf.py in this directory to cr nodes (once homer has been run)', type=str)
+parser.add_argument('-j', '--jobs', help='Number of nodes to push to in parallel (default: 4)', type=int, default=4)
+parser.add_argument('--trace', help='Print time taken by NETCONF RPCs per device and save a Chrome trace-event JSON file here', type=str)
+
+
+def main():
+    """ Runs the push stages of the junos_push_* scripts as one pipeline: LVS config to lvs
+        nodes, generated config to isp_router and optionally saved production data to cr nodes.
+        Pushes to different nodes run in parallel, each over a clab_junos session, rather than
+        the scripts running one after the other.  Returns True if all pushes worked. """
+
+    with open(args.topology, 'r') as wmf_file:
+        wmf_lab = clab_yaml.load(wmf_file)
+    with open(args.lvs_conf, 'r') as json_file:
+        lvs_config = json.load(json_file)
+    with open(args.isp_conf, 'r') as json_file:
+        isp_config = json.load(json_file)
+
+    clab_junos.init(args.sshconfig)
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for node_name in junos_push_lvs_conf.get_lvs_nodes(wmf_lab):
+            futures[f"lvs {node_name}"] = executor.submit(run_stage, junos_push_lvs_conf.push_lvs_node, node_name, lvs_config)
+        futures["isp isp_router"] = executor.submit(run_stage, junos_push_isp_router_conf.push_isp_router, isp_config)
+        if args.saved_data:
+            for node_name in junos_push_saved_data.get_cr_nodes(wmf_lab):
+                futures[f"saved {node_name}"] = executor.submit(run_saved_data_stage, node_name, args.saved_data)
+    results = {name: future.result() for name, future in futures.items()}
+
+    print_results(results)
+    return not any(error for seconds, error in results.values())
+
+
+def run_stage(push_func, *push_args):
+    """ Runs push, returning (seconds taken, error or None) """
+    start = time.perf_counter()
+    try:
+        push_func(*push_args)
+        error = None
+    except (ConnectError, RpcError, TransportError, OSError, KeyError, IndexError, TypeError, ValueError) as err:
+        error = str(err) or type(err).__name__
+    return time.perf_counter() - start, error
+
+
+def run_saved_data_stage(node_name, data_dir):
+    result = junos_push_saved_data.push_node(node_name, data_dir)
+    return result.seconds, result.error
+
+
+def print_results(results):
+    print()
+    for name, (seconds, error) in results.items():
+        print(f"{name:<30} {seconds:>8.3f}s  {f'FAILED: {error}' if error else 'ok'}")
+    failed = [name for name, (seconds, error) in results.items() if error]
+    print(f"\n{len(results) - len(failed)} of {len(results)} pushes ok" + (f", failed: {', '.join(failed)}" if failed else "."))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    ok = main()
+    if args.trace:
+        clab_trace.print_summary()
+        clab_trace.save_trace(args.trace)
+    if not ok:
+        sys.exit(1)
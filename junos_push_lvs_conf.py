@@ -1,20 +1,15 @@
 #!/usr/bin/python3
 
-import pynetbox
-
-from jnpr.junos import Device
-from jnpr.junos.utils.config import Config
 from jnpr.junos.exception import ConnectError
 
-from getpass import getpass
 import argparse
-import os
 import sys
-import re
 
-from pathlib import Path
 import json
-import yaml
+
+import clab_junos
+import clab_trace
+import clab_yaml
 
 import warnings
 warnings.filterwarnings(action='ignore',module='.*paramiko.*')
@@ -22,7 +17,7 @@ warnings.filterwarnings(action='ignore',module='.*paramiko.*')
 parser = argparse.ArgumentParser()
 parser.add_argument('-s', '--sshconfig', help='SSH config file', default='~/.ssh/config')
 parser.add_argument('-c', '--conffile', help='Path to JSON-formatted JunOS config gile', default='lvs_config.json')
-args = parser.parse_args()
+parser.add_argument('--trace', help='Print time taken by NETCONF RPCs per device and save a Chrome trace-event JSON file here', type=str)
 
 def main():
     """ Reads a local file 'crpd_lvs_config.json', which should be a crpd-compatible 
@@ -33,37 +28,34 @@ def main():
         lvs_config = json.loads(json_config.read())
 
     with open('wmf-lab.yaml', 'r') as wmf_file:
-        wmf_lab = yaml.safe_load(wmf_file)
-
-    for node_name in wmf_lab['topology']['nodes'].keys():
-        if node_name.startswith('lvs'):
-            clab_name = f"clab-wmf-lab-{node_name}"
-
-            junos_dev = get_junos_dev(clab_name)
+        wmf_lab = clab_yaml.load(wmf_file)
 
-            junos_dev.config.load(json.dumps(lvs_config), format="json", overwrite=True)
-            junos_dev.config.commit()
-            print(f"Pushed LVS config for {node_name}.")
-
-            junos_dev.close()
-
-    print()
-
-
-def get_junos_dev(dev_name):
-    # Initiates NETCONF session to router
+    clab_junos.init(args.sshconfig)
     try:
-        device = Device(dev_name, username=os.getlogin(), ssh_config=args.sshconfig, port=22)
-        device.open()
+        for node_name in get_lvs_nodes(wmf_lab):
+            push_lvs_node(node_name, lvs_config)
     except ConnectError as err:
         print(f"Cannot connect to device: {err}")
         sys.exit(1)
 
-    # Get config object
-    device.bind(config=Config)
+    print()
+
+
+def get_lvs_nodes(wmf_lab):
+    return [node_name for node_name in wmf_lab['topology']['nodes'].keys() if node_name.startswith('lvs')]
+
 
-    return device
+def push_lvs_node(node_name, lvs_config):
+    """ Replaces node's config with lvs_config and commits it """
+    with clab_junos.session(f"clab-wmf-lab-{node_name}") as junos_dev:
+        junos_dev.config.load(json.dumps(lvs_config), format="json", overwrite=True)
+        junos_dev.config.commit()
+    print(f"Pushed LVS config for {node_name}.")
 
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     main()
+    if args.trace:
+        clab_trace.print_summary()
+        clab_trace.save_trace(args.trace)
@@ -1,127 +1,171 @@
 #!/usr/bin/python3
 
-from jnpr.junos import Device
-from jnpr.junos.utils.config import Config
-from jnpr.junos.exception import ConnectError
+from jnpr.junos.exception import ConnectError, RpcError
+from ncclient.transport.errors import TransportError
 
-from getpass import getpass
 import argparse
-import os
 import sys
-import re
+import copy
+import time
 
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 import json
-import yaml
+
+import clab_confdiff
+import clab_junos
+import clab_trace
+import clab_yaml
 
 import warnings
 warnings.filterwarnings(action='ignore',module='.*paramiko.*')
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-s', '--sshconfig', help='SSH config file', default='~/.ssh/config')
-args = parser.parse_args()
+parser.add_argument('-j', '--jobs', help='Number of nodes to update in parallel (default: 4)', type=int, default=4)
+parser.add_argument('--trace', help='Print time taken by NETCONF RPCs per device and save a Chrome trace-event JSON file here', type=str)
 
-def main():
-    """ Removes BGP groups in list 'disable_groups' from selected clab devices, and pushes saved BGP and 
-        OSPF config to them if it is present. """
+DISABLE_GROUPS = ['Anycast4', 'Anycast6', 'IX4', 'IX6', 'Private-Peer4', 'Private-Peer6', 'Kubernetes4', 'Kubernetes6', 'Kubestage4', 'Kubestage6', 'Kubemlserve4', 'Kubemlserve6', 'Kubedse4', 'Kubedse6', 'Netflow', 'Cloudflare4', 'Switch4', 'Switch6', 'Kubemlstaging4', 'Kubemlstaging6']
+
+# Only operate on devices which name starts with one of these
+DEVICE_PREFIXES = ('cr')
 
-    disable_groups = ['Anycast4', 'Anycast6', 'IX4', 'IX6', 'Private-Peer4', 'Private-Peer6', 'Kubernetes4', 'Kubernetes6', 'Kubestage4', 'Kubestage6', 'Kubemlserve4', 'Kubemlserve6', 'Kubedse4', 'Kubedse6', 'Netflow', 'Cloudflare4', 'Switch4', 'Switch6', 'Kubemlstaging4', 'Kubemlstaging6']
+@dataclass
+class NodeResult:
+    name: str
+    seconds: float = 0
+    pushed: bool = False
+    # Size of config change loaded
+    load_bytes: int = 0
+    error: str = None
 
-    # Only operate on devices which name starts with one of these
-    device_prefixes = ('cr')
+
+def main():
+    """ Removes BGP groups in list DISABLE_GROUPS from selected clab devices, and pushes saved BGP and 
+        OSPF config to them if it is present.  Nodes are updated in parallel, and one that fails
+        doesn't stop the others.  Returns True if all were updated. """
 
     with open('output/wmf-lab.yaml', 'r') as wmf_file:
-        wmf_lab = yaml.safe_load(wmf_file)
+        wmf_lab = clab_yaml.load(wmf_file)
+
+    clab_junos.init(args.sshconfig)
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {node_name: executor.submit(push_node, node_name) for node_name in get_cr_nodes(wmf_lab)}
+    results = {node_name: future.result() for node_name, future in futures.items()}
 
-    for node_name in wmf_lab['topology']['nodes'].keys():
-        if node_name.startswith(device_prefixes):
-            clab_name = f"clab-wmf-lab-{node_name}"
-            junos_dev = get_junos_dev(clab_name)
+    print_results(results)
+    return not any(result.error for result in results.values())
 
+
+def get_cr_nodes(wmf_lab):
+    return [node_name for node_name in wmf_lab['topology']['nodes'].keys() if node_name.startswith(DEVICE_PREFIXES)]
+
+
+def push_node(node_name, data_dir="junos_data"):
+    """ Gets node's committed config, updates it with the data saved in data_dir and loads /
+        commits just the stanzas that changed, if any.  Errors, including from malformed saved
+        data, are recorded in the returned result rather than raised. """
+    result = NodeResult(node_name)
+    start = time.perf_counter()
+    try:
+        with clab_junos.session(f"clab-wmf-lab-{node_name}") as junos_dev:
             config = junos_dev.rpc.get_config(options={'format':'json', 'database' : 'committed'})
             del config['configuration']['@']
-            changed = False
-
-            # Iterate over BGP groups on device, and set any that we want to disabled in the config.
-            existing_bgp_groups = []
-            try:
-                for bgp_group in config['configuration']['protocols']['bgp']['group']:
-                    existing_bgp_groups.append(bgp_group['name'])
-                    if bgp_group['name'] in disable_groups and '@' not in bgp_group:
-                        bgp_group['@'] = {"inactive": True}
-                        changed = True
-            except KeyError:
-                # No existing groups defined in running conf, pass
-                pass
-
-            # If present, load saved config from junos_config dir for this device
-            try:
-                with open(f"junos_data/config/{node_name}.json", 'r') as json_file:
-                    prod_config = json.load(json_file)
-                # Add any BGP groups that do no exist on device:
-                for bgp_group in prod_config['configuration']['protocols']['bgp']['group']:
-                    if bgp_group['name'] not in existing_bgp_groups and bgp_group['name'] not in disable_groups:
-                        config['configuration']['protocols']['bgp']['group'].append(bgp_group)
-                        changed = True
-            except FileNotFoundError:
-                pass
-
-            # If present, load OSPF metrics from live device state
-            try:
-                with open(f"junos_data/ospf_ints/{node_name}.json", 'r') as json_file:
-                    live_metrics = json.load(json_file)
-                    new_metrics = {}
-                    for int_name in live_metrics.keys():
-                        if int_name == "lo0.0":
-                            crpd_int_name = "lo.0"
-                        elif int_name.endswith(".0"):
-                            crpd_int_name = int_name.split('.')[0].replace('/', '_').replace(':', '_')
-                        else:
-                            crpd_int_name = int_name.replace('/', '_').replace(':', '_')
-                        
-
-                        if live_metrics[int_name] == 0:
-                            new_metrics[crpd_int_name] = 1
-                        else:
-                            new_metrics[crpd_int_name] = live_metrics[int_name]
-
-                    for ospf_int in config['configuration']['protocols']['ospf']['area'][0]['interface']:
-                        if ospf_int['name'] in new_metrics.keys():
-                            try:
-                                if ospf_int['metric'] < 100:
-                                    ospf_int['metric'] = new_metrics[ospf_int['name']]
-                                    changed = True
-                            except KeyError:
-                                ospf_int['metric'] = new_metrics[ospf_int['name']]
-                                changed = True
-            except FileNotFoundError:
-                pass
-
-            # Push modified config back to device if things have changed.
-            if changed:
-                junos_dev.config.load(json.dumps(config), format="json", overwrite=True)
+
+            # Push changes to device if things have changed.
+            new_config = copy.deepcopy(config)
+            if update_config(new_config, node_name, data_dir):
+                result.load_bytes = clab_confdiff.load_changes(junos_dev, config, new_config)
+            if result.load_bytes:
                 junos_dev.config.commit()
-                print(f"Pushed revised config for {node_name}.")
+                result.pushed = True
+                print(f"Pushed revised config for {node_name} ({result.load_bytes} bytes).")
+    except (ConnectError, RpcError, TransportError, OSError, KeyError, IndexError, TypeError, ValueError) as err:
+        result.error = str(err) or type(err).__name__
+        print(f"Failed to update {node_name}: {result.error}")
 
-            junos_dev.close()
+    result.seconds = time.perf_counter() - start
+    return result
 
-    print()
 
+def update_config(config, node_name, data_dir="junos_data"):
+    """ Disables unwanted BGP groups in node's config, and adds BGP groups and OSPF metrics saved
+        from production.  Returns True if config was changed. """
+    changed = False
 
-def get_junos_dev(dev_name):
-    # Initiates NETCONF session to router
+    # Iterate over BGP groups on device, and set any that we want to disabled in the config.
+    existing_bgp_groups = []
     try:
-        device = Device(dev_name, username=os.getlogin(), ssh_config=args.sshconfig, port=22)
-        device.open()
-    except ConnectError as err:
-        print(f"Cannot connect to device: {err}")
-        sys.exit(1)
+        for bgp_group in config['configuration']['protocols']['bgp']['group']:
+            existing_bgp_groups.append(bgp_group['name'])
+            if bgp_group['name'] in DISABLE_GROUPS and '@' not in bgp_group:
+                bgp_group['@'] = {"inactive": True}
+                changed = True
+    except KeyError:
+        # No existing groups defined in running conf, pass
+        pass
+
+    # If present, load saved config from junos_config dir for this device
+    try:
+        with open(f"{data_dir}/config/{node_name}.json", 'r') as json_file:
+            prod_config = json.load(json_file)
+        # Add any BGP groups that do no exist on device:
+        for bgp_group in prod_config['configuration']['protocols']['bgp']['group']:
+            if bgp_group['name'] not in existing_bgp_groups and bgp_group['name'] not in DISABLE_GROUPS:
+                config['configuration']['protocols']['bgp']['group'].append(bgp_group)
+                changed = True
+    except FileNotFoundError:
+        pass
+
+    # If present, load OSPF metrics from live device state
+    try:
+        with open(f"{data_dir}/ospf_ints/{node_name}.json", 'r') as json_file:
+            live_metrics = json.load(json_file)
+            new_metrics = {}
+            for int_name in live_metrics.keys():
+                if int_name == "lo0.0":
+                    crpd_int_name = "lo.0"
+                elif int_name.endswith(".0"):
+                    crpd_int_name = int_name.split('.')[0].replace('/', '_').replace(':', '_')
+                else:
+                    crpd_int_name = int_name.replace('/', '_').replace(':', '_')
+                
+
+                if live_metrics[int_name] == 0:
+                    new_metrics[crpd_int_name] = 1
+                else:
+                    new_metrics[crpd_int_name] = live_metrics[int_name]
+
+            for ospf_int in config['configuration']['protocols']['ospf']['area'][0]['interface']:
+                if ospf_int['name'] in new_metrics.keys():
+                    try:
+                        if ospf_int['metric'] < 100:
+                            ospf_int['metric'] = new_metrics[ospf_int['name']]
+                            changed = True
+                    except KeyError:
+                        ospf_int['metric'] = new_metrics[ospf_int['name']]
+                        changed = True
+    except FileNotFoundError:
+        pass
 
-    # Get config object
-    device.bind(config=Config)
+    return changed
 
-    return device
+
+def print_results(results):
+    print()
+    for result in results.values():
+        status = f"FAILED: {result.error}" if result.error else f"pushed {result.load_bytes} bytes" if result.pushed else "no changes"
+        print(f"{result.name:<20} {result.seconds:>8.3f}s  {status}")
+    failed = [result.name for result in results.values() if result.error]
+    print(f"\n{len(results) - len(failed)} of {len(results)} nodes updated ok" +
+          (f", failed: {', '.join(failed)}" if failed else "."))
 
 
 if __name__ == '__main__':
-    main()
+    args = parser.parse_args()
+    ok = main()
+    if args.trace:
+        clab_trace.print_summary()
+        clab_trace.save_trace(args.trace)
+    if not ok:
+        sys.exit(1)
@@ -0,0 +1,232 @@
+import copy
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import clab_confdiff
+from clab_confdiff import REPLACE, diff_object
+
+
+# Minimal model of JunOS loading JSON config, enough to check a patch does what an overwrite
+# load of the desired config would.  With overwrite the candidate becomes the loaded config,
+# otherwise it's merged in honouring the operations and 'inactive' / 'active' attributes.
+
+class FakeConfig:
+    def __init__(self, candidate):
+        self.candidate = candidate
+        self.loads = []
+
+    def load(self, content, format=None, overwrite=False):
+        loaded = json.loads(content)['configuration']
+        self.loads.append((loaded, overwrite))
+        if overwrite:
+            self.candidate = without_operations(loaded)
+        else:
+            self.candidate = apply_object(self.candidate, loaded)
+
+
+class FakeDevice:
+    def __init__(self, candidate):
+        self.config = FakeConfig(copy.deepcopy(candidate))
+
+
+def without_operations(value):
+    if isinstance(value, dict):
+        stripped = {}
+        for key, item in value.items():
+            if key == '@':
+                attrs = {name: attr for name, attr in item.items() if name not in ('operation', 'active')}
+                if attrs:
+                    stripped['@'] = attrs
+            else:
+                stripped[key] = without_operations(item)
+        return stripped
+    if isinstance(value, list):
+        return [without_operations(item) for item in value]
+    return value
+
+
+def apply_object(current, patch):
+    """ Returns current stanza with patch merged in, None if it's deleted """
+    attrs = patch.get('@', {})
+    if attrs.get('operation') == "delete":
+        return None
+    if attrs.get('operation') == "replace":
+        return without_operations(patch)
+    result = copy.deepcopy(current)
+    if attrs.get('inactive'):
+        result.setdefault('@', {})['inactive'] = True
+    if attrs.get('active'):
+        result.get('@', {}).pop('inactive', None)
+        if result.get('@') == {}:
+            del result['@']
+    for key, value in patch.items():
+        if key.startswith('@'):
+            if key != '@' and value.get('operation') == "delete":
+                result.pop(key[1:], None)
+            continue
+        if patch.get(f"@{key}", {}).get('operation') == "delete":
+            continue
+        if isinstance(value, dict):
+            merged = apply_object(result[key], value) if key in result else without_operations(value)
+            if merged is None:
+                result.pop(key, None)
+            else:
+                result[key] = merged
+        elif key in result and clab_confdiff.is_named_list(value) and value:
+            elements = result[key]
+            for element in value:
+                names = [existing['name'] for existing in elements]
+                if element['name'] not in names:
+                    elements.append(without_operations(element))
+                    continue
+                merged = apply_object(elements[names.index(element['name'])], element)
+                if merged is None:
+                    del elements[names.index(element['name'])]
+                else:
+                    elements[names.index(element['name'])] = merged
+            if not elements:
+                del result[key]
+        else:
+            result[key] = without_operations(value)
+    return result
+
+
+def push(current, desired):
+    """ Returns the candidate config after loading the changes, and the load calls made """
+    junos_dev = FakeDevice(current['configuration'])
+    clab_confdiff.load_changes(junos_dev, current, desired)
+    return junos_dev.config.candidate, junos_dev.config.loads
+
+
+BASE = {
+    'configuration': {
+        'system': {'host-name': "cr1-eqiad"},
+        'policy-options': {
+            'policy-statement': [
+                {'name': "BGP_out", 'then': {'accept': [None]}},
+                {'name': "OSPF_out", 'then': {'reject': [None]}}
+            ]
+        },
+        'protocols': {
+            'bgp': {
+                'group': [
+                    {'name': "Core4", 'type': "internal", 'neighbor': [{'name': "10.0.0.1"}, {'name': "10.0.0.2"}]},
+                    {'name': "Transit4", 'type': "external", 'peer-as': "1299"}
+                ]
+            },
+            'ospf': {
+                'no-rfc-1583': [None],
+                'reference-bandwidth': "100g",
+                'area': [{'name': "0.0.0.0", 'interface': [{'name': "xe-0/0/0.0", 'metric': 100}]}]
+            }
+        }
+    }
+}
+
+
+def changed(edit):
+    desired = copy.deepcopy(BASE)
+    edit(desired['configuration'])
+    return desired
+
+
+def test_unchanged():
+    assert diff_object(BASE['configuration'], copy.deepcopy(BASE['configuration'])) is None
+    candidate, loads = push(BASE, copy.deepcopy(BASE))
+    assert loads == []
+
+
+def test_named_list_add():
+    desired = changed(lambda conf: conf['protocols']['bgp']['group'].append({'name': "IX4", 'type': "external"}))
+    patch = diff_object(BASE['configuration'], desired['configuration'])
+    assert patch == {'protocols': {'bgp': {'group': [{'name': "IX4", 'type': "external"}]}}}
+
+
+def test_named_list_delete():
+    desired = changed(lambda conf: conf['protocols']['bgp']['group'].pop(1))
+    patch = diff_object(BASE['configuration'], desired['configuration'])
+    assert patch == {'protocols': {'bgp': {'group': [{'name': "Transit4", '@': {'operation': "delete"}}]}}}
+
+
+def test_named_list_element_changed():
+    desired = changed(lambda conf: conf['protocols']['bgp']['group'][1].update({'peer-as': "174"}))
+    patch = diff_object(BASE['configuration'], desired['configuration'])
+    assert patch == {'protocols': {'bgp': {'group': [{'name': "Transit4", 'peer-as': "174"}]}}}
+
+
+def test_named_list_reorder_replaces_enclosing_stanza():
+    desired = changed(lambda conf: conf['protocols']['bgp']['group'].reverse())
+    patch = diff_object(BASE['configuration'], desired['configuration'])
+    assert patch == {'protocols': {'bgp': {**desired['configuration']['protocols']['bgp'],
+                                           '@': {'operation': "replace"}}}}
+
+
+def test_inactive_toggle():
+    def deactivate(conf):
+        conf['protocols']['bgp']['group'][1]['@'] = {'inactive': True}
+    desired = changed(deactivate)
+    patch = diff_object(BASE['configuration'], desired['configuration'])
+    assert patch == {'protocols': {'bgp': {'group': [{'name': "Transit4", '@': {'inactive': True}}]}}}
+    # And back again
+    patch = diff_object(desired['configuration'], BASE['configuration'])
+    assert patch == {'protocols': {'bgp': {'group': [{'name': "Transit4", '@': {'active': True}}]}}}
+
+
+def test_removed_leaf():
+    desired = changed(lambda conf: conf['protocols']['ospf'].pop('reference-bandwidth'))
+    patch = diff_object(BASE['configuration'], desired['configuration'])
+    assert patch == {'protocols': {'ospf': {'reference-bandwidth': "100g",
+                                            '@reference-bandwidth': {'operation': "delete"}}}}
+
+
+def test_removed_empty_leaf():
+    desired = changed(lambda conf: conf['protocols']['ospf'].pop('no-rfc-1583'))
+    patch = diff_object(BASE['configuration'], desired['configuration'])
+    assert patch == {'protocols': {'ospf': {'no-rfc-1583': [None], '@no-rfc-1583': {'operation': "delete"}}}}
+
+
+def test_changed_empty_leaf_in_named_list():
+    def accept_to_reject(conf):
+        conf['policy-options']['policy-statement'][0]['then'] = {'reject': [None]}
+    desired = changed(accept_to_reject)
+    patch = diff_object(BASE['configuration'], desired['configuration'])
+    assert patch == {'policy-options': {'policy-statement': [
+        {'name': "BGP_out", 'then': {'accept': [None], '@accept': {'operation': "delete"}, 'reject': [None]}}]}}
+
+
+def test_changed_leaf_list_replaces_enclosing_stanza():
+    base = {'configuration': {'policy-options': {'community': [{'name': "NO_EXPORT", 'members': ["no-export"]}]}}}
+    desired = copy.deepcopy(base)
+    desired['configuration']['policy-options']['community'][0]['members'] = ["no-export", "no-advertise"]
+    patch = diff_object(base['configuration'], desired['configuration'])
+    assert patch == {'policy-options': {'community': [
+        {'name': "NO_EXPORT", 'members': ["no-export", "no-advertise"], '@': {'operation': "replace"}}]}}
+
+
+def test_top_level_change_falls_back_to_overwrite():
+    base = changed(lambda conf: conf.update({'apply-groups': ["clab"]}))
+    # A changed leaf-list directly under 'configuration' can't be a patch
+    desired = changed(lambda conf: conf.update({'apply-groups': ["clab", "lvs"]}))
+    assert diff_object(base['configuration'], desired['configuration']) is REPLACE
+    candidate, loads = push(base, desired)
+    assert loads == [(desired['configuration'], True)]
+    assert candidate == desired['configuration']
+
+
+def test_patch_matches_overwrite():
+    def edit(conf):
+        bgp_groups = conf['protocols']['bgp']['group']
+        bgp_groups[0]['neighbor'].pop(0)
+        bgp_groups[0]['@'] = {'inactive': True}
+        bgp_groups.pop(1)
+        bgp_groups.append({'name': "IX6", 'type': "external", 'multipath': [None]})
+        conf['protocols']['ospf'].pop('no-rfc-1583')
+        conf['protocols']['ospf']['area'][0]['interface'][0]['metric'] = 200
+        conf['policy-options']['policy-statement'].reverse()
+        conf['system'] = {'host-name': "cr2-eqiad", 'time-zone': "UTC"}
+    desired = changed(edit)
+    candidate, loads = push(BASE, desired)
+    assert [overwrite for loaded, overwrite in loads] == [False]
+    assert candidate == desired['configuration']